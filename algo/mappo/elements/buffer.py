@@ -5,32 +5,20 @@ import numpy as np
 
 from core.decorator import config
 from algo.ppo.elements.buffer import compute_indices
+from utility.returns import compute_gae, length_mask
 from utility.utils import standardize
 
 logger = logging.getLogger(__name__)
 
 
-def compute_gae(reward, discount, value, last_value, gamma, 
-                gae_discount, norm_adv=False, mask=None, epsilon=1e-8):
-    if last_value is not None:
-        last_value = np.expand_dims(last_value, 0)
-        next_value = np.concatenate([value[1:], last_value], axis=0)
-    else:
-        next_value = value[1:]
-        value = value[:-1]
-    assert value.shape == next_value.shape, (value.shape, next_value.shape)
-    advs = delta = (reward + discount * gamma * next_value - value)
-    next_adv = 0
-    for i in reversed(range(advs.shape[0])):
-        advs[i] = next_adv = (delta[i] 
-            + discount[i] * gae_discount * next_adv)
-    traj_ret = advs + value
-    if norm_adv:
-        advs = standardize(advs, mask=mask, epsilon=epsilon)
-    return advs, traj_ret
-
-
 class MAPPOBuffer:
+    """ Trajectories are written into arrays of shape 
+    [n_envs, T, n_agents, ...] at per-env cursors, where T grows 
+    as needed. Finished trajectories are moved into memory arrays 
+    of shape [size, ...], reshaped to [size // sample_size, sample_size, ...] 
+    for sampling, where agent sequences are laid out as in 
+    [n_agents, n_envs * T, ...]
+    """
     @config
     def __init__(self):
         self._add_attributes()
@@ -43,11 +31,19 @@ class MAPPOBuffer:
         self._shuffled_idxes = np.arange(self._batch_size)
         self._curr_idxes = np.arange(self._mb_size)
         self._gae_discount = self._gamma * self._lam
-        self._buffer = [collections.defaultdict(list) for _ in range(self._n_envs)]
-        self._memory = collections.defaultdict(list)
+        # initialized on the first add
+        self._buffer = {}
+        self._traj_capacity = getattr(self, '_traj_capacity', 128)
+        self._n_agents = None
+        self._cursors = np.zeros(self._n_envs, dtype=np.int32)
+        self._invalid_episodes = np.zeros(self._n_envs, dtype=bool)
+        self._storage = {}
+        self._memory = {}
         
         self._is_store_shape = True
         self._norm_adv = getattr(self, '_norm_adv', 'minibatch')
+        # numpy or tf, see utility.returns
+        self._adv_backend = getattr(self, '_adv_backend', 'numpy')
         self._epsilon = 1e-5
 
         # sleep for dataset to have data
@@ -57,10 +53,8 @@ class MAPPOBuffer:
         self._ready = False
 
         # debug stats
-        self._buffer_size = [0 for _ in range(self._n_envs)]
         self._n_transitions = 0
         self._mem_len = 0
-        self._invalid_episodes = set()
         self._batch_history = collections.deque(maxlen=10)
         self._curr_batch_size = 0
 
@@ -83,94 +77,125 @@ class MAPPOBuffer:
         return self._ready
     
     def reset(self):
-        for traj in self._buffer:
-            traj.clear()
-        
         self.clear_buffer()
         self._n_transitions = 0
-        self._memory.clear()
+        self._memory = {}
         self._mem_len = 0
         self._ready = False
     
     def clear_buffer(self):
-        [traj.clear() for traj in self._buffer]
-        self._invalid_episodes.clear()
-        self._buffer_size = [0 for _ in range(self._n_envs)]
+        self._cursors[:] = 0
+        self._invalid_episodes[:] = False
         
     def add(self, i, **data):
-        assert i < len(self._buffer), i
+        assert i < self._n_envs, i
+        self.add_envs([i], **{k: np.expand_dims(v, 0) for k, v in data.items()})
 
-        if i in self._invalid_episodes:
-            raise ValueError(f'Adding data to invalid episodes({i}). Current invalid episodes: {self._invalid_episodes}')
-        n_agents = next(iter(data.values())).shape[0]
-        self._buffer_size[i] += n_agents
-        self._n_transitions += n_agents
+    def add_envs(self, env_ids, **data):
+        """ Adds a step of environments env_ids, 
+        where data are of shape [len(env_ids), n_agents, ...] """
+        env_ids = np.asarray(env_ids)
+        if np.any(self._invalid_episodes[env_ids]):
+            raise ValueError(f'Adding data to invalid episodes'
+                f'({env_ids[self._invalid_episodes[env_ids]]}). '
+                f'Current invalid episodes: {np.nonzero(self._invalid_episodes)[0]}')
+        if not self._buffer:
+            self._init_buffer(data)
+        steps = self._cursors[env_ids]
+        if np.any(steps == self._traj_capacity):
+            self._grow_buffer()
         for k, v in data.items():
-            assert v.shape[0] == n_agents, (k, v.shape)
-            self._buffer[i][k].append(v)
+            assert v.shape[:2] == (env_ids.size, self._n_agents), (k, v.shape)
+            self._buffer[k][env_ids, steps] = v
+        self._cursors[env_ids] += 1
+        self._n_transitions += env_ids.size * self._n_agents
     
     def remove(self, i):
-        if not self._buffer[i]:
-            assert self._buffer_size[i] == 0, self._buffer_size[i]
+        if self._cursors[i] == 0:
             return
-        self._n_transitions -= self._buffer_size[i]
-        self._buffer[i].clear()
-        self._buffer_size[i] = 0
-        self._invalid_episodes.add(i)
+        self._n_transitions -= self._cursors[i] * self._n_agents
+        self._cursors[i] = 0
+        self._invalid_episodes[i] = True
     
     def finish(self, last_values):
-        def compute_advantages_and_returns(buffer, last_values):
-            for i, (traj, lv) in enumerate(zip(buffer, last_values)):
-                if not traj:
-                    assert self._buffer_size[i] == 0, (i, self._buffer_size)
-                    assert i in self._invalid_episodes, (i, self._invalid_episodes)
-                    continue
-                assert i not in self._invalid_episodes, (i, self._invalid_episodes)
-                traj['advantage'], traj['traj_ret'] = \
-                    compute_gae(
-                        reward=np.array(traj['reward']), 
-                        discount=np.array(traj['discount']),
-                        value=np.array(traj['value']),
-                        last_value=lv,
-                        gamma=self._gamma,
-                        gae_discount=self._gae_discount,
-                        norm_adv=self._norm_adv == 'batch',
-                        epsilon=self._epsilon)
-            return buffer
+        def compute_advantages_and_returns(idxes, lengths, last_values):
+            T = lengths.max()
+            return compute_gae(
+                reward=self._buffer['reward'][idxes, :T], 
+                discount=self._buffer['discount'][idxes, :T],
+                value=self._buffer['value'][idxes, :T],
+                last_value=np.asarray(last_values)[idxes],
+                gamma=self._gamma,
+                gae_discount=self._gae_discount,
+                norm_adv=self._norm_adv == 'batch',
+                epsilon=self._epsilon,
+                lengths=lengths,
+                backend=self._adv_backend)
         
-        def move_data_to_memory(buffer):
+        def move_data_to_memory(idxes, lengths, advantage, traj_ret):
             n = self._n_transitions - self._mem_len
             if self._n_transitions > self._size:
                 n -= self._n_transitions % self._sample_size
-            self._mem_len += n
+            # valid steps, ordered by env and then time
+            rows, steps = np.nonzero(length_mask(lengths, lengths.max(), 2))
+            env_ids = idxes[rows]
             for k in self._sample_keys:
-                v = np.concatenate([traj[k] for traj in buffer if traj])    # merge env axis into sequential axis
-                v = np.swapaxes(v, 0, 1)    # swap sequential and agent axes
-                v = np.concatenate(v)[:n]
-                self._memory[k].append(v)
-                # debugging assert
-                lens = [v.shape[0] for v in self._memory[k]]
-                assert sum(lens) == self._mem_len, (lens, self._mem_len, n)
-
-        def reshape_memory(memory):
-            for k, v in memory.items():
-                v = np.concatenate(v)
-                assert v.shape[0] == self._mem_len, (v.shape, self._mem_len)
-                memory[k] = v.reshape(-1, self._sample_size, *v.shape[1:])
+                if k == 'advantage':
+                    v = advantage[rows, steps]
+                elif k == 'traj_ret':
+                    v = traj_ret[rows, steps]
+                else:
+                    v = self._buffer[k][env_ids, steps]
+                # merge the env and sequential axes into the agent axis
+                v = np.swapaxes(v, 0, 1).reshape(-1, *v.shape[2:])[:n]
+                self._write_memory(k, v)
+            self._mem_len += n
+
+        def reshape_memory():
+            self._memory = {k: v[:self._mem_len].reshape(-1, self._sample_size, *v.shape[1:])
+                for k, v in self._storage.items()}
             self._curr_batch_size = self._mem_len // self._sample_size
             self._batch_history.append(self._curr_batch_size)
         
         if self._n_transitions > self._mem_len:
-            compute_advantages_and_returns(self._buffer, last_values)
-            move_data_to_memory(self._buffer)
+            idxes = np.nonzero(self._cursors)[0]
+            assert not np.any(self._invalid_episodes[idxes]), \
+                (idxes, np.nonzero(self._invalid_episodes)[0])
+            lengths = self._cursors[idxes]
+            advantage, traj_ret = compute_advantages_and_returns(
+                idxes, lengths, last_values)
+            move_data_to_memory(idxes, lengths, advantage, traj_ret)
             self.clear_buffer()
             self._ready = self._n_transitions > self._size
             if self._ready:
-                reshape_memory(self._memory)
+                reshape_memory()
             return self._ready
         else:
             return False
 
+    def _init_buffer(self, data):
+        self._n_agents = next(iter(data.values())).shape[1]
+        self._buffer = {k: np.zeros(
+            (self._n_envs, self._traj_capacity, *v.shape[1:]), dtype=v.dtype)
+            for k, v in data.items()}
+
+    def _grow_buffer(self):
+        """ Doubles the capacity of trajectories """
+        self._buffer = {k: np.concatenate([v, np.zeros_like(v)], axis=1)
+            for k, v in self._buffer.items()}
+        self._traj_capacity *= 2
+
+    def _write_memory(self, k, v):
+        end = self._mem_len + v.shape[0]
+        if k not in self._storage or self._storage[k].shape[0] < end:
+            old = self._storage.get(k)
+            capacity = max(end, self._size + v.shape[0] if old is None 
+                else 2 * old.shape[0])
+            self._storage[k] = np.zeros((capacity, *v.shape[1:]), dtype=v.dtype)
+            if old is not None:
+                self._storage[k][:self._mem_len] = old[:self._mem_len]
+        self._storage[k][self._mem_len:end] = v
+
     def sample(self, sample_keys=None):
         def shuffule_indices():
             assert self._mem_len % self._sample_size == 0, (self._mem_len, self._sample_size)
@@ -238,13 +263,13 @@ class MAPPOBuffer:
         }
     
     def get(self, i, k):
-        return np.array(self._buffer[i][k])
+        return self._buffer[k][i, :self._cursors[i]]
     
     def update_buffer(self, i, k, v):
-        self._buffer[i][k] = v
+        self._buffer[k][i, :self._cursors[i]] = v
     
     def is_valid_traj(self, i):
-        return bool(self._buffer[i])
+        return bool(self._cursors[i])
 
 def create_buffer(config):
     return MAPPOBuffer(config)
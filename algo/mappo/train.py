@@ -65,14 +65,16 @@ def run(agent, env, buffer, step):
             **tf.nest.map_structure(
                 lambda x: x.reshape(env.n_envs, env.n_agents, *x.shape[1:]), terms)
         )
-        kwargs = [{k: v[i] for k, v in kwargs.items()} for i in range(env.n_envs)]
         info_list = env.info()
-        for i, (info, data) in enumerate(zip(info_list, kwargs)):
+        for i, info in enumerate(info_list):
             if info['bad_episode']:
                 buffer.remove(i)
-            elif info['valid_step']:
-                buffer.add(i, **data)
-                last_env_output[i] = env_output[i]
+        valid_env_ids = np.array([i for i, info in enumerate(info_list) 
+            if info['valid_step'] and not info['bad_episode']], dtype=np.int32)
+        if valid_env_ids.size:
+            buffer.add_envs(valid_env_ids, 
+                **{k: v[valid_env_ids] for k, v in kwargs.items()})
+            last_env_output[valid_env_ids] = env_output[valid_env_ids]
         prev_reset = reset
 
     score = env.score()
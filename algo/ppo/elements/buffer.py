@@ -4,51 +4,14 @@ import numpy as np
 
 from core.decorator import config
 from core.log import do_logging
-from utility.utils import moments, standardize
+from utility.returns import compute_gae, compute_nae
+from utility.utils import standardize
 from replay.utils import init_buffer, print_buffer
 
 
 logger = logging.getLogger(__name__)
 
 
-def compute_nae(reward, discount, value, last_value, 
-                gamma, mask=None, epsilon=1e-8):
-    next_return = last_value
-    traj_ret = np.zeros_like(reward)
-    for i in reversed(range(reward.shape[1])):
-        traj_ret[:, i] = next_return = (reward[:, i]
-            + discount[:, i] * gamma * next_return)
-
-    # Standardize traj_ret and advantages
-    traj_ret_mean, traj_ret_var = moments(traj_ret)
-    traj_ret_std = np.maximum(np.sqrt(traj_ret_var), 1e-8)
-    value = standardize(value, mask=mask, epsilon=epsilon)
-    # To have the same mean and std as trajectory return
-    value = (value + traj_ret_mean) / traj_ret_std     
-    advantage = standardize(traj_ret - value, mask=mask, epsilon=epsilon)
-    traj_ret = standardize(traj_ret, mask=mask, epsilon=epsilon)
-
-    return advantage, traj_ret
-
-def compute_gae(reward, discount, value, last_value, gamma, 
-                gae_discount, norm_adv=False, mask=None, epsilon=1e-8):
-    if last_value is not None:
-        last_value = np.expand_dims(last_value, 1)
-        next_value = np.concatenate([value[:, 1:], last_value], axis=1)
-    else:
-        next_value = value[:, 1:]
-        value = value[:, :-1]
-    assert value.shape == next_value.shape, (value.shape, next_value.shape)
-    advs = delta = (reward + discount * gamma * next_value - value)
-    next_adv = 0
-    for i in reversed(range(advs.shape[1])):
-        advs[:, i] = next_adv = (delta[:, i] 
-            + discount[:, i] * gae_discount * next_adv)
-    traj_ret = advs + value
-    if norm_adv:
-        advs = standardize(advs, mask=mask, epsilon=epsilon)
-    return advs, traj_ret
-
 def compute_indices(idxes, mb_idx, mb_size, N_MBS):
     start = mb_idx * mb_size
     end = (mb_idx + 1) * mb_size
@@ -104,6 +67,8 @@ class PPOBuffer:
         self._is_store_shape = True
         self._inferred_sample_keys = False
         self._norm_adv = getattr(self, '_norm_adv', 'minibatch')
+        # numpy or tf, see utility.returns
+        self._adv_backend = getattr(self, '_adv_backend', 'numpy')
         self._epsilon = 1e-5
         if hasattr(self, 'N_VALUE_EPOCHS'):
             self.N_EPOCHS += self.N_VALUE_EPOCHS
@@ -119,6 +84,10 @@ class PPOBuffer:
     def batch_size(self):
         return self._mb_size
 
+    @property
+    def norm_adv(self):
+        return self._norm_adv
+
     def __getitem__(self, k):
         return self._memory[k]
 
@@ -151,6 +120,18 @@ class PPOBuffer:
 
         self._idx += 1
 
+    def step_slots(self):
+        """ Returns views of memory at the current step, into which 
+        data of the step are written in place of add, followed by 
+        advance. Returns None before the first add initializes memory """
+        if self._memory == {}:
+            return None
+        return {k: v[:, self._idx] for k, v in self._memory.items()}
+
+    def advance(self):
+        """ Moves to the next step after writing to step_slots """
+        self._idx += 1
+
     def update(self, key, value, field='mb', mb_idxes=None):
         if field == 'mb':
             mb_idxes = self._curr_idxes if mb_idxes is None else mb_idxes
@@ -193,6 +174,16 @@ class PPOBuffer:
 
         return sample
 
+    def sample_all(self, sample_keys=None):
+        """ Returns the whole batch without shuffling or processing, 
+        for training loops that form minibatches themselves """
+        assert not self._sample_size, 'Sequential data is not supported'
+        if not self._ready:
+            self._wait_to_sample()
+
+        sample_keys = sample_keys or self._sample_keys
+        return {k: self._memory[k] for k in sample_keys}
+
     def _wait_to_sample(self):
         while not self._ready:
             time.sleep(self._sleep_time)
@@ -284,7 +275,8 @@ class PPOBuffer:
                 last_value=last_value,
                 gamma=self._gamma,
                 mask=self._memory.get('life_mask'),
-                epsilon=self._epsilon)
+                epsilon=self._epsilon,
+                backend=self._adv_backend)
         elif self._adv_type == 'gae':
             self._memory['advantage'], self._memory['traj_ret'] = \
                 compute_gae(
@@ -296,7 +288,8 @@ class PPOBuffer:
                 gae_discount=self._gae_discount,
                 norm_adv=self._norm_adv == 'batch',
                 mask=self._memory.get('life_mask'),
-                epsilon=self._epsilon)
+                epsilon=self._epsilon,
+                backend=self._adv_backend)
         elif self._adv_type == 'vtrace':
             pass
         else:
@@ -19,9 +19,14 @@ class PPOTrainingLoop(TrainingLoopBase):
         self._value_sample_keys = [
             'global_state', 'value', 'traj_ret', 'mask'
         ] + list(value_state_keys)
+        # runs the epoch loop in the graph if True, see _train_ppo_fused
+        self._fused_epochs = getattr(self, '_fused_epochs', False)
 
     def _train(self):
-        train_step, stats = self._train_ppo()
+        if self._fused_epochs:
+            train_step, stats = self._train_ppo_fused()
+        else:
+            train_step, stats = self._train_ppo()
         extra_stats = self._train_extra_vf()
         stats.update(extra_stats)
 
@@ -79,6 +84,65 @@ class PPOTrainingLoop(TrainingLoopBase):
 
         return n, stats
 
+    def _train_ppo_fused(self):
+        """ Trains with the epoch loop running in a compiled function. 
+        The batch is uploaded to the device once, and stats are fetched 
+        once per call to trainer.train_epochs, which covers all epochs 
+        if value_update is null and one epoch otherwise, as values 
+        and advantages are then updated on the host between epochs.
+        _after_train_step is not called in this mode.
+        """
+        stats = collections.defaultdict(list)
+        max_kl = getattr(self, '_max_kl', None) or None
+        n_epochs = self.N_EPOCHS if self._value_update is None else 1
+        norm_adv = self.dataset.norm_adv == 'minibatch'
+        n = 0
+        train_time = 0
+
+        for i in range(0, self.N_EPOCHS, n_epochs):
+            with self._sample_timer:
+                data = self.dataset.sample_all()
+                data = {k: tf.convert_to_tensor(v) for k, v in data.items()}
+
+            with self._train_timer:
+                out = self.trainer.train_epochs(
+                    data, n_epochs=n_epochs, n_mbs=self.N_MBS, 
+                    max_kl=max_kl, norm_adv=norm_adv)
+                n_updates, kl, value, terms = tf.nest.map_structure(
+                    lambda x: x.numpy(), out)
+            train_time += self._train_timer.last()
+            n += n_updates
+
+            for k, v in terms.items():
+                stats[f'train/{k}'] += list(v)
+
+            if max_kl and kl > max_kl:
+                do_logging(f'Eearly stopping after {n} update(s) '
+                    f'due to reaching max kl. Current kl={kl:.3g}', logger=logger)
+                break
+
+            if self._value_update == 'reuse':
+                self.dataset.update('value', value, field='all')
+            if self._value_update == 'once':
+                self.dataset.update_value_with_func(self.compute_value)
+            if self._value_update is not None:
+                last_value = self.compute_value()
+                self.dataset.finish(last_value)
+
+            self._after_train_epoch()
+
+        stats['misc/policy_updates'] = n
+        stats['train/kl'] = kl
+        stats['train/value'] = value,
+        stats['time/sample_mean'] = self._sample_timer.average()
+        stats['time/train_mean'] = train_time / n
+        stats['time/fps'] = n / train_time
+
+        if self._train_timer.total() > 1000:
+            self._train_timer.reset()
+
+        return n, stats
+
     def _train_extra_vf(self):
         stats = collections.defaultdict(list)
         for _ in range(self.N_VALUE_EPOCHS):
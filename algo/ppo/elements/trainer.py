@@ -1,4 +1,5 @@
 import functools
+import tensorflow as tf
 
 from core.elements.trainer import Trainer, create_trainer
 from core.decorator import override
@@ -12,6 +13,7 @@ class PPOTrainer(Trainer):
         # Explicitly instantiate tf.function to avoid unintended retracing
         TensorSpecs = get_data_format(self.config, env_stats, self.loss.model, False)
         self.train = build(self.train, TensorSpecs)
+        self.train_epochs = tf.function(self.raw_train_epochs)
 
     def raw_train(self, obs, action, value, traj_ret, 
             advantage, logpi, state=None, mask=None):
@@ -22,6 +24,65 @@ class PPOTrainer(Trainer):
 
         return terms
 
+    def raw_train_epochs(self, data, n_epochs, n_mbs, 
+            max_kl=None, norm_adv=True, epsilon=1e-5):
+        """ Runs n_epochs of minibatch updates on data, the whole batch 
+        residing on the device. Minibatches are shuffled and sliced in 
+        the graph, and training stops early once kl exceeds max_kl
+        
+        Returns:
+            n: the number of updates
+            kl: kl of the last update
+            value: data['value'] overwritten by values 
+                computed in each minibatch. Minibatches are always
+                trained with the old values in data['value']
+            terms: the mean of each term per update, stacked
+        """
+        size = tf.shape(data['advantage'])[0]
+        mb_size = size // n_mbs
+        n = n_epochs * n_mbs
+        # a random permutation of indices per epoch, 
+        # sliced into n_epochs * n_mbs minibatches
+        idxes = tf.argsort(tf.random.uniform((n_epochs, size)), axis=-1)
+        idxes = tf.reshape(idxes[:, :n_mbs * mb_size], (n, mb_size))
+
+        outputs = self.train.structured_outputs
+        kl = tf.zeros((), outputs['kl'].dtype)
+        terms = {k: tf.TensorArray(v.dtype, size=0, dynamic_size=True)
+            for k, v in outputs.items() if k not in ('kl', 'value')}
+
+        def cond(i, kl, value, terms):
+            if max_kl:
+                return tf.logical_and(i < n, kl <= max_kl)
+            return i < n
+
+        def body(i, kl, value, terms):
+            mb_idxes = idxes[i]
+            # values are gathered from data, so that later epochs
+            # clip the value loss against the rollout's old values
+            mb = {k: tf.gather(v, mb_idxes) for k, v in data.items()}
+            if norm_adv:
+                mean, var = tf.nn.moments(mb['advantage'], 
+                    axes=list(range(mb['advantage'].shape.ndims)))
+                mb['advantage'] = (mb['advantage'] - mean) / tf.sqrt(var + epsilon)
+            mb_terms = self.raw_train(**mb)
+            kl = mb_terms.pop('kl')
+            # values of the minibatch stopping the loop are written 
+            # back as well, which is fine as the data is dropped then
+            value = tf.tensor_scatter_nd_update(
+                value, mb_idxes[:, None], 
+                tf.cast(mb_terms.pop('value'), value.dtype))
+            terms = {k: terms[k].write(i, tf.reduce_mean(v)) 
+                for k, v in mb_terms.items()}
+
+            return i+1, kl, value, terms
+
+        i, kl, value, terms = tf.while_loop(
+            cond, body, (0, kl, data['value'], terms))
+        terms = {k: v.stack() for k, v in terms.items()}
+
+        return i, kl, value, terms
+
 
 create_trainer = functools.partial(create_trainer,
     name='ppo', trainer_cls=PPOTrainer
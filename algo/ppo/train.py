@@ -1,5 +1,6 @@
 import functools
 import signal
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import numpy as np
 
@@ -8,15 +9,25 @@ from core.monitor import create_monitor
 from core.tf_config import configure_gpu, configure_precision, silence_tf_logs
 from core.utils import save_config
 from utility.utils import TempStore
-from utility.run import Runner, evaluate
+from utility.run import Runner, RunMode, evaluate
 from utility.timer import Every, Timer
 from utility import pkg
 from env.func import create_env
 
 
-def train(agent, env, eval_env, buffer):
+def train(agent, env, eval_env, buffer, collect_buffer=None):
+    """ Trains the agent, collecting data into buffer in between 
+    training if collect_buffer is None. Otherwise, data is collected 
+    into collect_buffer in a background thread while training on 
+    buffer, and the two are swapped every iteration. The data trained 
+    on is then collected by policies from the previous iteration, i.e., 
+    it is stale by at most the updates of one iteration, 
+    which are recorded as misc/staleness. If these updates exceed 
+    agent.max_staleness, collection starts after training instead.
+    Collection is paused during evaluation and recording, 
+    which share the model and the monitor with it
+    """
     collect_fn = pkg.import_module('elements.utils', algo=agent.name).collect
-    collect = functools.partial(collect_fn, buffer)
 
     suite_name = env.name.split("_")[0] \
         if '_' in env.name else 'builtin'
@@ -24,12 +35,21 @@ def train(agent, env, eval_env, buffer):
     info_func = em.info_func if hasattr(em, 'info_func') else None
 
     step = agent.get_env_step()
-    runner = Runner(env, agent, step=step, nsteps=agent.N_STEPS, info_func=info_func)
+    run_mode = agent.config.get('run_mode', RunMode.NSTEPS)
+    runner = Runner(env, agent, step=step, nsteps=agent.N_STEPS, 
+        run_mode=run_mode, info_func=info_func)
+
+    def collect(buffer, **kwargs):
+        """ Runs the runner, collecting data into buffer """
+        if run_mode == RunMode.SLOTS:
+            return runner.run(buffer=buffer, **kwargs)
+        return runner.run(
+            step_fn=functools.partial(collect_fn, buffer), **kwargs)
 
     def initialize_rms():
         print('Start to initialize running stats...')
         for _ in range(10):
-            runner.run(action_selector=env.random_action, step_fn=collect)
+            collect(buffer, action_selector=env.random_action)
             agent.actor.update_obs_rms(np.concatenate(buffer['obs']))
             agent.actor.update_reward_rms(buffer['reward'], buffer['discount'])
             buffer.reset()
@@ -78,11 +98,7 @@ def train(agent, env, eval_env, buffer):
             agent.record(step=step)
             agent.save()
 
-    print('Training starts...')
-    while step < agent.MAX_STEPS:
-        start_env_step = agent.get_env_step()
-        with rt:
-            step = runner.run(step_fn=collect)
+    def process_buffer(buffer):
         # NOTE: normalizing rewards here may introduce some inconsistency 
         # if normalized rewards is fed as an input to the network.
         # One can reconcile this by moving normalization to collect 
@@ -96,21 +112,79 @@ def train(agent, env, eval_env, buffer):
         value = agent.compute_value()
         buffer.finish(value)
 
-        start_train_step = agent.get_train_step()
-        with tt:
-            agent.train_record()
+    def train_record(step, start_env_step, start_train_step, pause=None):
+        """ pause waits for the collection running in the background """
         agent.store(
             fps=(step-start_env_step)/rt.last(),
             tps=(agent.get_train_step()-start_train_step)/tt.last())
         agent.set_env_step(step)
-        buffer.reset()
 
-        if to_eval(agent.get_train_step()) or step > agent.MAX_STEPS:
+        evaluating = to_eval(agent.get_train_step()) or step > agent.MAX_STEPS
+        recording = to_record(agent.get_train_step())
+        if pause is not None and (evaluating or recording):
+            pause()
+
+        if evaluating:
             evaluate_agent(step, eval_env, agent)
 
-        if to_record(agent.get_train_step()) and agent.contains_stats('score'):
+        if recording and agent.contains_stats('score'):
             record_stats(step)
 
+    if collect_buffer is not None:
+        print('Training starts with collection overlapped...')
+        executor = ThreadPoolExecutor(max_workers=1)
+        def run(buffer):
+            with rt:
+                return collect(buffer)
+        max_staleness = agent.config.get('max_staleness', None)
+        # the number of updates of one training, unknown until measured
+        updates_per_train = None
+        # the number of updates when each rollout started
+        start_updates = int(agent.trainer.optimizer.iterations)
+        future = executor.submit(run, collect_buffer)
+        while step < agent.MAX_STEPS:
+            start_env_step = agent.get_env_step()
+            step = future.result()
+            process_buffer(collect_buffer)
+            buffer, collect_buffer = collect_buffer, buffer
+            agent.train_loop.dataset = buffer
+            updates = int(agent.trainer.optimizer.iterations)
+            agent.store(**{'misc/staleness': updates - start_updates})
+            # a rollout collected during training is stale by the updates 
+            # of the training, it starts after training if they are too many
+            throttled = max_staleness is not None and (
+                updates_per_train is None or updates_per_train > max_staleness)
+            if not throttled:
+                start_updates = updates
+                future = executor.submit(run, collect_buffer)
+
+            start_train_step = agent.get_train_step()
+            with tt:
+                agent.train_record()
+            buffer.reset()
+            updates_per_train = int(agent.trainer.optimizer.iterations) - updates
+            if throttled:
+                start_updates = int(agent.trainer.optimizer.iterations)
+                future = executor.submit(run, collect_buffer)
+            train_record(step, start_env_step, start_train_step, 
+                pause=future.result)
+        future.result()
+        executor.shutdown()
+        return
+
+    print('Training starts...')
+    while step < agent.MAX_STEPS:
+        start_env_step = agent.get_env_step()
+        with rt:
+            step = collect(buffer)
+        process_buffer(buffer)
+
+        start_train_step = agent.get_train_step()
+        with tt:
+            agent.train_record()
+        buffer.reset()
+        train_record(step, start_env_step, start_train_step)
+
 def main(config, train=train):
     silence_tf_logs()
     configure_gpu()
@@ -180,6 +254,11 @@ def main(config, train=train):
         config.buffer['n_envs'] = env.n_envs
         config.buffer['state_keys'] = model.state_keys
         config.buffer['use_dataset'] = config.buffer.get('use_dataset', False)
+        if config.strategy.train_loop.get('fused_epochs', False) \
+                or config.agent.get('overlap_collection', False):
+            # the fused loop reads the whole batch from the buffer, 
+            # and the overlapped collection swaps buffers every iteration
+            config.buffer['use_dataset'] = False
         create_buffer = pkg.import_module(
             'elements.buffer', config=config.agent).create_buffer
         buffer = create_buffer(config.buffer)
@@ -221,7 +300,12 @@ def main(config, train=train):
     agent = build_agent()
     save_config(root_dir, model_name, config)
 
-    train(agent, env, eval_env, buffer)
+    if config.agent.get('overlap_collection', False):
+        collect_buffer = pkg.import_module(
+            'elements.buffer', config=config.agent).create_buffer(config.buffer)
+        train(agent, env, eval_env, buffer, collect_buffer)
+    else:
+        train(agent, env, eval_env, buffer)
 
     if use_ray:
         env.close()
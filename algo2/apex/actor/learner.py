@@ -8,6 +8,7 @@ from utility.utils import config_attr
 from utility.ray_setup import config_actor
 from utility import pkg
 from replay.func import create_replay
+from replay.sharded import ShardedReplay
 from env.func import create_env
 from algo.apex.actor.actor import get_actor_base_class
 
@@ -101,10 +102,20 @@ def get_learner_class(AgentBase):
             if not getattr(self, 'use_central_buffer', True):
                 assert replay is None, f'Replay({replay}) is not None for non-central buffer'
                 self.replay = replay = create_replay(replay_config)
+            # a sharded replay handles remote calls itself
+            use_ray = getattr(self, '_use_central_buffer', True) \
+                and not isinstance(replay, ShardedReplay)
+            # sample requests kept in flight and batches per request
+            kwargs = dict(
+                n_inflight=config.get('n_inflight', 2),
+                n_batches_per_call=config.get('n_batches_per_call', 1),
+                priority_update_period=config.get('priority_update_period', 1),
+            ) if use_ray else {}
             dataset = create_dataset(
                 replay, env, 
                 data_format=data_format, 
-                use_ray=getattr(self, '_use_central_buffer', True))
+                use_ray=use_ray, 
+                **kwargs)
             
             return dataset
 
@@ -115,13 +115,14 @@ def get_worker_class(AgentBase):
             em = pkg.import_module(self.env.name.split("_")[0], pkg='env')
             info_func = em.info_func if hasattr(em, 'info_func') else None
             self._run_mode = getattr(self, '_run_mode', RunMode.NSTEPS)
-            assert self._run_mode in [RunMode.NSTEPS, RunMode.TRAJ]
+            assert self._run_mode in [RunMode.NSTEPS, RunMode.TRAJ, RunMode.ASYNC]
             self.runner = Runner(
                 self.env, self, 
-                nsteps=self.SYNC_PERIOD if self._run_mode == RunMode.NSTEPS else None,
+                nsteps=self.SYNC_PERIOD if self._run_mode != RunMode.TRAJ else None,
                 run_mode=self._run_mode,
                 record_envs=getattr(self, '_record_envs', None),
-                info_func=info_func)
+                info_func=info_func,
+                min_ready=getattr(self, '_min_ready', None))
 
             # worker side prioritization
             self._worker_side_prioritization = getattr(
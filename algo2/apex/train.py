@@ -5,7 +5,7 @@ import ray
 
 from utility.ray_setup import sigint_shutdown_ray
 from utility import pkg
-from replay.func import create_replay_center
+from replay.func import create_replay_center, get_worker_replay
 
 
 default_agent_config = {    
@@ -64,8 +64,9 @@ def main(env_config, model_config, agent_config, replay_config):
             model_config=model_config, 
             env_config=env_config, 
             buffer_config=replay_config)
+        # with a sharded replay, each worker writes to its own shard
         worker.prefill_replay.remote(
-            learner if replay is None else replay)
+            learner if replay is None else get_worker_replay(replay, wid))
         workers.append(worker)
 
     if agent_config.get('has_evaluator', True):
@@ -79,7 +80,8 @@ def main(env_config, model_config, agent_config, replay_config):
         evaluator.run.remote(learner, monitor)
 
     learner.start_learning.remote()
-    [w.run.remote(learner, replay, monitor) for w in workers]
+    [w.run.remote(learner, get_worker_replay(replay, wid), monitor) 
+        for wid, w in enumerate(workers)]
     
     elapsed_time = 0
     interval = 10
@@ -26,6 +26,7 @@ def get_data_format(*, env, replay_config, **kwargs):
     )
     if is_per:
         data_format['idxes'] = ((None, ), tf.int32)
+        data_format['generation'] = ((None, ), tf.int64)
         if replay_config.get('use_is_ratio', is_per):
             data_format['IS_ratio'] = ((None, ), tf.float32)
     if n_steps > 1:
@@ -132,6 +133,7 @@ class DQNBase(TargetNetOps, ActionScheduler, AgentBase):
 
             if self._is_per:
                 idxes = data.pop('idxes').numpy()
+                generations = data.pop('generation').numpy()
 
             with self._learn_timer:
                 terms = self.train(**data)
@@ -144,7 +146,8 @@ class DQNBase(TargetNetOps, ActionScheduler, AgentBase):
 
             terms = {f'train/{k}': v.numpy() for k, v in terms.items()}
             if self._is_per:
-                self.dataset.update_priorities(terms['train/priority'], idxes)
+                self.dataset.update_priorities(
+                    terms['train/priority'], idxes, generations)
 
             self.store(**terms)
 
@@ -22,6 +22,7 @@ def get_data_format(*, env, replay_config, agent_config,
     )
     if is_per:
         data_format['idxes'] = ((None), tf.int32)
+        data_format['generation'] = ((None), tf.int64)
         if replay_config.get('use_is_ratio'):
             data_format['IS_ratio'] = ((None, ), tf.float32)
     if store_state:
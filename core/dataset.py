@@ -45,8 +45,8 @@ class Dataset:
     def sample(self):
         return next(self._iterator)
 
-    def update_priorities(self, priorities, indices):
-        self._buffer.update_priorities(priorities, indices)
+    def update_priorities(self, priorities, indices, generations=None):
+        self._buffer.update_priorities(priorities, indices, generations)
 
     def _prepare_dataset(self, process_fn, batch_size, **kwargs):
         with tf.name_scope('data'):
@@ -91,7 +91,7 @@ def process_with_env(data, env_stats, obs_range=None,
 
 
 def create_dataset(buffer, env_stats, data_format=None, 
-        use_ray=False, one_hot_action=False):
+        use_ray=False, one_hot_action=False, **kwargs):
     process = functools.partial(process_with_env, 
         env_stats=env_stats, one_hot_action=one_hot_action)
     if use_ray:
@@ -99,5 +99,5 @@ def create_dataset(buffer, env_stats, data_format=None,
         DatasetClass = RayDataset
     else:
         DatasetClass = Dataset
-    dataset = DatasetClass(buffer, data_format, process)
+    dataset = DatasetClass(buffer, data_format, process, **kwargs)
     return dataset
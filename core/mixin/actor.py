@@ -6,6 +6,7 @@ import numpy as np
 from typing import Tuple, Union
 
 from core.log import do_logging
+from utility.returns import discounted_sum, linear_scan
 from utility.rms import RunningMeanStd
 
 logger = logging.getLogger(__name__)
@@ -136,11 +137,8 @@ class RMS:
         def forward_discounted_sum(next_ret, reward, discount, gamma):
             assert reward.shape == discount.shape, (reward.shape, discount.shape)
             # we assume the sequential dimension is at the first axis
-            nstep = reward.shape[0]
-            ret = np.zeros_like(reward)
-            for t in reversed(range(nstep)):
-                ret[t] = next_ret = reward[t] + gamma * discount[t] * next_ret
-            return next_ret, ret
+            ret = discounted_sum(reward, discount, gamma, next_ret, axis=0)
+            return ret[0], ret
 
         def backward_discounted_sum(prev_ret, reward, discount, gamma):
             """ Compute the discounted sum of rewards in the reverse order """
@@ -152,11 +150,12 @@ class RMS:
                 return prev_ret, ret
             else:
                 # we assume the sequential dimension is at the second axis
-                nstep = reward.shape[1]
-                ret = np.zeros_like(reward)
-                for t in range(nstep):
-                    ret[:, t] = prev_ret = reward[:, t] + gamma * prev_ret
-                    prev_ret *= discount[:, t]
+                # ret[:, t] = reward[:, t] + gamma * discount[:, t-1] * ret[:, t-1]
+                coef = np.concatenate([np.ones_like(discount[:, :1]), 
+                    discount[:, :-1]], axis=1)
+                ret = linear_scan(reward, gamma * coef, prev_ret, 
+                    axis=1, reverse=False)
+                prev_ret = ret[:, -1] * discount[:, -1]
                 return prev_ret, ret
 
         if self._normalize_reward:
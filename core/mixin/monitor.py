@@ -1,6 +1,7 @@
 import os, atexit
 import logging
 from collections import defaultdict
+from threading import Lock
 import numpy as np
 import tensorflow as tf
 
@@ -57,6 +58,9 @@ class Recorder:
         self._headers = []
         self._current_row = {}
         self._store_dict = defaultdict(list)
+        # serializes access to the store, which may be written by 
+        # a collecting thread while the learner gets stats from it
+        self._locker = Lock()
 
     def __contains__(self, item):
         return item in self._store_dict and self._store_dict[item] != []
@@ -65,68 +69,73 @@ class Recorder:
         return item in self._store_dict and self._store_dict[item] != []
         
     def store(self, **kwargs):
-        for k, v in kwargs.items():
-            if isinstance(v, tf.Tensor):
-                v = v.numpy()
-            if v is None:
-                return
-            elif isinstance(v, (list, tuple)):
-                self._store_dict[k] += list(v)
-            else:
-                self._store_dict[k].append(v)
+        with self._locker:
+            for k, v in kwargs.items():
+                if isinstance(v, tf.Tensor):
+                    v = v.numpy()
+                if v is None:
+                    return
+                elif isinstance(v, (list, tuple)):
+                    self._store_dict[k] += list(v)
+                else:
+                    self._store_dict[k].append(v)
 
     """ All get functions below will remove the corresponding items from the store """
     def get_raw_item(self, key):
-        if key in self._store_dict:
-            v = self._store_dict[key]
-            del self._store_dict[key]
-            return {key: v}
-        return None
+        with self._locker:
+            if key in self._store_dict:
+                v = self._store_dict[key]
+                del self._store_dict[key]
+                return {key: v}
+            return None
         
     def get_item(self, key, mean=True, std=False, min=False, max=False):
-        stats = {}
-        if key not in self._store_dict:
+        with self._locker:
+            stats = {}
+            if key not in self._store_dict:
+                return stats
+            v = self._store_dict[key]
+            if isscalar(v):
+                stats[key] = v
+                return
+            if mean:
+                stats[f'{key}'] = np.mean(v).astype(np.float32)
+            if std:
+                stats[f'{key}_std'] = np.std(v).astype(np.float32)
+            if min:
+                stats[f'{key}_min'] = np.min(v).astype(np.float32)
+            if max:
+                stats[f'{key}_max'] = np.max(v).astype(np.float32)
+            del self._store_dict[key]
             return stats
-        v = self._store_dict[key]
-        if isscalar(v):
-            stats[key] = v
-            return
-        if mean:
-            stats[f'{key}'] = np.mean(v).astype(np.float32)
-        if std:
-            stats[f'{key}_std'] = np.std(v).astype(np.float32)
-        if min:
-            stats[f'{key}_min'] = np.min(v).astype(np.float32)
-        if max:
-            stats[f'{key}_max'] = np.max(v).astype(np.float32)
-        del self._store_dict[key]
-        return stats
 
     def get_raw_stats(self):
-        stats = self._store_dict.copy()
-        self._store_dict.clear()
-        return stats
+        with self._locker:
+            stats = self._store_dict.copy()
+            self._store_dict.clear()
+            return stats
 
     def get_stats(self, mean=True, std=False, min=False, max=False):
-        stats = {}
-        for k in sorted(self._store_dict):
-            v = self._store_dict[k]
-            k_std, k_min, k_max = std, min, max
-            if k.startswith('train/') or k.startswith('stats/'):
-                k_std = k_min = k_max = True
-            if isscalar(v):
-                stats[k] = v
-                continue
-            if mean:
-                stats[f'{k}'] = np.mean(v).astype(np.float32)
-            if k_std:
-                stats[f'{k}_std'] = np.std(v).astype(np.float32)
-            if k_min:
-                stats[f'{k}_min'] = np.min(v).astype(np.float32)
-            if k_max:
-                stats[f'{k}_max'] = np.max(v).astype(np.float32)
-        self._store_dict.clear()
-        return stats
+        with self._locker:
+            stats = {}
+            for k in sorted(self._store_dict):
+                v = self._store_dict[k]
+                k_std, k_min, k_max = std, min, max
+                if k.startswith('train/') or k.startswith('stats/'):
+                    k_std = k_min = k_max = True
+                if isscalar(v):
+                    stats[k] = v
+                    continue
+                if mean:
+                    stats[f'{k}'] = np.mean(v).astype(np.float32)
+                if k_std:
+                    stats[f'{k}_std'] = np.std(v).astype(np.float32)
+                if k_min:
+                    stats[f'{k}_min'] = np.min(v).astype(np.float32)
+                if k_max:
+                    stats[f'{k}_max'] = np.max(v).astype(np.float32)
+            self._store_dict.clear()
+            return stats
 
     def get_count(self, name):
         return len(self._store_dict[name])
@@ -207,7 +216,8 @@ class Recorder:
             self._out_file.write("\t".join(map(str,vals))+"\n")
             self._out_file.flush()
         self._current_row.clear()
-        self._store_dict.clear()
+        with self._locker:
+            self._store_dict.clear()
         self._first_row=False
 
 
@@ -69,6 +69,11 @@ class Optimizer(tf.Module):
     @property
     def variables(self):
         return self._opt.variables()
+
+    @property
+    def iterations(self):
+        """ The number of updates applied so far """
+        return self._opt.iterations
     
     def get_transformed_grads(self, var_list=[]):
         assert hasattr(self._opt, 'get_transformed_grads'), f'{self._opt} does not support "get_transformed_grads"'
@@ -1,9 +1,11 @@
+import collections
 import logging
 import time
 import ray
 
 from core.dataset import *
 from core.log import do_logging
+from replay.ds.priority_queue import PriorityUpdateQueue
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +17,24 @@ class  RayDataset(Dataset):
                  process_fn=None, 
                  batch_size=False, 
                  print_data_format=True, 
+                 n_inflight=2,
+                 n_batches_per_call=1,
+                 priority_update_period=1,
                  **kwargs):
+        """
+        Args:
+            n_inflight: the number of sample requests kept in flight
+            n_batches_per_call: the number of batches each request retrieves
+            priority_update_period: the number of priority updates 
+                coalesced into one remote call
+        """
+        # set before super().__init__, which starts the data pipeline
+        self._sleep_time = 0.025
+        self._n_inflight = n_inflight
+        self._n_batches_per_call = n_batches_per_call
+        self._priority_update_period = priority_update_period
+        self._priority_queue = PriorityUpdateQueue()
+        self._n_priority_updates = 0
         super().__init__(
             buffer, 
             data_format, 
@@ -23,7 +42,6 @@ class  RayDataset(Dataset):
             batch_size=batch_size, 
             print_data_format=print_data_format, 
             **kwargs)
-        self._sleep_time = 0.025
     
     def name(self):
         return ray.get(self._buffer.name.remote())
@@ -32,15 +50,31 @@ class  RayDataset(Dataset):
         return ray.get(self._buffer.good_to_learn.remote())
 
     def _sample(self):
+        def request():
+            if self._n_batches_per_call > 1:
+                return self._buffer.sample_many.remote(self._n_batches_per_call)
+            else:
+                return self._buffer.sample.remote()
+        # keeps several requests in flight to hide the round-trip latency
+        refs = collections.deque([request() for _ in range(self._n_inflight)])
         while True:
-            data = ray.get(self._buffer.sample.remote())
+            data = ray.get(refs.popleft())
+            refs.append(request())
             if data is None:
                 time.sleep(self._sleep_time)
+            elif isinstance(data, list):
+                for d in data:
+                    yield d
             else:
                 yield data
 
-    def update_priorities(self, priorities, indices):
-        self._buffer.update_priorities.remote(priorities, indices)
+    def update_priorities(self, priorities, indices, generations=None):
+        self._priority_queue.put(priorities, indices, generations)
+        self._n_priority_updates += 1
+        if self._n_priority_updates % self._priority_update_period == 0:
+            priorities, indices, generations = self._priority_queue.flush()
+            self._buffer.update_priorities.remote(
+                priorities, indices, generations)
 
 
 def get_dataformat(replay):
@@ -1,36 +1,65 @@
 import os
-import importlib
+import re
+import importlib.util
 
 from utility.file import retrieve_pyfiles
 
 
-def retrieve_all_make_env():
-    env_dict = {}
+# suite -> (module name, function name), built on the first call to make_env
+_make_env_index = None
+# suite -> make function, filled as suites are requested
+_make_env_fns = {}
+
+
+def index_all_make_env():
+    """ Maps suites to their make functions by scanning the sources,
+    so that no environment module is imported here """
+    index = {}
     root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-    
+
     for i in range(1, 10):
         pkg = 'env' if i == 1 else f'env{i}'
         if importlib.util.find_spec(pkg) is not None:
             env_dir = os.path.join(root_dir, pkg)
             files = retrieve_pyfiles(env_dir)
-            filenames = [f.rsplit('/', maxsplit=1)[-1][:-3] for f in files]
-            for f in filenames:
-                m = importlib.import_module(f'{pkg}.{f}')
-                for attr in dir(m):
-                    if attr.startswith('make'):
-                        env_dict[attr.split('_', maxsplit=1)[1]] = getattr(m, attr)
-    
-    return env_dict
+            for f in files:
+                module = f.rsplit('/', maxsplit=1)[-1][:-3]
+                with open(f) as fp:
+                    src = fp.read()
+                for fn_name in re.findall(r'^def (make_\w+)\(', src, re.MULTILINE):
+                    index[fn_name.split('_', maxsplit=1)[1]] = (f'{pkg}.{module}', fn_name)
+
+    return index
+
+
+def get_make_env(suite):
+    """ Returns the make function of suite, importing only its module """
+    global _make_env_index
+    if suite not in _make_env_fns:
+        if _make_env_index is None:
+            _make_env_index = index_all_make_env()
+        if suite not in _make_env_index:
+            return None
+        module, fn_name = _make_env_index[suite]
+        _make_env_fns[suite] = getattr(importlib.import_module(module), fn_name)
+
+    return _make_env_fns[suite]
+
+
+def retrieve_all_make_env():
+    global _make_env_index
+    if _make_env_index is None:
+        _make_env_index = index_all_make_env()
+
+    return {suite: get_make_env(suite) for suite in _make_env_index}
 
 
 def make_env(config):
     config = config.copy()
     env_name = config['name'].lower()
 
-    env_dict = retrieve_all_make_env()
     suite = env_name.split('_', 1)[0]
-    builtin_env = env_dict.pop('builtin_gym')
-    env_func = env_dict.get(suite, builtin_env)
+    env_func = get_make_env(suite) or get_make_env('builtin_gym')
     env = env_func(config)
-    
+
     return env
@@ -1,3 +1,4 @@
+import logging
 import numpy as np
 import os
 os.environ.setdefault('PATH', '')
@@ -6,16 +7,33 @@ import gym
 from gym.spaces.box import Box
 import cv2
 
+from core.log import do_logging
+from utility.utils import batch_dicts
+from env.cls import EnvVecBase
+from env.typing import EnvOutput
 from env.utils import process_single_agent_env
 
 cv2.ocl.setUseOpenCL(False)
+logger = logging.getLogger(__name__)
 
+# the maximum number of channels cv2.resize processes in a single pass
+CV_MAX_CHANNELS = 512
+# the number of stacks of frames used in turn by in-place frame stacking. 
+# Three keep the previous observation intact through a step that also 
+# auto-resets, which writes two stacks: the terminal and the reset ones
+N_FRAME_STACKS = 3
 
 
 def make_atari(config):
     assert 'atari' in config['name'], config['name']
-    env = Atari(**config)
     config.setdefault('max_episode_steps', 108000)    # 30min
+    if config.get('batched', False):
+        # simulates all n_envs environments in one EnvVec
+        return AtariEnvVec(config)
+    env = Atari(**config)
+    if env.inplace_stack:
+        # frames are stacked by Atari
+        config['frame_stack'] = 1
     env = process_single_agent_env(env, config)
     
     return env
@@ -27,7 +45,17 @@ class Atari:
     def __init__(self, name, *, frame_skip=4, life_done=False,
                 image_size=(84, 84), noop=30, 
                 sticky_actions=True, gray_scale=True, 
-                np_obs=False, **kwargs):
+                np_obs=False, frame_stack=1, inplace_stack=False, 
+                **kwargs):
+        """
+        Args:
+            inplace_stack: if True, pooling, resizing and frame stacking
+                write into a rolling preallocated buffer, and observations
+                are views of it of shape [H, W, frame_stack]. An observation 
+                is valid until the third step/reset after it is returned, 
+                so it outlives a step followed by a reset.
+                Only gray-scale images are supported.
+        """
         version = 0 if sticky_actions else 4
         name = name.split('_', 1)[-1]
         name = name[0].capitalize() + name[1:]
@@ -63,6 +91,16 @@ class Atari:
             shape += (3,)
         self._buffer = [np.empty(shape, dtype=np.uint8) for _ in range(2)]
 
+        self.inplace_stack = inplace_stack
+        self.frame_stack = frame_stack if inplace_stack else 1
+        if inplace_stack:
+            assert gray_scale, 'In-place frame stacking requires gray-scale images'
+            # stacks of frames used in turn, so that previous 
+            # observations remain intact while writing the current one
+            self._frames = np.zeros(
+                (N_FRAME_STACKS, self.frame_stack, *self.image_size), dtype=np.uint8)
+            self._frame_idx = 0
+
         self.lives = 0  # Will need to be set by reset().
         self._game_over = True
         self._frames_in_step = 0    # count the frames elapsed in a single step
@@ -71,7 +109,7 @@ class Atari:
     def observation_space(self):
         # Return the observation space adjusted to match the shape of the processed
         # observations.
-        c = 1 if self.gray_scale else 3
+        c = self.frame_stack if self.gray_scale else 3
         shape = self.image_size + (c, )
         return Box(low=0, high=255, shape=shape,
                 dtype=np.uint8)
@@ -104,6 +142,11 @@ class Atari:
         self._game_over = True
 
     def reset(self, hard_reset=True, **kwargs):
+        self._reset(**kwargs)
+        return self._pool_and_resize(reset=True)
+
+    def _reset(self, **kwargs):
+        """ Resets the game and grabs the first screen to self._buffer """
         self.env.reset(**kwargs)
         if 'FIRE' in self.env.get_action_meanings():
             action = self.env.get_action_meanings().index('FIRE')
@@ -118,19 +161,16 @@ class Atari:
         self.lives = self.env.ale.lives()
         self._get_screen(self._buffer[0])
         self._buffer[1].fill(0)
-        obs = self._pool_and_resize()
 
         self._game_over = False
-        return obs
 
     def _fake_reset(self):
         if 'FIRE' in self.env.get_action_meanings():
             action = self.env.get_action_meanings().index('FIRE')
         else:
             action = 0
-        obs = self.step(action)[0]
-        
-        return obs
+        # screens are pooled and resized by the caller
+        self._step(action)
 
     def render(self, mode):
         """Renders the current screen, before preprocessing.
@@ -150,6 +190,15 @@ class Atari:
         return self.env.render(mode)
 
     def step(self, action):
+        total_reward, is_terminal, info = self._step(action)
+        # Pool the last two observations.
+        obs = self._pool_and_resize()
+
+        return obs, total_reward, is_terminal, info
+
+    def _step(self, action):
+        """ Repeats action for frame_skip frames, 
+        grabbing the last two screens to self._buffer """
         total_reward = 0.
 
         for step in range(1, self.frame_skip+1):
@@ -173,14 +222,11 @@ class Atari:
                 i = step - (self.frame_skip - 1)
                 self._get_screen(self._buffer[i])
 
-        # Pool the last two observations.
-        obs = self._pool_and_resize()
-
         self._game_over = done
         info['frame_skip'] = step
-        return obs, total_reward, is_terminal, info
+        return total_reward, is_terminal, info
 
-    def _pool_and_resize(self):
+    def _pool_and_resize(self, reset=False):
         """Transforms two frames into a Nature DQN observation.
 
         For efficiency, the transformation is done in-place in self._buffer.
@@ -193,6 +239,19 @@ class Atari:
             np.maximum(self._buffer[0], self._buffer[1],
                     out=self._buffer[0])
 
+        if self.inplace_stack:
+            prev_frames = self._frames[self._frame_idx]
+            self._frame_idx = (self._frame_idx + 1) % N_FRAME_STACKS
+            frames = self._frames[self._frame_idx]
+            # cv2 receive size of form (width, height)
+            cv2.resize(self._buffer[0], self.image_size[::-1], 
+                dst=frames[-1], interpolation=cv2.INTER_AREA)
+            if reset:
+                frames[:-1] = frames[-1]
+            else:
+                frames[:-1] = prev_frames[1:]
+            return np.moveaxis(frames, 0, -1)
+
         img = cv2.resize(
             self._buffer[0], self.image_size, interpolation=cv2.INTER_AREA)
         img = np.asarray(img, dtype=np.uint8)
@@ -207,3 +266,234 @@ class Atari:
     @property
     def is_multiagent(self):
         return False
+
+
+class AtariEnvVec(EnvVecBase):
+    """ Runs n_envs Atari games in a single EnvVec
+
+    Screens of all games are grabbed to a preallocated buffer, then pooled,
+    resized by a single cv2.resize pass and stacked into a rolling buffer
+    of shape [n_envs, H, W, frame_stack] at once. Observations are views of 
+    this buffer, which are valid until the third step/reset after they 
+    are returned, where an auto-reset in step counts as one. Therefore, 
+    the observation returned by the previous step outlives the next step. 
+    Outputs follow EnvStats stacked over environments: games
+    are reset when they are over, unless reset is explicitly called. 
+    Only gray-scale images are supported.
+    """
+    manual_reset_warning = True
+    def __init__(self, config):
+        config = config.copy()
+        config.pop('batched', None)
+        assert not config.get('frame_diff', False), \
+            'FrameDiff is not supported by AtariEnvVec'
+        self.name = config['name']
+        self.n_envs = config.pop('n_envs', 1)
+        self.frame_stack = config.get('frame_stack', 1)
+        # a single environment provides spaces and stats
+        stats_config = config.copy()
+        stats_config['inplace_stack'] = True
+        self.env = make_atari(stats_config)
+        self.max_episode_steps = self.env.max_episode_steps
+        self.timeout_done = self.env.timeout_done
+        self.float_dtype = self.env.float_dtype
+        self.auto_reset = True
+        self.reward_scale = config.get('reward_scale', 1)
+        self.reward_min = config.get('reward_min')
+        self.reward_max = config.get('reward_max')
+
+        config['frame_stack'] = 1
+        config['inplace_stack'] = False
+        self.envs = [Atari(**config) for _ in range(self.n_envs)]
+        if 'seed' in config:
+            [env.seed(config['seed'] + i) for i, env in enumerate(self.envs)]
+        atari = self.envs[0]
+        assert atari.gray_scale, 'AtariEnvVec requires gray-scale images'
+        self.frame_skip = atari.frame_skip
+        self.image_size = atari.image_size
+
+        # games write their screens to self._screens, 
+        # whose last two axes are contiguous
+        self._screens = np.empty(
+            (2, self.n_envs, *atari._buffer[0].shape), dtype=np.uint8)
+        for i, env in enumerate(self.envs):
+            env._buffer = [self._screens[0, i], self._screens[1, i]]
+        # screens are resized in chunks of at most CV_MAX_CHANNELS channels
+        self._chunks = [(s, min(s + CV_MAX_CHANNELS, self.n_envs)) 
+            for s in range(0, self.n_envs, CV_MAX_CHANNELS)]
+        self._pooled = [np.empty((*atari._buffer[0].shape, e - s), dtype=np.uint8)
+            for s, e in self._chunks]
+        self._resized = [np.empty((*self.image_size, e - s), dtype=np.uint8)
+            for s, e in self._chunks]
+        # stacks of frames used in turn, so that previous 
+        # observations remain intact while writing the current one
+        self._frames = np.zeros(
+            (N_FRAME_STACKS, self.n_envs, *self.image_size, self.frame_stack), 
+            dtype=np.uint8)
+        self._frame_idx = 0
+
+        self._score = np.zeros(self.n_envs)
+        self._epslen = np.zeros(self.n_envs, np.int32)
+        self._game_over = np.ones(self.n_envs, bool)
+        self._mask = np.ones(self.n_envs, bool)
+        self._info = [{} for _ in range(self.n_envs)]
+        self._prev_obs = None
+        self._output = None
+        self._reset(np.arange(self.n_envs))
+
+        super().__init__()
+
+    def random_action(self, *args, **kwargs):
+        return np.random.randint(
+            0, self.env.action_dim, self.n_envs, dtype=np.int32)
+
+    def reset(self, idxes=None):
+        if self.auto_reset:
+            self.auto_reset = False
+            if AtariEnvVec.manual_reset_warning:
+                do_logging('Explicitly resetting turns off auto-reset. Maker sure this is done intentionally at evaluation', logger=logger)
+                AtariEnvVec.manual_reset_warning = False
+        idxes = np.asarray(self._get_idxes(idxes))
+        # repetitively calling reset results in no environment interaction
+        to_reset = idxes[self._output.reset[idxes] == 0]
+        if len(to_reset):
+            self._reset(to_reset)
+
+        return self.output(idxes)
+
+    def step(self, actions, **kwargs):
+        actions = np.reshape(actions, self.n_envs)
+        # games stepped after the game is over are frozen
+        alive = ~self._game_over
+        reward = np.zeros(self.n_envs, self.float_dtype)
+        discount = np.zeros(self.n_envs, self.float_dtype)
+        reset = np.zeros(self.n_envs, self.float_dtype)
+        for i in np.nonzero(alive)[0]:
+            r, done, info = self.envs[i]._step(actions[i])
+            info['reward'] = r
+            self._score[i] += r
+            self._epslen[i] += info['frame_skip']
+            game_over = bool(info.get('game_over', done))
+            if self._epslen[i] >= self.max_episode_steps:
+                game_over = True
+                done = self.timeout_done
+                info['timeout'] = True
+            reward[i] = r
+            discount[i] = 1 - done
+            reset[i] = info.get('reset', False)
+            if game_over:
+                info['game_over'] = game_over
+                info['score'] = self._score[i]
+                info['epslen'] = self._epslen[i]
+            self._game_over[i] = game_over
+            self._info[i] = info
+        reward = reward * self.reward_scale
+        if self.reward_min is not None or self.reward_max is not None:
+            reward = np.clip(reward, self.reward_min, self.reward_max)
+        obs = self._pool_and_resize(updated=alive)
+        self._mask = alive
+        self._prev_obs = obs
+        self._output = EnvOutput(dict(obs=obs), reward, discount, reset)
+
+        if self.auto_reset and np.any(self._game_over):
+            # when resetting, we override the obs and reset but keep the others
+            self._reset(np.nonzero(self._game_over)[0])
+
+        return self._output
+
+    def score(self, idxes=None):
+        idxes = self._get_idxes(idxes)
+        return np.array([self._info[i].get('score', self._score[i]) for i in idxes])
+
+    def epslen(self, idxes=None):
+        idxes = self._get_idxes(idxes)
+        return np.array([self._info[i].get('epslen', self._epslen[i]) for i in idxes])
+
+    def mask(self, idxes=None):
+        idxes = self._get_idxes(idxes)
+        return self._mask[idxes]
+
+    def game_over(self):
+        return self._game_over.copy()
+
+    def prev_obs(self, idxes=None):
+        idxes = self._get_idxes(idxes)
+        return dict(obs=self._prev_obs[idxes])
+
+    def info(self, idxes=None, convert_batch=False):
+        idxes = self._get_idxes(idxes)
+        info = [self._info[i] for i in idxes]
+        if convert_batch:
+            info = batch_dicts(info)
+        return info
+
+    def output(self, idxes=None):
+        if idxes is None:
+            return self._output
+        idxes = self._get_idxes(idxes)
+        return EnvOutput({k: v[idxes] for k, v in self._output.obs.items()},
+            self._output.reward[idxes], self._output.discount[idxes],
+            self._output.reset[idxes])
+
+    def get_screen(self, size=None):
+        imgs = np.stack([env.get_screen() for env in self.envs])
+        if size is not None:
+            # cv2 receive size of form (width, height)
+            imgs = np.stack([cv2.resize(i, size[::-1], interpolation=cv2.INTER_AREA) 
+                            for i in imgs])
+        return imgs
+
+    def close(self):
+        self.env.close()
+        [env.close() for env in self.envs]
+
+    """ Implementation """
+    def _pool_and_resize(self, updated=None, reset=None):
+        """ Pools, resizes and stacks screens of all games at once, 
+        writing to the next stack of frames. Games not updated keep 
+        their frames, and those reset repeat the new frame """
+        if self.frame_skip > 1:
+            np.maximum(self._screens[0], self._screens[1], out=self._screens[0])
+        prev_frames = self._frames[self._frame_idx]
+        self._frame_idx = (self._frame_idx + 1) % N_FRAME_STACKS
+        frames = self._frames[self._frame_idx]
+        frames[..., :-1] = prev_frames[..., 1:]
+        for (s, e), pooled, resized in zip(self._chunks, self._pooled, self._resized):
+            np.copyto(pooled, self._screens[0, s:e].transpose(1, 2, 0))
+            # cv2 takes single-channel images as 2D arrays, 
+            # and receive size of form (width, height)
+            if e - s == 1:
+                cv2.resize(pooled[..., 0], self.image_size[::-1], 
+                    dst=resized[..., 0], interpolation=cv2.INTER_AREA)
+            else:
+                cv2.resize(pooled, self.image_size[::-1], 
+                    dst=resized, interpolation=cv2.INTER_AREA)
+            frames[s:e, ..., -1] = resized.transpose(2, 0, 1)
+        if reset is not None:
+            frames[reset] = frames[reset, ..., -1:]
+        if updated is not None:
+            frames[~updated] = prev_frames[~updated]
+        return frames
+
+    def _reset(self, idxes):
+        for i in idxes:
+            self.envs[i]._reset()
+        self._score[idxes] = 0
+        self._epslen[idxes] = 0
+        self._game_over[idxes] = False
+        updated = np.zeros(self.n_envs, bool)
+        updated[idxes] = True
+        obs = self._pool_and_resize(updated=updated, reset=idxes)
+        if self._output is None:
+            reward = np.zeros(self.n_envs, self.float_dtype)
+            discount = np.ones(self.n_envs, self.float_dtype)
+            reset = np.ones(self.n_envs, self.float_dtype)
+        else:
+            # copy the previous output, which may have been returned by step
+            reward, discount, reset = [x.copy() for x in self._output[1:]]
+            reset[idxes] = 1
+            if not self.auto_reset:
+                # an explicit reset starts a new episode from scratch
+                reward[idxes] = 0
+                discount[idxes] = 1
+        self._output = EnvOutput(dict(obs=obs), reward, discount, reset)
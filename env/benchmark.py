@@ -0,0 +1,204 @@
+""" Measures reset and step throughput of environments
+
+For each environment, backend (Env, EnvVec, ProcEnvVec, RayEnvVec) and
+n_workers/n_envs in the grid, environments are stepped with random actions,
+recording steps per second and the latency of each call to step. Results
+are printed and saved as a list of dicts in a json file.
+
+Example:
+    python -m env.benchmark -s atari mpe -ne 1 8 -nw 1 4 -o env_bench.json
+"""
+import argparse
+import itertools
+import json
+import time
+import numpy as np
+
+from utility.display import pwc
+from env import make_env, index_all_make_env
+from env.cls import Env, EnvVec
+
+
+# a representative environment of each suite
+SUITE_ENVS = dict(
+    atari='atari_breakout',
+    builtin_gym='CartPole-v1',
+    dmc='dmc_walker_walk',
+    mpe='mpe_simple_spread',
+    procgen='procgen_coinrun',
+    smac='smac_3s5z',
+    smac2='smac2_3s5z',
+    smac4='smac4_3s5z',
+)
+BACKENDS = ['Env', 'EnvVec', 'ProcEnvVec', 'RayEnvVec']
+
+
+def create_bench_env(config, backend, env_fn=make_env):
+    """ Creates an environment of the given backend """
+    config = config.copy()
+    if backend == 'Env':
+        return Env(config, env_fn)
+    elif backend == 'EnvVec':
+        return EnvVec(config, env_fn)
+    elif backend == 'ProcEnvVec':
+        from env.proc_env import ProcEnvVec
+        return ProcEnvVec(config, env_fn)
+    elif backend == 'RayEnvVec':
+        from env.ray_env import RayEnvVec
+        EnvType = EnvVec if config.get('n_envs', 1) > 1 else Env
+        return RayEnvVec(EnvType, config, env_fn)
+    else:
+        raise ValueError(f'Unknown backend: {backend}')
+
+
+def is_valid(backend, n_workers, n_envs):
+    """ Returns if backend runs with n_workers and n_envs """
+    if backend == 'Env':
+        return n_workers == 1 and n_envs == 1
+    elif backend == 'EnvVec':
+        return n_workers == 1
+    else:
+        return n_workers > 1
+
+
+def benchmark_env(config, backend, n_steps=1000, n_resets=10,
+        warmup_steps=10, env_fn=make_env):
+    """ Benchmarks an environment of the given backend
+
+    Steps are measured first with auto-reset. Each reset measured afterwards
+    follows an untimed step, so that every reset interacts with
+    the environments.
+
+    Returns:
+        A dict of results, where latencies are in milliseconds
+    """
+    env = create_bench_env(config, backend, env_fn)
+    try:
+        n_envs = env.n_envs
+        for _ in range(warmup_steps):
+            env.step(env.random_action())
+
+        step_times = np.zeros(n_steps)
+        for i in range(n_steps):
+            action = env.random_action()
+            start = time.perf_counter()
+            env.step(action)
+            step_times[i] = time.perf_counter() - start
+
+        reset_times = np.zeros(n_resets)
+        for i in range(n_resets):
+            env.step(env.random_action())
+            start = time.perf_counter()
+            env.reset()
+            reset_times[i] = time.perf_counter() - start
+    finally:
+        env.close()
+
+    step_ms = step_times * 1000
+    return dict(
+        name=config['name'],
+        backend=backend,
+        n_workers=config.get('n_workers', 1),
+        n_envs=config.get('n_envs', 1),
+        total_envs=n_envs,
+        n_steps=n_steps,
+        steps_per_sec=n_steps * n_envs / step_times.sum(),
+        step_mean_ms=step_ms.mean(),
+        step_p50_ms=np.percentile(step_ms, 50),
+        step_p99_ms=np.percentile(step_ms, 99),
+        resets_per_sec=n_resets * n_envs / reset_times.sum() if n_resets else None,
+        reset_p50_ms=np.percentile(reset_times * 1000, 50) if n_resets else None,
+    )
+
+
+def benchmark(names, backends=BACKENDS, n_workers=(1,), n_envs=(1,),
+        n_steps=1000, n_resets=10, config={}):
+    """ Benchmarks environments over the grid of backends,
+    n_workers and n_envs. Failures are recorded along with the results """
+    results = []
+    for name, backend, nw, ne in itertools.product(
+            names, backends, n_workers, n_envs):
+        if not is_valid(backend, nw, ne):
+            continue
+        env_config = dict(config, name=name, n_workers=nw, n_envs=ne)
+        try:
+            result = benchmark_env(env_config, backend,
+                n_steps=n_steps, n_resets=n_resets)
+            pwc(f'{name} {backend} n_workers={nw} n_envs={ne}: '
+                f'{result["steps_per_sec"]:.1f} steps/s, '
+                f'step p50={result["step_p50_ms"]:.3g}ms '
+                f'p99={result["step_p99_ms"]:.3g}ms', color='cyan')
+        except Exception as e:
+            result = dict(name=name, backend=backend,
+                n_workers=nw, n_envs=ne, error=repr(e))
+            pwc(f'{name} {backend} n_workers={nw} n_envs={ne} failed: {e!r}')
+        results.append(result)
+
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--environment', '-e',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='environments to benchmark')
+    parser.add_argument('--suite', '-s',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='suites whose representative environments are '
+                            'benchmarked, all registered suites if neither '
+                            'environments nor suites are given')
+    parser.add_argument('--backend', '-b',
+                        type=str,
+                        nargs='*',
+                        default=BACKENDS,
+                        choices=BACKENDS)
+    parser.add_argument('--n_workers', '-nw', type=int, nargs='*', default=[1])
+    parser.add_argument('--n_envs', '-ne', type=int, nargs='*', default=[1])
+    parser.add_argument('--n_steps', '-n', type=int, default=1000)
+    parser.add_argument('--n_resets', '-r', type=int, default=10)
+    parser.add_argument('--kwargs', '-kw',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='extra env config of form key=value')
+    parser.add_argument('--output', '-o', type=str, default='env_bench.json')
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    names = list(args.environment)
+    suites = args.suite
+    if not names and not suites:
+        suites = [s for s in index_all_make_env() if s in SUITE_ENVS]
+    names += [SUITE_ENVS[s] for s in suites]
+
+    config = {}
+    for kw in args.kwargs:
+        k, v = kw.split('=', 1)
+        try:
+            v = eval(v)
+        except Exception:
+            pass
+        config[k] = v
+
+    use_ray = 'RayEnvVec' in args.backend and max(args.n_workers) > 1
+    if use_ray:
+        import ray
+        ray.init()
+
+    results = benchmark(names, args.backend, args.n_workers, args.n_envs,
+        n_steps=args.n_steps, n_resets=args.n_resets, config=config)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, default=float)
+    pwc(f'Results are saved to {args.output}', color='blue')
+
+    if use_ray:
+        ray.shutdown()
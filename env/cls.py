@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import itertools
 import numpy as np
 import cv2
@@ -94,6 +95,14 @@ class EnvVecBase(gym.Wrapper):
 
 
 class EnvVec(EnvVecBase):
+    """ Steps n_envs environments in the current process
+
+    EnvVec keeps the batched output of all environments: step replaces it
+    by the stacked outputs, while partial steps, resets and step_wait write
+    the outputs of the given environments into it in place. Episode 
+    statistics are queried from the given environments only when asked 
+    for, and score/epslen are returned as arrays.
+    """
     def __init__(self, config, env_fn=make_env):
         self.n_envs = n_envs = config.pop('n_envs', 1)
         self.name = config['name']
@@ -104,6 +113,13 @@ class EnvVec(EnvVecBase):
                 for i, env in enumerate(self.envs)
                 if hasattr(env, 'seed')]
         self.max_episode_steps = self.env.max_episode_steps
+        # threads stepping environments asynchronously, created on demand
+        self._pool = None
+        self._futures = {}
+        # batched output of all environments
+        self._output = None
+        self._write_output(list(range(self.n_envs)), 
+            [env.output() for env in self.envs])
         super().__init__()
 
     def random_action(self, *args, **kwargs):
@@ -111,28 +127,77 @@ class EnvVec(EnvVecBase):
             else env.action_space.sample() for env in self.envs])
 
     def reset(self, idxes=None, **kwargs):
+        """ Resets the environments given by idxes, writing their outputs
+        into the batched output in place
+
+        Returns:
+            EnvOutput of these environments
+        """
         idxes = self._get_idxes(idxes)
-        out = zip(*[self.envs[i].reset() for i in idxes])
+        self._write_output(idxes, [self.envs[i].reset() for i in idxes])
+
+        return self.output(idxes)
+
+    def step(self, actions, idxes=None, **kwargs):
+        """ Steps all environments, or only those given by idxes if
+        provided, where actions and kwargs are aligned with idxes. 
+        Outputs of a partial step are written into the batched output 
+        in place, which is returned as a whole """
+        assert not self._futures, 'Call step_wait before stepping synchronously'
+        if idxes is None:
+            self._output = self._envvec_op('step', action=actions, **kwargs)
+        else:
+            idxes = self._get_idxes(idxes)
+            self._write_output(idxes, 
+                self._envvec_op('step', idxes, action=actions, **kwargs))
 
-        return EnvOutput(*[self._convert_batch(o) for o in out])
+        return self._output
 
-    def step(self, actions, **kwargs):
-        return self._envvec_op('step', action=actions, **kwargs)
+    def step_async(self, actions, idxes=None, **kwargs):
+        """ Starts stepping the environments given by idxes in a thread pool,
+        where actions and kwargs are aligned with idxes """
+        idxes = self._get_idxes(idxes)
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.n_envs)
+        for j, i in enumerate(idxes):
+            assert i not in self._futures, f'Environment {i} is being stepped'
+            kw = {k: np.squeeze(v[j]) for k, v in kwargs.items()}
+            self._futures[i] = self._pool.submit(
+                self.envs[i].step, np.squeeze(actions[j]), **kw)
+
+    def step_wait(self, min_ready=None):
+        """ Waits until at least min_ready environments stepped by step_async 
+        are done, all pending environments by default
+
+        Returns:
+            idxes: the environments that are done
+            env_output: EnvOutput of these environments
+        """
+        pending = set(self._futures.values())
+        min_ready = len(pending) if min_ready is None else min(min_ready, len(pending))
+        n_ready = 0
+        while n_ready < min_ready:
+            _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            n_ready = len(self._futures) - len(pending)
+        idxes = [i for i, f in self._futures.items() if f not in pending]
+        self._write_output(idxes, [self._futures.pop(i).result() for i in idxes])
+
+        return idxes, self.output(idxes)
 
     def score(self, idxes=None):
         idxes = self._get_idxes(idxes)
-        return [self.envs[i].score() for i in idxes]
+        return np.array([self.envs[i].score() for i in idxes])
 
     def epslen(self, idxes=None):
         idxes = self._get_idxes(idxes)
-        return [self.envs[i].epslen() for i in idxes]
+        return np.array([self.envs[i].epslen() for i in idxes], np.int64)
 
     def mask(self, idxes=None):
         idxes = self._get_idxes(idxes)
         return np.stack([self.envs[i].mask() for i in idxes])
 
     def game_over(self):
-        return np.stack([env.game_over() for env in self.envs])
+        return np.array([env.game_over() for env in self.envs], bool)
 
     def prev_obs(self, idxes=None):
         idxes = self._get_idxes(idxes)
@@ -149,10 +214,11 @@ class EnvVec(EnvVecBase):
         return info
 
     def output(self, idxes=None):
-        idxes = self._get_idxes(idxes)
-        out = zip(*[self.envs[i].output() for i in idxes])
-
-        return EnvOutput(*[self._convert_batch(o) for o in out])
+        """ Returns the batched output if idxes is None, 
+        or a copy of the outputs of the environments given by idxes """
+        if idxes is None:
+            return self._output
+        return self._output[self._get_idxes(idxes)]
 
     def get_screen(self, size=None):
         if hasattr(self.env, 'get_screen'):
@@ -167,20 +233,37 @@ class EnvVec(EnvVecBase):
         
         return imgs
 
-    def _envvec_op(self, name, **kwargs):
+    def _envvec_op(self, name, idxes=None, **kwargs):
+        """ Calls method name of all environments, and returns the
+        stacked outputs. If idxes is given, calls those environments 
+        only and returns their outputs in a list """
         method = lambda e: getattr(e, name)
+        envs = self.envs if idxes is None else [self.envs[i] for i in idxes]
         if kwargs:
-            kwargs = {k: [np.squeeze(x) for x in np.split(v, self.n_envs)] 
+            kwargs = {k: [np.squeeze(x) for x in np.split(v, len(envs))] 
                 for k, v in kwargs.items()}
             kwargs = [dict(x) for x in zip(*[itertools.product([k], v) 
                 for k, v in kwargs.items()])]
-            out = zip(*[method(env)(**kw) for env, kw in zip(self.envs, kwargs)])
+            out = [method(env)(**kw) for env, kw in zip(envs, kwargs)]
         else:
-            out = zip(*[method(env)() for env in self.envs])
-
-        return EnvOutput(*[self._convert_batch(o) for o in out])
+            out = [method(env)() for env in envs]
+        if idxes is not None:
+            return out
+
+        return EnvOutput(*[self._convert_batch(o) for o in zip(*out)])
+
+    def _write_output(self, idxes, outs):
+        """ Writes outputs of the environments given by idxes
+        into the batched output in place """
+        out = EnvOutput(*[self._convert_batch(o) for o in zip(*outs)])
+        if self._output is None:
+            self._output = out
+        else:
+            self._output[idxes] = out
 
     def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
         if hasattr(self.env, 'close'):
             [env.close() for env in self.envs]
 
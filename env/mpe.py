@@ -4,6 +4,10 @@ from env import wrappers
 
 def make_mpe(config):
     assert 'mpe' in config['name'], config['name']
+    if config.get('batched', False):
+        # simulates all n_envs environments in one EnvVec
+        from env.mpe_env.batched_env import MPEEnvVec
+        return MPEEnvVec(config)
     env = MPEEnv(config)
     env = wrappers.DataProcess(env)
     env = wrappers.MASimEnvStats(env)
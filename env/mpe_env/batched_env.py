@@ -0,0 +1,217 @@
+import logging
+import numpy as np
+
+from core.log import do_logging
+from utility.utils import batch_dicts
+from env.cls import EnvVecBase
+from env.typing import EnvOutput
+from env.wrappers import DataProcess, MASimEnvStats
+from env.mpe_env.core import BatchedWorld
+from env.mpe_env.MPE_env import MPEEnv
+from env.mpe_env.scenarios import load
+
+logger = logging.getLogger(__name__)
+
+
+class MPEEnvVec(EnvVecBase):
+    """ Simulates n_envs copies of an MPE scenario in lockstep
+
+    All worlds are kept in a BatchedWorld, and observations and rewards
+    are computed for all worlds at once by the scenario, which should
+    define reset_worlds, batch_observation and batch_reward. Outputs
+    follow MASimEnvStats stacked over environments: worlds are reset
+    when their episodes are over, unless reset is explicitly called.
+    Only discrete actions of movable, silent agents are supported.
+    """
+    manual_reset_warning = True
+    def __init__(self, config):
+        config = config.copy()
+        config.pop('batched', None)
+        self.name = config['name']
+        self.n_envs = config.pop('n_envs', 1)
+        # a single environment provides spaces and stats
+        self.env = MASimEnvStats(DataProcess(MPEEnv(config)))
+        if 'seed' in config:
+            self.env.seed(config['seed'])
+        self.max_episode_steps = self.env.max_episode_steps
+        self.float_dtype = self.env.float_dtype
+
+        name = config['name'].split('_', 1)[1]
+        self.scenario = load(name + '.py').Scenario()
+        for fn in ['reset_worlds', 'batch_observation', 'batch_reward']:
+            assert hasattr(self.scenario, fn), \
+                f'Scenario {name} does not support batched simulation: {fn} is not defined'
+        world = self.scenario.make_world(config)
+        assert self.env.is_action_discrete, 'Only discrete actions are supported'
+        assert len(world.policy_agents) == len(world.agents), world.agents
+        assert all(a.movable and a.silent for a in world.agents), \
+            'Only movable and silent agents are supported'
+        self.world = BatchedWorld(world, self.n_envs)
+        self.n_agents = len(world.agents)
+        self.shared_reward = getattr(world, 'collaborative', False)
+        self.use_global_state = self.env.use_global_state
+        self.timeout_done = self.env.timeout_done
+        self.auto_reset = True
+
+        # maps discrete actions to physical actions scaled by sensitivities
+        u = np.zeros((2 * world.dim_p + 1, world.dim_p))
+        u[1::2] = -np.eye(world.dim_p)
+        u[2::2] = np.eye(world.dim_p)
+        sensitivity = np.array([5. if a.accel is None else a.accel
+            for a in world.agents])
+        self._u = u[None] * sensitivity[:, None, None]
+
+        self._score = np.zeros(self.n_envs)
+        self._epslen = np.zeros(self.n_envs, np.int32)
+        self._game_over = np.ones(self.n_envs, bool)
+        # statistics of the last step, kept after auto-reset
+        self._last_score = np.zeros(self.n_envs)
+        self._last_epslen = np.zeros(self.n_envs, np.int32)
+        self._individual_reward = np.zeros((self.n_envs, self.n_agents))
+        self._last_game_over = np.zeros(self.n_envs, bool)
+        self._timeout = np.zeros(self.n_envs, bool)
+        self._mask = np.ones((self.n_envs, self.n_agents), bool)
+        self._prev_obs = None
+        self._output = None
+        self._reset(np.arange(self.n_envs))
+
+        super().__init__()
+
+    def random_action(self, *args, **kwargs):
+        return np.random.randint(
+            0, self.env.action_dim, (self.n_envs, self.n_agents), dtype=np.int32)
+
+    def reset(self, idxes=None):
+        if self.auto_reset:
+            self.auto_reset = False
+            if MPEEnvVec.manual_reset_warning:
+                do_logging('Explicitly resetting turns off auto-reset. Maker sure this is done intentionally at evaluation', logger=logger)
+                MPEEnvVec.manual_reset_warning = False
+        idxes = np.asarray(self._get_idxes(idxes))
+        # repetitively calling reset results in no environment interaction
+        to_reset = idxes[~np.any(self._output.reset[idxes], -1)]
+        if len(to_reset):
+            self._reset(to_reset)
+
+        return self.output(idxes)
+
+    def step(self, actions, **kwargs):
+        actions = np.reshape(actions, (self.n_envs, self.n_agents))
+        # worlds stepped after the game is over are frozen
+        alive = ~self._game_over
+        self.world.step(self._u[np.arange(self.n_agents), actions])
+        obs = self._observe()
+        individual_reward = self.scenario.batch_reward(self.world)
+        reward = np.sum(individual_reward, -1)
+        self._score = np.where(alive, self._score + reward, self._score)
+        self._epslen = np.where(alive, self._epslen + 1, self._epslen)
+        # if shared reward, all agents have the same reward, which is the sum
+        reward = np.broadcast_to(reward[:, None], individual_reward.shape) \
+            if self.shared_reward else individual_reward
+        done = self._epslen >= self.world.world_length
+        timeout = self._epslen >= self.max_episode_steps
+        if self.timeout_done:
+            done = done | timeout
+        game_over = done | timeout
+
+        alive_agents = np.broadcast_to(alive[:, None], reward.shape)
+        obs = {k: np.where(alive[:, None, None], v, self._output.obs[k])
+            for k, v in obs.items()}
+        reward = np.where(alive_agents, reward, 0).astype(self.float_dtype)
+        discount = np.where(alive_agents, 1 - done[:, None], 0).astype(self.float_dtype)
+        self._individual_reward = np.where(
+            alive_agents, individual_reward, self._individual_reward)
+        self._last_score = self._score.copy()
+        self._last_epslen = self._epslen.copy()
+        self._last_game_over = np.where(alive, game_over, self._last_game_over)
+        self._timeout = np.where(alive, timeout, self._timeout)
+        self._mask = alive_agents.copy()
+        self._prev_obs = obs
+        self._game_over = self._game_over | game_over
+        reset = np.zeros((self.n_envs, self.n_agents), self.float_dtype)
+        self._output = EnvOutput(obs, reward, discount, reset)
+
+        if self.auto_reset and np.any(self._game_over):
+            # when resetting, we override the obs and reset but keep the others
+            self._reset(np.nonzero(self._game_over)[0])
+
+        return self._output
+
+    def score(self, idxes=None):
+        idxes = self._get_idxes(idxes)
+        return self._last_score[idxes]
+
+    def epslen(self, idxes=None):
+        idxes = self._get_idxes(idxes)
+        return self._last_epslen[idxes]
+
+    def mask(self, idxes=None):
+        idxes = self._get_idxes(idxes)
+        return self._mask[idxes]
+
+    def game_over(self):
+        return self._game_over.copy()
+
+    def prev_obs(self, idxes=None):
+        idxes = self._get_idxes(idxes)
+        return {k: v[idxes] for k, v in self._prev_obs.items()}
+
+    def info(self, idxes=None, convert_batch=False):
+        idxes = self._get_idxes(idxes)
+        info = [dict(
+            individual_reward=self._individual_reward[i],
+            score=self._last_score[i],
+            epslen=self._last_epslen[i],
+            game_over=self._last_game_over[i],
+            timeout=self._timeout[i],
+        ) for i in idxes]
+        if convert_batch:
+            info = batch_dicts(info)
+        return info
+
+    def output(self, idxes=None):
+        if idxes is None:
+            return self._output
+        idxes = self._get_idxes(idxes)
+        return EnvOutput({k: v[idxes] for k, v in self._output.obs.items()},
+            self._output.reward[idxes], self._output.discount[idxes],
+            self._output.reset[idxes])
+
+    def close(self):
+        self.env.close()
+
+    """ Implementation """
+    def _observe(self):
+        obs = self.scenario.batch_observation(self.world).astype(self.float_dtype)
+        if self.use_global_state:
+            global_state = obs.reshape(self.n_envs, 1, -1)
+            global_state = np.repeat(global_state, self.n_agents, 1)
+        else:
+            global_state = obs
+        return dict(obs=obs, global_state=global_state)
+
+    def _reset(self, idxes):
+        self.scenario.reset_worlds(self.world, idxes)
+        self.world.world_step[idxes] = 0
+        self.world.calculate_distances()
+        self._score[idxes] = 0
+        self._epslen[idxes] = 0
+        self._game_over[idxes] = False
+        obs = self._observe()
+        if self._output is None:
+            reward = np.zeros((self.n_envs, self.n_agents), self.float_dtype)
+            discount = np.ones((self.n_envs, self.n_agents), self.float_dtype)
+            reset = np.ones((self.n_envs, self.n_agents), self.float_dtype)
+            self._output = EnvOutput(obs, reward, discount, reset)
+        else:
+            # copy the previous output, which may have been returned by step
+            out = EnvOutput(*[{k: v.copy() for k, v in x.items()} 
+                if isinstance(x, dict) else x.copy() for x in self._output])
+            for k, v in obs.items():
+                out.obs[k][idxes] = v[idxes]
+            out.reset[idxes] = 1
+            if not self.auto_reset:
+                # an explicit reset starts a new episode from scratch
+                out.reward[idxes] = 0
+                out.discount[idxes] = 1
+            self._output = out
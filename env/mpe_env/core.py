@@ -155,27 +155,15 @@ class World(object):
         return [agent for agent in self.agents if agent.action_callback is not None]
 
     def calculate_distances(self):
+        entities = self.entities
         if self.cached_dist_vect is None:
-            # initialize distance data structure
-            self.cached_dist_vect = np.zeros((len(self.entities),
-                                              len(self.entities),
-                                              self.dim_p))
-            # calculate minimum distance for a collision between all entities （size相加�?
-            self.min_dists = np.zeros((len(self.entities), len(self.entities)))
-            for ia, entity_a in enumerate(self.entities):
-                for ib in range(ia + 1, len(self.entities)):
-                    entity_b = self.entities[ib]
-                    min_dist = entity_a.size + entity_b.size
-                    self.min_dists[ia, ib] = min_dist
-                    self.min_dists[ib, ia] = min_dist
-
-        for ia, entity_a in enumerate(self.entities):
-            for ib in range(ia + 1, len(self.entities)):
-                entity_b = self.entities[ib]
-                delta_pos = entity_a.state.p_pos - entity_b.state.p_pos
-                self.cached_dist_vect[ia, ib, :] = delta_pos
-                self.cached_dist_vect[ib, ia, :] = -delta_pos
+            # calculate minimum distance for a collision between all entities
+            size = np.array([e.size for e in entities], dtype=np.float64)
+            self.min_dists = size[:, None] + size[None, :]
+            np.fill_diagonal(self.min_dists, 0)
 
+        pos = np.stack([e.state.p_pos for e in entities])
+        self.cached_dist_vect = pos[:, None] - pos[None, :]
         self.cached_dist_mag = np.linalg.norm(self.cached_dist_vect, axis=2)
 
         self.cached_collisions = (self.cached_dist_mag <= self.min_dists)
@@ -211,7 +199,7 @@ class World(object):
         for agent in self.scripted_agents:
             agent.action = agent.action_callback(agent, self)
         # gather forces applied to entities
-        p_force = [None] * len(self.entities)
+        p_force = np.zeros((len(self.entities), self.dim_p))
         # apply agent physical controls
         p_force = self.apply_action_force(p_force)
         # apply environment forces
@@ -239,43 +227,52 @@ class World(object):
 
     # gather physical forces acting on entities
     def apply_environment_force(self, p_force):
-        # simple (but inefficient) collision response
-        for a, entity_a in enumerate(self.entities):
-            for b, entity_b in enumerate(self.entities):
-                if(b <= a):
-                    continue
-                [f_a, f_b] = self.get_entity_collision_force(a, b)
-                if(f_a is not None):
-                    if(p_force[a] is None):
-                        p_force[a] = 0.0
-                    p_force[a] = f_a + p_force[a]
-                if(f_b is not None):
-                    if(p_force[b] is None):
-                        p_force[b] = 0.0
-                    p_force[b] = f_b + p_force[b]
-            if entity_a.movable:
-                for wall in self.walls:
-                    wf = self.get_wall_collision_force(entity_a, wall)
-                    if wf is not None:
-                        if p_force[a] is None:
-                            p_force[a] = 0.0
-                        p_force[a] = p_force[a] + wf
+        entities = self.entities
+        props = self.get_entity_properties(entities)
+        if self.cache_dists and self.cached_dist_vect is not None:
+            delta_pos = self.cached_dist_vect
+        else:
+            pos = np.stack([e.state.p_pos for e in entities])
+            delta_pos = pos[:, None] - pos[None, :]
+        p_force = p_force + compute_collision_forces(
+            delta_pos, props['mass'], props['size'], props['movable'], 
+            props['collide'], self.contact_force, self.contact_margin)
+        if self.walls:
+            for a, entity_a in enumerate(entities):
+                if entity_a.movable:
+                    for wall in self.walls:
+                        wf = self.get_wall_collision_force(entity_a, wall)
+                        if wf is not None:
+                            p_force[a] = p_force[a] + wf
         return p_force
 
     def integrate_state(self, p_force):
-        for i, entity in enumerate(self.entities):
-            if not entity.movable:
-                continue
-            entity.state.p_vel = entity.state.p_vel * (1 - self.damping)
-            if (p_force[i] is not None):
-                entity.state.p_vel += (p_force[i] / entity.mass) * self.dt
-            if entity.max_speed is not None:
-                speed = np.sqrt(
-                    np.square(entity.state.p_vel[0]) + np.square(entity.state.p_vel[1]))
-                if speed > entity.max_speed:
-                    entity.state.p_vel = entity.state.p_vel / np.sqrt(np.square(entity.state.p_vel[0]) +
-                                                                      np.square(entity.state.p_vel[1])) * entity.max_speed
-            entity.state.p_pos += entity.state.p_vel * self.dt
+        entities = self.entities
+        props = self.get_entity_properties(entities)
+        movable = [e for e in entities if e.movable]
+        if not movable:
+            return
+        idxes = np.nonzero(props['movable'])[0]
+        pos = np.stack([e.state.p_pos for e in movable])
+        vel = np.stack([e.state.p_vel for e in movable])
+        pos, vel = integrate_physics(pos, vel, p_force[idxes], 
+            props['mass'][idxes], props['max_speed'][idxes], 
+            self.dt, self.damping)
+        for i, entity in enumerate(movable):
+            entity.state.p_vel = vel[i]
+            entity.state.p_pos[...] = pos[i]
+
+    def get_entity_properties(self, entities=None):
+        """ Returns physical properties of entities as arrays of shape [n_entities] """
+        entities = entities or self.entities
+        return dict(
+            mass=np.array([e.mass for e in entities], dtype=np.float64),
+            size=np.array([e.size for e in entities], dtype=np.float64),
+            movable=np.array([e.movable for e in entities], dtype=bool),
+            collide=np.array([e.collide for e in entities], dtype=bool),
+            max_speed=np.array([np.inf if e.max_speed is None else e.max_speed 
+                for e in entities], dtype=np.float64),
+        )
 
     def update_agent_state(self, agent):
         # set communication state (directly for now)
@@ -359,3 +356,137 @@ class World(object):
         force[perp_dim] = np.cos(theta) * force_mag
         force[prll_dim] = np.sin(theta) * np.abs(force_mag)
         return force
+
+
+# n_envs copies of a world stepped in lockstep
+class BatchedWorld(object):
+    """ Holds states of n_envs copies of world as entity arrays
+    
+    p_pos and p_vel are of shape [n_envs, n_entities, dim_p], where 
+    entities are ordered as world.entities; c is of shape [n_envs, n_agents, dim_c].
+    Physical properties are taken from world and shared by all copies. 
+    Walls and scripted agents are not supported
+    """
+    def __init__(self, world, n_envs):
+        assert not world.walls, 'BatchedWorld does not support walls'
+        assert not world.scripted_agents, 'BatchedWorld does not support scripted agents'
+        self.n_envs = n_envs
+        self.n_agents = len(world.agents)
+        self.n_entities = len(world.entities)
+        self.dim_c = world.dim_c
+        self.dim_p = world.dim_p
+        self.dt = world.dt
+        self.damping = world.damping
+        self.contact_force = world.contact_force
+        self.contact_margin = world.contact_margin
+        self.world_length = world.world_length
+
+        props = world.get_entity_properties()
+        self.mass = props['mass']
+        self.size = props['size']
+        self.movable = props['movable']
+        self.collide = props['collide']
+        self.max_speed = props['max_speed']
+        agents = world.agents
+        # force = mass * a * action + n
+        self.u_scale = np.array([a.mass * a.accel if a.accel is not None else a.mass 
+            for a in agents], dtype=np.float64)
+        self.u_noise = np.array([a.u_noise or 0. for a in agents], dtype=np.float64)
+        self.c_noise = np.array([a.c_noise or 0. for a in agents], dtype=np.float64)
+        self.silent = np.array([a.silent for a in agents], dtype=bool)
+
+        self.p_pos = np.zeros((n_envs, self.n_entities, self.dim_p))
+        self.p_vel = np.zeros((n_envs, self.n_entities, self.dim_p))
+        self.c = np.zeros((n_envs, self.n_agents, self.dim_c))
+        self.world_step = np.zeros(n_envs, np.int32)
+        self.calculate_distances()
+
+    def step(self, u, c=None):
+        """ Steps all worlds
+        
+        Args:
+            u: [n_envs, n_agents, dim_p], physical actions of agents
+            c: [n_envs, n_agents, dim_c], communication actions of agents
+        """
+        self.world_step += 1
+        # positions may have been written since the last step
+        self.calculate_distances()
+        p_force = np.zeros_like(self.p_pos)
+        agent_movable = self.movable[:self.n_agents, None]
+        noise = np.random.randn(*u.shape) * self.u_noise[:, None] \
+            if np.any(self.u_noise) else 0.
+        p_force[:, :self.n_agents] = np.where(
+            agent_movable, self.u_scale[:, None] * u + noise, 0.)
+        p_force += compute_collision_forces(
+            self.dist_vect, self.mass, self.size, self.movable, 
+            self.collide, self.contact_force, self.contact_margin)
+        pos, vel = integrate_physics(self.p_pos, self.p_vel, p_force, 
+            self.mass, self.max_speed, self.dt, self.damping)
+        movable = self.movable[:, None]
+        self.p_pos = np.where(movable, pos, self.p_pos)
+        self.p_vel = np.where(movable, vel, self.p_vel)
+        if c is None or not self.dim_c:
+            self.c = np.zeros_like(self.c)
+        else:
+            noise = np.random.randn(*c.shape) * self.c_noise[:, None] \
+                if np.any(self.c_noise) else 0.
+            self.c = np.where(self.silent[:, None], 0., c + noise)
+        self.calculate_distances()
+
+    def calculate_distances(self):
+        """ Computes dist_vect [n_envs, n_entities, n_entities, dim_p] and 
+        dist_mag [n_envs, n_entities, n_entities], both between all entities """
+        self.dist_vect = self.p_pos[:, :, None] - self.p_pos[:, None, :]
+        self.dist_mag = np.linalg.norm(self.dist_vect, axis=-1)
+
+
+def compute_collision_forces(delta_pos, mass, size, movable, collide, 
+        contact_force=1e+2, contact_margin=1e-3):
+    """ Computes collision forces between all pairs of entities at once
+    
+    Args:
+        delta_pos: [..., n_entities, n_entities, dim_p], where 
+            delta_pos[..., i, j] is the position of entity i relative to j
+        mass, size, movable, collide: [..., n_entities]
+    Returns:
+        force: [..., n_entities, dim_p], the total collision force on 
+            each entity, which is zero for unmovable entities
+    """
+    n = delta_pos.shape[-2]
+    movable_i, movable_j = movable[..., :, None], movable[..., None, :]
+    # a pair collides if both entities are colliders and either one moves
+    valid = collide[..., :, None] & collide[..., None, :] \
+        & (movable_i | movable_j) & ~np.eye(n, dtype=bool)
+    dist = np.linalg.norm(delta_pos, axis=-1)
+    # minimum allowable distance
+    dist_min = size[..., :, None] + size[..., None, :]
+    # softmax penetration
+    k = contact_margin
+    penetration = np.logaddexp(0, -(dist - dist_min)/k)*k
+    # consider mass in collisions if both entities move
+    force_ratio = np.where(movable_j, mass[..., None, :] / mass[..., :, None], 1.)
+    scale = np.where(valid & movable_i, 
+        contact_force * penetration * force_ratio / np.where(valid, dist, 1.), 0.)
+    force = np.sum(scale[..., None] * delta_pos, axis=-2)
+
+    return force
+
+
+def integrate_physics(pos, vel, force, mass, max_speed, dt=.1, damping=.25):
+    """ Integrates states of movable entities for one step
+    
+    Args:
+        pos, vel, force: [..., n_entities, dim_p]
+        mass, max_speed: [..., n_entities], where max_speed is np.inf 
+            for entities without a speed limit
+    Returns:
+        pos, vel: [..., n_entities, dim_p], the new positions and velocities
+    """
+    vel = vel * (1 - damping) + (force / mass[..., None]) * dt
+    speed = np.linalg.norm(vel, axis=-1, keepdims=True)
+    max_speed = max_speed[..., None]
+    over = speed > max_speed
+    vel = vel * np.where(over, max_speed / np.where(over, speed, 1.), 1.)
+    pos = pos + vel * dt
+
+    return pos, vel
@@ -101,3 +101,40 @@ class Scenario(BaseScenario):
             comm.append(other.state.c)
             other_pos.append(other.state.p_pos - agent.state.p_pos)
         return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + comm)
+
+    """ Batched counterparts of the above, operating on a BatchedWorld """
+    def reset_worlds(self, world, idxes):
+        n = len(idxes)
+        world.p_pos[idxes, :world.n_agents] = np.random.uniform(
+            -1, +1, (n, world.n_agents, world.dim_p))
+        world.p_pos[idxes, world.n_agents:] = 0.8 * np.random.uniform(
+            -1, +1, (n, world.n_entities - world.n_agents, world.dim_p))
+        world.p_vel[idxes] = 0
+        world.c[idxes] = 0
+
+    def batch_reward(self, world):
+        """ Returns rewards of shape [n_envs, n_agents] """
+        n = world.n_agents
+        dists = world.dist_mag[:, :n, n:]
+        rew = -np.sum(np.min(dists, axis=1), axis=-1, keepdims=True)
+        # an agent always collides with itself, as in is_collision
+        dist_min = world.size[:n, None] + world.size[None, :n]
+        collisions = np.sum(world.dist_mag[:, :n, :n] < dist_min, axis=1)
+        rew = rew - np.where(world.collide[:n], collisions, 0)
+        return rew
+
+    def batch_observation(self, world):
+        """ Returns observations of shape [n_envs, n_agents, obs_dim] """
+        n = world.n_agents
+        pos = world.p_pos[:, :n]
+        # landmark_pos[:, i, j] is the position of landmark j relative to agent i
+        landmark_pos = world.p_pos[:, None, n:] - pos[:, :, None]
+        # others[i] lists the other agents of agent i in order
+        others = np.array([[j for j in range(n) if j != i] for i in range(n)], dtype=np.int64)
+        other_pos = pos[:, others] - pos[:, :, None]
+        comm = world.c[:, others]
+        return np.concatenate([
+            world.p_vel[:, :n], pos, 
+            landmark_pos.reshape(*pos.shape[:2], -1), 
+            other_pos.reshape(*pos.shape[:2], -1), 
+            comm.reshape(*pos.shape[:2], -1)], axis=-1)
@@ -0,0 +1,297 @@
+import atexit
+import logging
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing import connection
+import traceback
+import numpy as np
+
+from core.log import do_logging
+from env.cls import *
+from env.stats_cache import CachedEnv, get_env_cache
+
+logger = logging.getLogger(__name__)
+
+
+class ProcEnvVec(EnvVecBase):
+    """ Steps environments in n_workers subprocesses
+
+    Each worker runs an EnvVec of n_envs environments, or the EnvVec 
+    returned by env_fn if config sets batched, and writes its
+    outputs to shared-memory arrays of shape [n_workers * n_envs, ...],
+    so only actions and commands are sent through pipes. Observations,
+    rewards, discounts and resets returned by step/reset/output are
+    copies of these arrays by default. If copy_output is False, they
+    are views overwritten by the next call to step/reset, so callers
+    must not keep them across steps, as Runner does.
+    """
+    def __init__(self, config, env_fn=make_env):
+        config = config.copy()
+        self.name = config['name']
+        self.n_workers = config.pop('n_workers', 1)
+        self.envsperworker = config.pop('n_envs', 1)
+        self.n_envs = self.envsperworker * self.n_workers
+        self._copy_output = config.pop('copy_output', True)
+        start_method = config.pop('start_method', 'spawn')
+
+        # the cache of a single environment provides attributes and
+        # the layout of the shared-memory arrays
+        self.env = CachedEnv(get_env_cache(config, env_fn))
+        self.max_episode_steps = self.env.max_episode_steps
+        example = self.env.output()
+        self._shms = {}
+        specs = _map_output(self._create_shm, example)
+        self._output = _map_output(self._get_array, specs)
+
+        ctx = mp.get_context(start_method)
+        self._conns = []
+        self._processes = []
+        for i in range(self.n_workers):
+            worker_config = config.copy()
+            worker_config['n_envs'] = self.envsperworker
+            if 'seed' in config:
+                worker_config['seed'] = config['seed'] + i * self.envsperworker
+            start = i * self.envsperworker
+            parent_conn, child_conn = ctx.Pipe()
+            p = ctx.Process(target=_worker,
+                args=(child_conn, worker_config, env_fn, specs, start),
+                daemon=True)
+            p.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._processes.append(p)
+        self._pending = set()       # workers being stepped asynchronously
+        self._closed = False
+        do_logging(f'{self.n_workers} subprocesses are launched, '
+            f'each with {self.envsperworker} environments', logger=logger)
+
+        super().__init__()
+
+        atexit.register(self.close)
+
+    def random_action(self, *args, **kwargs):
+        return np.concatenate(self._call_all('random_action'))
+
+    def reset(self, idxes=None):
+        idxes = self._get_idxes(idxes)
+        worker_idxes = self._split_idxes(idxes)
+        for i, j in worker_idxes.items():
+            self._conns[i].send(('reset', j))
+        self._recv(worker_idxes)
+
+        return self._get_output(idxes)
+
+    def step(self, actions, **kwargs):
+        assert not self._pending, 'Call step_wait before stepping synchronously'
+        actions = np.split(actions, self.n_workers)
+        kwargs = {k: np.split(v, self.n_workers) for k, v in kwargs.items()}
+        for i, conn in enumerate(self._conns):
+            conn.send(('step', (actions[i], {k: v[i] for k, v in kwargs.items()})))
+        self._recv(range(self.n_workers))
+
+        return self._get_output()
+
+    def step_async(self, actions, idxes=None, **kwargs):
+        """ Starts stepping the environments given by idxes, where actions
+        and kwargs are aligned with idxes. As a worker steps all its 
+        environments at once, idxes should cover all environments of a worker """
+        idxes = self._get_idxes(idxes)
+        actions = np.asarray(actions)
+        positions = {i: j for j, i in enumerate(idxes)}
+        for wid in sorted({i // self.envsperworker for i in idxes}):
+            assert wid not in self._pending, f'Worker {wid} is being stepped'
+            env_ids = range(wid * self.envsperworker, (wid+1) * self.envsperworker)
+            assert all(i in positions for i in env_ids), \
+                f'idxes({idxes}) do not cover all environments of worker {wid}'
+            local = [positions[i] for i in env_ids]
+            self._conns[wid].send(('step', 
+                (actions[local], {k: v[local] for k, v in kwargs.items()})))
+            self._pending.add(wid)
+
+    def step_wait(self, min_ready=None):
+        """ Waits until at least min_ready environments stepped by step_async 
+        are done, all pending environments by default
+
+        Returns:
+            idxes: the environments that are done
+            env_output: EnvOutput of these environments, copied from shared memory
+        """
+        n_workers = len(self._pending) if min_ready is None \
+            else min(-(-min_ready // self.envsperworker), len(self._pending))
+        conns = {self._conns[i]: i for i in self._pending}
+        ready = []
+        while len(ready) < n_workers:
+            ready += [conns.pop(c) for c in connection.wait(list(conns))]
+        self._recv(ready)
+        self._pending.difference_update(ready)
+        idxes = [wid * self.envsperworker + i 
+            for wid in sorted(ready) for i in range(self.envsperworker)]
+
+        return idxes, self._get_output(idxes)
+
+    def output(self, idxes=None):
+        return self._get_output(idxes)
+
+    def score(self, idxes=None):
+        return np.array(self._call('score', idxes))
+
+    def epslen(self, idxes=None):
+        return np.array(self._call('epslen', idxes))
+
+    def mask(self, idxes=None):
+        return np.stack(self._call('mask', idxes))
+
+    def game_over(self):
+        return np.concatenate(self._call_all('game_over'))
+
+    def prev_obs(self, idxes=None):
+        obs = self._call('prev_obs', idxes)
+        if isinstance(obs[0], dict):
+            obs = batch_dicts(obs)
+        return obs
+
+    def info(self, idxes=None, convert_batch=False):
+        info = self._call('info', idxes)
+        if convert_batch:
+            info = batch_dicts(info)
+        return info
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for conn in self._conns:
+            try:
+                conn.send(('close', None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for p in self._processes:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self._output = None
+        for shm in self._shms.values():
+            _close_shm(shm)
+            shm.unlink()
+
+    """ Implementation """
+    def _create_shm(self, x):
+        """ Creates shared memory for x from all environments, 
+        and returns its spec, (name, shape, dtype) """
+        x = np.asarray(x)
+        shape = (self.n_envs, *x.shape)
+        shm = shared_memory.SharedMemory(
+            create=True, size=max(int(np.prod(shape)) * x.dtype.itemsize, 1))
+        self._shms[shm.name] = shm
+        return shm.name, shape, x.dtype
+
+    def _get_array(self, spec):
+        name, shape, dtype = spec
+        return np.ndarray(shape, dtype, buffer=self._shms[name].buf)
+
+    def _get_output(self, idxes=None):
+        if idxes is None:
+            out = self._output
+            if self._copy_output:
+                out = _map_output(np.copy, out)
+        else:
+            idxes = np.asarray(self._get_idxes(idxes))
+            out = _map_output(lambda x: x[idxes], self._output)
+        return out
+
+    def _split_idxes(self, idxes):
+        """ Maps environment indices to {worker: local indices} """
+        worker_idxes = {}
+        for i in idxes:
+            worker_idxes.setdefault(i // self.envsperworker, []).append(
+                i % self.envsperworker)
+        return worker_idxes
+
+    def _recv(self, workers):
+        results = [self._conns[i].recv() for i in workers]
+        for ok, result in results:
+            if not ok:
+                raise RuntimeError(f'Error in an environment subprocess:\n{result}')
+        return [result for _, result in results]
+
+    def _call_all(self, name, *args, **kwargs):
+        for conn in self._conns:
+            conn.send(('call', (name, args, kwargs)))
+        return self._recv(range(self.n_workers))
+
+    def _call(self, name, idxes):
+        """ Calls a method taking idxes on workers, and chains the outputs """
+        if idxes is None:
+            out = self._call_all(name)
+        else:
+            worker_idxes = self._split_idxes(self._get_idxes(idxes))
+            for i, j in worker_idxes.items():
+                self._conns[i].send(('call', (name, (j,), {})))
+            out = self._recv(worker_idxes)
+        return list(itertools.chain(*out))
+
+
+def _map_output(func, out):
+    """ Applies func to each array in an EnvOutput, whose obs is a dict """
+    return EnvOutput({k: func(v) for k, v in out.obs.items()},
+        func(out.reward), func(out.discount), func(out.reset))
+
+
+def _attach(spec, shms):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    shms.append(shm)
+    return np.ndarray(shape, dtype, buffer=shm.buf)
+
+
+def _close_shm(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # arrays returned to users still refer to the memory, 
+        # which is released along with them
+        pass
+
+
+def _write(arrays, output, idxes):
+    for k, v in output.obs.items():
+        arrays.obs[k][idxes] = v
+    arrays.reward[idxes] = output.reward
+    arrays.discount[idxes] = output.discount
+    arrays.reset[idxes] = output.reset
+
+
+def _worker(conn, config, env_fn, specs, start):
+    shms = []
+    try:
+        arrays = _map_output(lambda spec: _attach(spec, shms), specs)
+        env = env_fn(config) if config.get('batched', False) \
+            else EnvVec(config, env_fn)
+        all_idxes = slice(start, start + env.n_envs)
+        while True:
+            cmd, data = conn.recv()
+            try:
+                if cmd == 'step':
+                    actions, kwargs = data
+                    _write(arrays, env.step(actions, **kwargs), all_idxes)
+                    conn.send((True, None))
+                elif cmd == 'reset':
+                    _write(arrays, env.reset(data), start + np.asarray(data))
+                    conn.send((True, None))
+                elif cmd == 'call':
+                    name, args, kwargs = data
+                    conn.send((True, getattr(env, name)(*args, **kwargs)))
+                elif cmd == 'close':
+                    env.close()
+                    break
+                else:
+                    raise ValueError(f'Unknown command: {cmd}')
+            except Exception:
+                conn.send((False, traceback.format_exc()))
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        arrays = None
+        for shm in shms:
+            _close_shm(shm)
+        conn.close()
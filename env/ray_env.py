@@ -3,6 +3,7 @@ import numpy as np
 import ray
 
 from env.cls import *
+from env.stats_cache import CachedEnv, get_env_cache
 
 
 class RayEnvVec(EnvVecBase):
@@ -20,10 +21,12 @@ class RayEnvVec(EnvVecBase):
             self.envs = [RayEnvType.remote(config, env_fn) 
                     for i in range(self.n_workers)]
 
-        self.env = EnvType(config, env_fn)
+        # attributes are read from the cache instead of a local environment
+        self.env = CachedEnv(get_env_cache(config, env_fn))
         self.max_episode_steps = self.env.max_episode_steps
-        self._combine_func = np.stack if isinstance(self.env, Env) else np.concatenate
-        self.env.close()
+        self._combine_func = np.stack if EnvType is Env else np.concatenate
+        # in-flight steps of workers, {object ref: worker id}
+        self._futures = {}
 
         super().__init__()
 
@@ -37,6 +40,7 @@ class RayEnvVec(EnvVecBase):
         return self._combine_func(ray.get([env.random_action.remote() for env in self.envs]))
 
     def step(self, actions, **kwargs):
+        assert not self._futures, 'Call step_wait before stepping synchronously'
         actions = [np.squeeze(a) for a in np.split(actions, self.n_workers)]
         if kwargs:
             kwargs = {k: [np.squeeze(x) for x in np.split(v, self.n_workers)] 
@@ -58,6 +62,46 @@ class RayEnvVec(EnvVecBase):
         out = [self._convert_batch(o, self._combine_func) for o in zip(*out)]
         return EnvOutput(*out)
 
+    def step_async(self, actions, idxes=None, **kwargs):
+        """ Starts stepping the environments given by idxes, where actions
+        and kwargs are aligned with idxes. As a worker steps all its 
+        environments at once, idxes should cover all environments of a worker """
+        idxes = self._get_idxes(idxes)
+        actions = np.asarray(actions)
+        positions = {i: j for j, i in enumerate(idxes)}
+        for wid in sorted({i // self.envsperworker for i in idxes}):
+            assert wid not in self._futures.values(), f'Worker {wid} is being stepped'
+            env_ids = range(wid * self.envsperworker, (wid+1) * self.envsperworker)
+            assert all(i in positions for i in env_ids), \
+                f'idxes({idxes}) do not cover all environments of worker {wid}'
+            local = [positions[i] for i in env_ids]
+            kw = {k: np.squeeze(v[local]) for k, v in kwargs.items()}
+            ref = self.envs[wid].step.remote(np.squeeze(actions[local]), **kw)
+            self._futures[ref] = wid
+
+    def step_wait(self, min_ready=None):
+        """ Waits until at least min_ready environments stepped by step_async 
+        are done, all pending environments by default
+
+        Returns:
+            idxes: the environments that are done
+            env_output: EnvOutput of these environments
+        """
+        refs = list(self._futures)
+        n_workers = len(refs) if min_ready is None \
+            else min(-(-min_ready // self.envsperworker), len(refs))
+        ready, _ = ray.wait(refs, num_returns=n_workers)
+        # also take the others that are done by now
+        ready, _ = ray.wait(refs, num_returns=len(refs), timeout=0) \
+            if len(ready) < len(refs) else (ready, None)
+        wids = [self._futures.pop(r) for r in ready]
+        out = ray.get(ready)
+        idxes = [wid * self.envsperworker + i 
+            for wid in wids for i in range(self.envsperworker)]
+        out = [self._convert_batch(o, self._combine_func) for o in zip(*out)]
+
+        return idxes, EnvOutput(*out)
+
     def score(self, idxes=None):
         return self._remote_call('score', idxes)
 
@@ -90,7 +134,7 @@ class RayEnvVec(EnvVecBase):
         if idxes is None:
             out = ray.get([method(e).remote() for e in self.envs])
         else:
-            if isinstance(self.env, Env):
+            if self._combine_func is np.stack:
                 out = ray.get([method(self.envs[i]).remote() for i in idxes])
             else:
                 new_idxes = [[] for _ in range(self.n_workers)]
@@ -100,7 +144,7 @@ class RayEnvVec(EnvVecBase):
                     for i, j in enumerate(new_idxes) if j])
 
         if single_output:
-            if isinstance(self.env, Env):
+            if self._combine_func is np.stack:
                 return self._convert_batch(out) if convert_batch else out
             # for these outputs, we expect them to be of form [[out*], [out*]]
             # and we chain them into [out*]
@@ -25,6 +25,7 @@ import gym
 
 from utility.utils import batch_dicts
 from env.smac_maps import get_map_params
+from env import smac_utils
 from env import wrappers
 
 
@@ -135,6 +136,7 @@ class SMAC(gym.Env):
         heuristic_ai=False,
         heuristic_rest=False,
         debug=False,
+        vectorized_feats=True,
         **kwargs,
     ):
         """
@@ -232,6 +234,10 @@ class SMAC(gym.Env):
         debug: bool, optional
             Log messages about observations, state, actions and rewards for
             debugging purposes (default is False).
+        vectorized_feats: bool, optional
+            Compute observations and states of all agents at once with
+            array operations (default is True). Features are the same as
+            those computed agent by agent.
         """
         import sys
         from absl import flags
@@ -299,6 +305,9 @@ class SMAC(gym.Env):
         self.heuristic_ai = heuristic_ai
         self.heuristic_rest = heuristic_rest
         self.debug = debug
+        self.vectorized_feats = vectorized_feats
+        # buffers reused to compute features, see env/smac_utils.py
+        self._feat_buffers = {}
         self.window_size = (window_size_x, window_size_y)
         self.replay_dir = replay_dir
         self.replay_prefix = replay_prefix
@@ -532,12 +541,7 @@ class SMAC(gym.Env):
             print("Started Episode {}"
                           .format(self._episode_count).center(60, "*"))
 
-        if self.use_state_agent:
-            global_state = [self.get_state_agent(agent_id) for agent_id in range(self.n_agents)]
-        else:
-            global_state = [self.get_state(agent_id) for agent_id in range(self.n_agents)]
-
-        local_obs = self.get_obs()
+        global_state, local_obs = self.get_obs_and_states(available_actions)
 
         if self.use_stacked_frames:
             self.stacked_local_obs = np.roll(self.stacked_local_obs, 1, axis=1)
@@ -633,12 +637,7 @@ class SMAC(gym.Env):
                 }
                 dones[i] = True
                 
-            if self.use_state_agent:
-                global_state = [self.get_state_agent(agent_id) for agent_id in range(self.n_agents)]
-            else:
-                global_state = [self.get_state(agent_id) for agent_id in range(self.n_agents)]
-
-            local_obs = self.get_obs()
+            global_state, local_obs = self.get_obs_and_states(available_actions)
 
             if self.use_stacked_frames:
                 self.stacked_local_obs = np.roll(self.stacked_local_obs, 1, axis=1)
@@ -737,12 +736,7 @@ class SMAC(gym.Env):
 
         self._score += np.max(reward)
 
-        if self.use_state_agent:
-            global_state = [self.get_state_agent(agent_id) for agent_id in range(self.n_agents)]
-        else:
-            global_state = [self.get_state(agent_id) for agent_id in range(self.n_agents)]
-
-        local_obs = self.get_obs()
+        global_state, local_obs = self.get_obs_and_states(available_actions)
 
         if self.use_stacked_frames:
             self.stacked_local_obs = np.roll(self.stacked_local_obs, 1, axis=1)
@@ -1328,10 +1322,36 @@ class SMAC(gym.Env):
         NOTE: Agents should have access only to their local observations
         during decentralised execution.
         """
+        if self.vectorized_feats and not self.debug:
+            return smac_utils.get_obs(self, self.get_avail_actions())
         agents_obs = np.array(
             [self.get_obs_agent(i) for i in range(self.n_agents)], dtype=np.float32)
         return agents_obs
 
+    def get_obs_and_states(self, avail_actions):
+        """Returns global states and observations of all agents, 
+        computing unit features once for all agents if vectorized_feats.
+        """
+        if not self.vectorized_feats or self.debug:
+            if self.use_state_agent:
+                global_state = [self.get_state_agent(agent_id) for agent_id in range(self.n_agents)]
+            else:
+                global_state = [self.get_state(agent_id) for agent_id in range(self.n_agents)]
+            return global_state, self.get_obs()
+
+        allies = smac_utils.gather_units(self, True)
+        enemies = smac_utils.gather_units(self, False)
+        local_obs = smac_utils.get_obs(self, avail_actions, allies, enemies)
+        if self.obs_instead_of_state:
+            global_state = np.tile(local_obs.reshape(1, -1), (self.n_agents, 1))
+        elif self.use_state_agent:
+            global_state = smac_utils.get_state_agent(self, avail_actions, allies, enemies)
+        else:
+            global_state = smac_utils.get_state(
+                self, avail_actions, allies, enemies, obs=local_obs)
+
+        return global_state, local_obs
+
     def get_state(self, agent_id=-1):
         """Returns the global state.
         NOTE: This functon should not be used during decentralised execution.
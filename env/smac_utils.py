@@ -0,0 +1,411 @@
+""" Vectorized feature construction for SMAC environments
+
+Functions here compute observations and global states of all agents at
+once from unit attributes gathered into arrays, producing the same
+features as the per-agent methods of the SMAC environments (get_obs_agent,
+get_state_agent and get_state). Feature blocks are written to buffers kept
+in env._feat_buffers, which are zeroed and reused at every step; the
+returned features are freshly concatenated so that they can be held across
+steps.
+"""
+import numpy as np
+
+from utility.typing import AttrDict
+
+
+def gather_units(env, ally):
+    """ Gathers attributes of allies or enemies into arrays """
+    if ally:
+        units = [env.agents[i] for i in range(env.n_agents)]
+        shield_bits = env.shield_bits_ally
+    else:
+        units = [env.enemies[i] for i in range(env.n_enemies)]
+        shield_bits = env.shield_bits_enemy
+    pos = np.array([(u.pos.x, u.pos.y) for u in units], dtype=np.float64)
+    units = AttrDict(
+        units=units,
+        pos=pos,
+        alive=np.array([u.health > 0 for u in units], dtype=bool),
+        health=np.array([u.health / u.health_max for u in units], dtype=np.float64),
+        shield=np.array([u.shield / env.unit_max_shield(u) for u in units], 
+            dtype=np.float64) if shield_bits > 0 else None,
+        type_id=np.array([env.get_unit_type_id(u, ally) for u in units], 
+            dtype=np.int64) if env.unit_type_bits > 0 else None,
+        center=(pos - (env.map_x / 2, env.map_y / 2)) 
+            / (env.max_distance_x, env.max_distance_y),
+    )
+    if ally:
+        units.cooldown = np.array([_cooldown(env, u) for u in units.units], dtype=np.float64)
+        units.sight_range = np.array([env.unit_sight_range(i)
+            for i in range(env.n_agents)], dtype=np.float64)
+
+    return units
+
+
+def get_obs(env, avail_actions, allies=None, enemies=None):
+    """ Returns observations of all agents, as get_obs_agent in env/smac.py """
+    allies = allies or gather_units(env, True)
+    enemies = enemies or gather_units(env, False)
+    avail_actions = np.asarray(avail_actions)
+    ally_feats, enemy_feats, move_feats = _get_obs_blocks(
+        env, avail_actions, allies, enemies)
+
+    own_feats = _zeros(env, 'own_feats', (env.n_agents, env.get_obs_own_feats_size()))
+    alive = allies.alive
+    own_feats[alive, 0] = 1     # visible
+    ind = 4
+    if env.obs_own_health:
+        own_feats[:, ind] = allies.health
+        ind += 1
+        if env.shield_bits_ally > 0:
+            own_feats[:, ind] = allies.shield
+            ind += 1
+    if env.unit_type_bits > 0:
+        _one_hot(own_feats, ind, allies.type_id)
+        ind += env.unit_type_bits
+    if env.obs_last_action:
+        own_feats[:, ind:] = env.last_action
+    own_feats[~alive] = 0
+
+    obs = [ally_feats.reshape(env.n_agents, -1),
+        enemy_feats.reshape(env.n_agents, -1), move_feats, own_feats]
+    if env.obs_agent_id:
+        obs.append(np.eye(env.n_agents, dtype=np.float32))
+    if env.obs_timestep_number:
+        obs.append(np.full((env.n_agents, 1),
+            env._episode_steps / env.max_episode_steps, dtype=np.float32))
+    obs = np.concatenate(obs, -1)
+
+    return obs
+
+
+def get_obs_own_first(env, avail_actions, allies=None, enemies=None):
+    """ Returns observations of all agents, as get_obs_agent in env2/smac3.py,
+    where move, enemy, ally and own features are concatenated in order and
+    own features include the agent's last action and id """
+    allies = allies or gather_units(env, True)
+    enemies = enemies or gather_units(env, False)
+    avail_actions = np.asarray(avail_actions)
+    ally_feats, enemy_feats, move_feats = _get_obs_blocks(
+        env, avail_actions, allies, enemies)
+
+    own_feats = _zeros(env, 'own_feats', (env.n_agents, env.get_obs_own_feats_size()))
+    ind = 0
+    if env.obs_own_health:
+        own_feats[:, ind] = allies.health
+        ind += 1
+        if env.shield_bits_ally > 0:
+            own_feats[:, ind] = allies.shield
+            ind += 1
+    if env.unit_type_bits > 0:
+        _one_hot(own_feats, ind, allies.type_id)
+        ind += env.unit_type_bits
+    if env.obs_own_last_action or env.obs_last_action:
+        _one_hot(own_feats, ind, np.asarray(env.raw_last_action, dtype=np.int64))
+        ind += env.n_actions
+    if env.obs_agent_id:
+        _one_hot(own_feats, ind, np.arange(env.n_agents))
+        ind += env.n_agents
+    assert ind == own_feats.shape[-1], (ind, own_feats.shape)
+    own_feats[~allies.alive] = 0
+
+    obs = [move_feats, enemy_feats.reshape(env.n_agents, -1),
+        ally_feats.reshape(env.n_agents, -1), own_feats]
+    if env.obs_timestep_number:
+        obs.append(np.full((env.n_agents, 1),
+            env._episode_steps / env.episode_limit, dtype=np.float32))
+    obs = np.concatenate(obs, -1)
+
+    return obs
+
+
+def get_state_agent(env, avail_actions, allies=None, enemies=None):
+    """ Returns global states of all agents, as get_state_agent in env/smac.py """
+    allies = allies or gather_units(env, True)
+    enemies = enemies or gather_units(env, False)
+    avail_actions = np.asarray(avail_actions)
+    n_agents, n_enemies = env.n_agents, env.n_enemies
+    alive = allies.alive
+    # features of dead agents are all zeros if use_mustalive
+    valid = alive if env.use_mustalive else np.ones(n_agents, bool)
+    sight_range = allies.sight_range
+
+    move_feats = _get_move_feats(env, 'state_move_feats',
+        env.get_obs_move_feats_size(), avail_actions, allies, valid,
+        env.state_pathing_grid, env.state_terrain_height)
+
+    # Enemy features
+    enemy_feats = _zeros(env, 'state_enemy_feats',
+        (n_agents, *env.get_state_enemy_feats_size()))
+    dist, rel = _relative(allies.pos, enemies.pos)
+    relative = alive[:, None] & enemies.alive[None]
+    enemy_feats[..., 0] = avail_actions[:, env.n_actions_no_attack:]   # available
+    enemy_feats[..., 1] = dist / sight_range[:, None]                  # distance
+    enemy_feats[..., 2:4] = rel / sight_range[:, None, None]           # relative X, Y
+    enemy_feats[..., 4] = dist < sight_range[:, None]                  # visible
+    enemy_feats[~relative, :5] = 0
+    ind = 5
+    if env.obs_all_health:
+        enemy_feats[..., ind] = enemies.health
+        ind += 1
+        if env.shield_bits_enemy > 0:
+            enemy_feats[..., ind] = enemies.shield
+            ind += 1
+    if env.unit_type_bits > 0:
+        _one_hot(enemy_feats, ind, np.broadcast_to(enemies.type_id, (n_agents, n_enemies)))
+        ind += env.unit_type_bits
+    if env.add_center_xy:
+        enemy_feats[..., ind:ind+2] = enemies.center
+    enemy_feats[~(valid[:, None] & enemies.alive[None])] = 0
+
+    # Ally features
+    ally_feats = _zeros(env, 'state_ally_feats',
+        (n_agents, *env.get_state_ally_feats_size()))
+    others = _others(n_agents)
+    dist, rel = _relative(allies.pos, allies.pos)
+    dist = np.take_along_axis(dist, others, 1)
+    rel = rel[np.arange(n_agents)[:, None], others]
+    ally_feats[..., 0] = dist < sight_range[:, None]                   # visible
+    ally_feats[..., 1] = dist / sight_range[:, None]                   # distance
+    ally_feats[..., 2:4] = rel / sight_range[:, None, None]            # relative X, Y
+    ally_feats[~alive, :, :4] = 0
+    ally_feats[..., 4] = allies.cooldown[others]                       # cooldown
+    ind = 5
+    if env.obs_all_health:
+        ally_feats[..., ind] = allies.health[others]
+        ind += 1
+        if env.shield_bits_ally > 0:
+            ally_feats[..., ind] = allies.shield[others]
+            ind += 1
+    if env.add_center_xy:
+        ally_feats[..., ind:ind+2] = allies.center[others]
+        ind += 2
+    if env.unit_type_bits > 0:
+        _one_hot(ally_feats, ind, allies.type_id[others])
+        ind += env.unit_type_bits
+    if env.state_last_action:
+        ally_feats[..., ind:] = env.last_action[others]
+    ally_feats[~(valid[:, None] & alive[others])] = 0
+
+    # Own features
+    own_feats = _zeros(env, 'state_own_feats', (n_agents, env.get_state_own_feats_size()))
+    own_feats[:, 0] = 1     # visible
+    ind = 4
+    if env.obs_own_health:
+        own_feats[:, ind] = allies.health
+        ind += 1
+        if env.shield_bits_ally > 0:
+            own_feats[:, ind] = allies.shield
+            ind += 1
+    if env.add_center_xy:
+        own_feats[:, ind:ind+2] = allies.center
+        ind += 2
+    if env.unit_type_bits > 0:
+        _one_hot(own_feats, ind, allies.type_id)
+        ind += env.unit_type_bits
+    if env.state_last_action:
+        own_feats[:, ind:] = env.last_action
+    own_feats[~valid] = 0
+
+    state = [ally_feats.reshape(n_agents, -1),
+        enemy_feats.reshape(n_agents, -1), move_feats, own_feats]
+    if env.state_agent_id:
+        state.append(np.eye(n_agents, dtype=np.float32))
+    if env.state_timestep_number:
+        state.append(np.full((n_agents, 1),
+            env._episode_steps / env.max_episode_steps, dtype=np.float32))
+    state = np.concatenate(state, -1)
+
+    return state
+
+
+def get_state(env, avail_actions, allies=None, enemies=None, obs=None):
+    """ Returns global states of all agents, as get_state in env/smac.py """
+    allies = allies or gather_units(env, True)
+    enemies = enemies or gather_units(env, False)
+    avail_actions = np.asarray(avail_actions)
+    n_agents, n_enemies = env.n_agents, env.n_enemies
+    alive = allies.alive
+    valid = alive if env.use_mustalive else np.ones(n_agents, bool)
+    sight_range = allies.sight_range
+    _, (_, nf_al), (_, nf_en), _ = env.get_state_size()
+
+    # Ally features, where ally_state[i, j] is the feature of ally j for agent i
+    ally_state = _zeros(env, 'ally_state', (n_agents, n_agents, nf_al))
+    ally_state[..., 0] = allies.health
+    ally_state[..., 1] = allies.cooldown
+    ind = 2
+    if env.add_center_xy:
+        ally_state[..., ind:ind+2] = allies.center
+        ind += 2
+    if env.shield_bits_ally > 0:
+        ally_state[..., ind] = allies.shield
+        ind += 1
+    if env.unit_type_bits > 0:
+        _one_hot(ally_state, ind, np.broadcast_to(allies.type_id, (n_agents, n_agents)))
+        ind += env.unit_type_bits
+    dist, rel = _relative(allies.pos, allies.pos)
+    ind = _fill_relative_state(env, ally_state, ind, dist, rel, sight_range, alive)
+    if env.state_last_action:
+        ally_state[alive, :, ind:] = env.last_action
+    ally_state[~(valid[:, None] & alive[None])] = 0
+
+    # Enemy features
+    enemy_state = _zeros(env, 'enemy_state', (n_agents, n_enemies, nf_en))
+    enemy_state[..., 0] = enemies.health
+    ind = 1
+    if env.add_center_xy:
+        enemy_state[..., ind:ind+2] = enemies.center
+        ind += 2
+    if env.shield_bits_enemy > 0:
+        enemy_state[..., ind] = enemies.shield
+        ind += 1
+    if env.unit_type_bits > 0:
+        _one_hot(enemy_state, ind, np.broadcast_to(enemies.type_id, (n_agents, n_enemies)))
+        ind += env.unit_type_bits
+    dist, rel = _relative(allies.pos, enemies.pos)
+    ind = _fill_relative_state(env, enemy_state, ind, dist, rel, sight_range, alive)
+    if env.add_enemy_action_state:
+        enemy_state[alive, :, ind] = avail_actions[alive, env.n_actions_no_attack:]
+    enemy_state[~(valid[:, None] & enemies.alive[None])] = 0
+
+    state = [ally_state.reshape(n_agents, -1), enemy_state.reshape(n_agents, -1)]
+    if env.add_move_state:
+        state.append(_get_move_feats(env, 'move_state',
+            env.get_state_move_feats_size(), avail_actions, allies, valid,
+            env.state_pathing_grid, env.state_terrain_height))
+    if env.add_local_obs:
+        state.append(get_obs(env, avail_actions, allies, enemies) if obs is None else obs)
+    if env.state_timestep_number:
+        state.append(np.full((n_agents, 1),
+            env._episode_steps / env.max_episode_steps, dtype=np.float32))
+    if env.add_agent_id:
+        state.append(np.eye(n_agents, dtype=np.float32))
+    state = np.concatenate(state, -1)
+
+    return state
+
+
+""" Implementation """
+def _zeros(env, name, shape):
+    """ Returns a zeroed float32 buffer of shape, reused across calls """
+    buf = env._feat_buffers.get(name)
+    if buf is None or buf.shape != shape:
+        buf = env._feat_buffers[name] = np.zeros(shape, np.float32)
+    else:
+        buf.fill(0)
+    return buf
+
+
+def _cooldown(env, unit):
+    max_cd = env.unit_max_cooldown(unit)
+    if env.map_type == "MMM" and unit.unit_type == env.medivac_id:
+        return unit.energy / max_cd         # energy
+    return unit.weapon_cooldown / max_cd    # cooldown
+
+
+def _others(n):
+    """ others[i] lists all agents except agent i in order """
+    return np.array([[j for j in range(n) if j != i] for i in range(n)],
+        dtype=np.int64).reshape(n, n-1)
+
+
+def _relative(pos, other_pos):
+    """ Returns distances and relative positions of other_pos to pos """
+    rel = other_pos[None] - pos[:, None]
+    dist = np.hypot(rel[..., 0], rel[..., 1])
+    return dist, rel
+
+
+def _one_hot(feats, ind, idxes):
+    """ Sets feats[..., ind + idxes] to 1 """
+    np.put_along_axis(feats, (ind + idxes)[..., None], 1, axis=-1)
+
+
+def _fill_relative_state(env, state, ind, dist, rel, sight_range, alive):
+    """ Writes features relative to agents for get_state """
+    start = ind
+    if env.add_distance_state:
+        state[..., ind] = dist / sight_range[:, None]              # distance
+        ind += 1
+    if env.add_xy_state:
+        state[..., ind:ind+2] = rel / sight_range[:, None, None]   # relative X, Y
+        ind += 2
+    if env.add_visible_state:
+        state[..., ind] = dist < sight_range[:, None]              # visible
+        ind += 1
+    state[~alive, :, start:ind] = 0
+    return ind
+
+
+def _get_move_feats(env, name, size, avail_actions, allies, valid,
+        pathing_grid, terrain_height):
+    move_feats = _zeros(env, name, (env.n_agents, size))
+    move_feats[:, :env.n_actions_move] = avail_actions[:, 2:2+env.n_actions_move]
+    ind = env.n_actions_move
+    for i in np.nonzero(valid)[0]:
+        unit = allies.units[i]
+        j = ind
+        if pathing_grid:
+            move_feats[i, j: j + env.n_obs_pathing] = env.get_surrounding_pathing(unit)
+            j += env.n_obs_pathing
+        if terrain_height:
+            move_feats[i, j:] = env.get_surrounding_height(unit)
+    move_feats[~valid] = 0
+    return move_feats
+
+
+def _get_obs_blocks(env, avail_actions, allies, enemies):
+    """ Returns ally, enemy and move features of observations,
+    which are shared by all SMAC versions """
+    n_agents, n_enemies = env.n_agents, env.n_enemies
+    alive = allies.alive
+    sight_range = allies.sight_range
+
+    move_feats = _get_move_feats(env, 'move_feats',
+        env.get_obs_move_feats_size(), avail_actions, allies, alive,
+        env.obs_pathing_grid, env.obs_terrain_height)
+
+    # Enemy features
+    enemy_feats = _zeros(env, 'enemy_feats', (n_agents, *env.get_obs_enemy_feats_size()))
+    dist, rel = _relative(allies.pos, enemies.pos)
+    visible = alive[:, None] & (dist < sight_range[:, None]) & enemies.alive[None]
+    enemy_feats[..., 0] = avail_actions[:, env.n_actions_no_attack:]   # available
+    enemy_feats[..., 1] = dist / sight_range[:, None]                  # distance
+    enemy_feats[..., 2:4] = rel / sight_range[:, None, None]           # relative X, Y
+    ind = 4
+    if env.obs_all_health:
+        enemy_feats[..., ind] = enemies.health
+        ind += 1
+        if env.shield_bits_enemy > 0:
+            enemy_feats[..., ind] = enemies.shield
+            ind += 1
+    if env.unit_type_bits > 0:
+        _one_hot(enemy_feats, ind, np.broadcast_to(enemies.type_id, (n_agents, n_enemies)))
+    enemy_feats[~visible] = 0
+
+    # Ally features
+    ally_feats = _zeros(env, 'ally_feats', (n_agents, *env.get_obs_ally_feats_size()))
+    others = _others(n_agents)
+    dist, rel = _relative(allies.pos, allies.pos)
+    dist = np.take_along_axis(dist, others, 1)
+    rel = rel[np.arange(n_agents)[:, None], others]
+    visible = alive[:, None] & (dist < sight_range[:, None]) & alive[others]
+    ally_feats[..., 0] = 1                                             # visible
+    ally_feats[..., 1] = dist / sight_range[:, None]                   # distance
+    ally_feats[..., 2:4] = rel / sight_range[:, None, None]            # relative X, Y
+    ind = 4
+    if env.obs_all_health:
+        ally_feats[..., ind] = allies.health[others]
+        ind += 1
+        if env.shield_bits_ally > 0:
+            ally_feats[..., ind] = allies.shield[others]
+            ind += 1
+    if env.unit_type_bits > 0:
+        _one_hot(ally_feats, ind, allies.type_id[others])
+        ind += env.unit_type_bits
+    if env.obs_last_action:
+        ally_feats[..., ind:] = env.last_action[others]
+    ally_feats[~visible] = 0
+
+    return ally_feats, enemy_feats, move_feats
@@ -0,0 +1,137 @@
+""" On-disk cache of environment stats
+
+Reading stats, spaces or the output layout of an environment otherwise
+requires constructing it, which is costly for environments such as SMAC.
+The cache is used only if cache_env_stats=True in the env config. It is
+stored in ENV_STATS_DIR, keyed by a hash of the env config, with entries
+that do not affect it removed, and of the env factory. The key does not
+cover environment code, so remove the directory after changing an
+environment, or the stale stats and output layout are returned.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import cloudpickle
+
+from core.log import do_logging
+from env.cls import Env, make_env
+
+logger = logging.getLogger(__name__)
+
+ENV_STATS_DIR = os.path.join('logs', 'env_stats')
+# config entries that do not affect the cached data
+EXCLUDED_KEYS = ('n_workers', 'n_envs', 'seed', 'vec_backend',
+    'copy_output', 'start_method', 'batched', 'cache_env_stats')
+# attributes of an environment kept in the cache, when available
+ENV_ATTRS = ('max_episode_steps', 'frame_skip', 'n_agents', 'is_multiagent',
+    'auto_reset', 'timeout_done', 'float_dtype', 'obs_shape', 'obs_dtype',
+    'action_shape', 'action_dtype', 'action_dim', 'is_action_discrete',
+    'n_trainable_agents', 'use_life_mask', 'use_action_mask',
+    'global_state_shape', 'global_state_dtype',
+    'observation_space', 'action_space', 'reward_range', 'metadata')
+
+
+def env_fn_id(env_fn):
+    """ Identifies env_fn by its module and qualified name, 
+    along with the arguments bound by functools.partial """
+    args = []
+    while isinstance(env_fn, functools.partial):
+        args.append((env_fn.args, env_fn.keywords))
+        env_fn = env_fn.func
+    name = getattr(env_fn, '__qualname__', type(env_fn).__qualname__)
+    return [getattr(env_fn, '__module__', None), name, args]
+
+
+def env_config_key(config, env_fn=make_env):
+    """ Returns the hash of the env config and 
+    the env factory identifying their cache """
+    config = {k: v for k, v in config.items() if k not in EXCLUDED_KEYS}
+    s = json.dumps([config, env_fn_id(env_fn)], sort_keys=True, default=str)
+    return hashlib.md5(s.encode()).hexdigest()
+
+
+def get_cache_path(config, env_fn=make_env):
+    return os.path.join(ENV_STATS_DIR, f'{env_config_key(config, env_fn)}.pkl')
+
+
+def load_env_cache(config, env_fn=make_env):
+    """ Returns the cache of config, or None if not cached """
+    if not config.get('cache_env_stats', False):
+        return None
+    path = get_cache_path(config, env_fn)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return cloudpickle.load(f)
+    except Exception as e:
+        do_logging(f'Failed to load env stats from {path}: {e}',
+            logger=logger, level='WARNING')
+        return None
+
+
+def save_env_cache(config, cache, env_fn=make_env):
+    """ Saves cache atomically, so that concurrent
+    workers never read a partially written file """
+    path = get_cache_path(config, env_fn)
+    os.makedirs(ENV_STATS_DIR, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        cloudpickle.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def get_env_cache(config, env_fn=make_env):
+    """ Returns the cache of config, constructing an environment
+    and saving its stats, attributes and output if not cached.
+
+    Returns:
+        A dict with entries
+            stats: env.stats()
+            attrs: attributes in ENV_ATTRS
+            output: env.output() of a single environment
+    """
+    cache = load_env_cache(config, env_fn)
+    if cache is not None:
+        return cache
+
+    config = config.copy()
+    config['n_workers'] = 1
+    config['n_envs'] = 1
+    config.pop('batched', None)
+    env = Env(config, env_fn)
+    cache = dict(
+        stats=env.stats(),
+        attrs={k: getattr(env, k) for k in ENV_ATTRS if hasattr(env, k)},
+        output=env.output(),
+    )
+    env.close()
+    if config.get('cache_env_stats', False):
+        try:
+            save_env_cache(config, cache, env_fn)
+        except Exception as e:
+            do_logging(f'Failed to save env stats of {config["name"]}: {e}',
+                logger=logger, level='WARNING')
+
+    return cache
+
+
+class CachedEnv:
+    """ Stands in for a local environment whose attributes
+    are only read, providing them from the cache """
+    def __init__(self, cache):
+        self._stats = cache['stats']
+        self._output = cache['output']
+        for k, v in cache['attrs'].items():
+            setattr(self, k, v)
+
+    def stats(self):
+        return self._stats
+
+    def output(self):
+        return self._output
+
+    def close(self):
+        pass
@@ -321,11 +321,17 @@ class DataProcess(gym.Wrapper):
 
     def observation(self, observation):
         if isinstance(observation, np.ndarray):
-            return convert_dtype(observation, self.precision)
+            return self._convert(observation)
         elif isinstance(observation, dict):
             for k, v in observation.items():
-                observation[k] = convert_dtype(v, self.precision)
+                observation[k] = self._convert(v)
         return observation
+
+    def _convert(self, x):
+        # arrays already of the right dtype, e.g., uint8 images, are not copied
+        if isinstance(x, np.ndarray) and x.dtype == infer_dtype(x.dtype, self.precision):
+            return x
+        return convert_dtype(x, self.precision)
     
     # def action(self, action):
     #     if isinstance(action, np.ndarray):
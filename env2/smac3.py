@@ -25,6 +25,7 @@ import gym
 
 from utility.utils import batch_dicts
 from env.smac_maps import get_map_params
+from env import smac_utils
 from env import wrappers
 
 
@@ -122,6 +123,7 @@ class SMAC(gym.Env):
         heuristic_ai=False,
         heuristic_rest=False,
         debug=False,
+        vectorized_feats=True,
         **kwargs,
     ):
         """
@@ -219,6 +221,10 @@ class SMAC(gym.Env):
         debug: bool, optional
             Log messages about observations, state, actions and rewards for
             debugging purposes (default is False).
+        vectorized_feats: bool, optional
+            Compute observations and states of all agents at once with
+            array operations (default is True). Features are the same as
+            those computed agent by agent.
         """
         import sys
         from absl import flags
@@ -274,6 +280,9 @@ class SMAC(gym.Env):
         self.heuristic_ai = heuristic_ai
         self.heuristic_rest = heuristic_rest
         self.debug = debug
+        self.vectorized_feats = vectorized_feats
+        # buffers reused to compute features, see env/smac_utils.py
+        self._feat_buffers = {}
         self.window_size = (window_size_x, window_size_y)
         self.replay_dir = replay_dir
         self.replay_prefix = replay_prefix
@@ -502,7 +511,7 @@ class SMAC(gym.Env):
 
         global_state = self.get_state()
 
-        local_obs = self.get_obs()
+        local_obs = self.get_obs(available_actions)
 
         obs_dict = dict(
             obs=local_obs,
@@ -587,7 +596,7 @@ class SMAC(gym.Env):
 
             global_state = self.get_state()
             
-            local_obs = self.get_obs()
+            local_obs = self.get_obs(available_actions)
 
             obs_dict = dict(
                 obs=local_obs,
@@ -669,7 +678,7 @@ class SMAC(gym.Env):
 
         global_state = self.get_state()
 
-        local_obs = self.get_obs()
+        local_obs = self.get_obs(available_actions)
 
         obs_dict = dict(
             obs=local_obs,
@@ -1238,11 +1247,15 @@ class SMAC(gym.Env):
 
         return agent_obs
 
-    def get_obs(self):
+    def get_obs(self, avail_actions=None):
         """Returns all agent observations in a list.
         NOTE: Agents should have access only to their local observations
         during decentralised execution.
         """
+        if self.vectorized_feats and not self.debug:
+            if avail_actions is None:
+                avail_actions = self.get_avail_actions()
+            return smac_utils.get_obs_own_first(self, avail_actions)
         agents_obs = np.array(
             [self.get_obs_agent(i) for i in range(self.n_agents)], dtype=np.float32)
         return agents_obs
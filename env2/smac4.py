@@ -25,6 +25,7 @@ import gym
 
 from utility.utils import batch_dicts
 from env.smac_maps import get_map_params
+from env import smac_utils
 from env import wrappers
 
 
@@ -121,6 +122,7 @@ class SMAC(gym.Env):
         heuristic_ai=False,
         heuristic_rest=False,
         debug=False,
+        vectorized_feats=True,
         **kwargs,
     ):
         """
@@ -218,6 +220,10 @@ class SMAC(gym.Env):
         debug: bool, optional
             Log messages about observations, state, actions and rewards for
             debugging purposes (default is False).
+        vectorized_feats: bool, optional
+            Compute observations and states of all agents at once with
+            array operations (default is True). Features are the same as
+            those computed agent by agent.
         """
         import sys
         from absl import flags
@@ -272,6 +278,9 @@ class SMAC(gym.Env):
         self.heuristic_ai = heuristic_ai
         self.heuristic_rest = heuristic_rest
         self.debug = debug
+        self.vectorized_feats = vectorized_feats
+        # buffers reused to compute features, see env/smac_utils.py
+        self._feat_buffers = {}
         self.window_size = (window_size_x, window_size_y)
         self.replay_dir = replay_dir
         self.replay_prefix = replay_prefix
@@ -486,9 +495,10 @@ class SMAC(gym.Env):
             print("Started Episode {}"
                           .format(self._episode_count).center(60, "*"))
 
-        global_state = np.array([self.get_state() for _ in range(self.n_agents)], np.float32)
+        global_state = self.get_state()
+        global_state = np.array([global_state for _ in range(self.n_agents)], np.float32)
 
-        local_obs = self.get_obs()
+        local_obs = self.get_obs(available_actions)
 
         obs_dict = dict(
             obs=local_obs,
@@ -577,9 +587,10 @@ class SMAC(gym.Env):
                     "won": self.win_counted
                 }
 
-            global_state = np.array([self.get_state() for _ in range(self.n_agents)], np.float32)
+            global_state = self.get_state()
+            global_state = np.array([global_state for _ in range(self.n_agents)], np.float32)
             
-            local_obs = self.get_obs()
+            local_obs = self.get_obs(available_actions)
 
             obs_dict = dict(
                 obs=local_obs,
@@ -655,9 +666,10 @@ class SMAC(gym.Env):
         self._score += reward
         reward = np.ones(self.n_agents, np.float32) * reward
 
-        global_state = np.array([self.get_state() for _ in range(self.n_agents)], np.float32)
+        global_state = self.get_state()
+        global_state = np.array([global_state for _ in range(self.n_agents)], np.float32)
 
-        local_obs = self.get_obs()
+        local_obs = self.get_obs(available_actions)
 
         obs_dict = dict(
             obs=local_obs,
@@ -1210,11 +1222,15 @@ class SMAC(gym.Env):
 
         return agent_obs
 
-    def get_obs(self):
+    def get_obs(self, avail_actions=None):
         """Returns all agent observations in a list.
         NOTE: Agents should have access only to their local observations
         during decentralised execution.
         """
+        if self.vectorized_feats and not self.debug:
+            if avail_actions is None:
+                avail_actions = self.get_avail_actions()
+            return smac_utils.get_obs_own_first(self, avail_actions)
         agents_obs = np.array(
             [self.get_obs_agent(i) for i in range(self.n_agents)], dtype=np.float32)
         return agents_obs
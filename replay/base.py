@@ -6,11 +6,15 @@ import numpy as np
 
 from core.decorator import config
 from replay.utils import *
+from replay.ds.frame_pool import FramePool
 
 logger = logging.getLogger(__name__)
 
 
 class Replay(ABC):
+    # attributes restored along with memory-mapped memory
+    _header_attrs = ('_mem_idx', '_is_full')
+
     """ Interface """
     @config
     def __init__(self, **kwargs):
@@ -33,14 +37,42 @@ class Replay(ABC):
         self._n_envs = getattr(self, '_n_envs', 1)
         self._is_full = False
 
+        # store each frame of stacked observations once
+        self._frame_stack = getattr(self, '_frame_stack', 1)
+        self._use_frame_pool = getattr(self, '_use_frame_pool', False) \
+            and self._frame_stack > 1
+        if self._use_frame_pool:
+            self._frame_pool = FramePool(
+                self._capacity * getattr(self, '_frame_pool_ratio', 2), 
+                self._frame_stack)
+            # frames are deduplicated across consecutive transitions, 
+            # so we always collect transitions in a local buffer first
+            self._seqlen = getattr(self, '_seqlen', 64)
+            # merged chunks do not write the next_obs of their last 
+            # transitions into the following slots, so next_obs is kept
+            assert self._has_next_obs, \
+                'The frame pool requires has_next_obs, which stores frame ids only'
+        self._use_local_buffer = self._n_envs > 1 or self._use_frame_pool
+
+        # keep memory in memory-mapped files under self._dir/memmap
+        self._memmap = getattr(self, '_memmap', False)
+        assert not (self._memmap and self._use_frame_pool), \
+            'Memory-mapped replay does not support the frame pool'
+        self._memmap_dir = self._dir / 'memmap'
+        # take a snapshot every snapshot_period adds/merges
+        self._snapshot_period = getattr(self, '_snapshot_period', None)
+        self._n_writes = 0
+
         self._add_attributes(**kwargs)
         self._construct_temp_buff()
+        if self._memmap:
+            self._restore_memmap()
 
     def _add_attributes(self):
         self._pre_dims = (self._capacity, )
 
     def _construct_temp_buff(self):
-        if self._n_envs > 1:
+        if self._use_local_buffer:
             from replay.func import create_local_buffer
             self._tmp_buf = create_local_buffer({
                 'replay_type': self._replay_type,
@@ -58,7 +90,9 @@ class Replay(ABC):
         return len(self) >= self._min_size
     
     def load_data(self):
-        if self._memory == {}:
+        if self._memmap:
+            self._restore_memmap()
+        elif self._memory == {}:
             for filename in self._dir.glob('*.npz'):
                 data = load_data(filename)
                 if data is not None:
@@ -67,7 +101,9 @@ class Replay(ABC):
             logger.warning(f'There are already {len(self)} transitions in the memory. No further loading is performed')
 
     def save(self):
-        if self._save:
+        if self._memmap:
+            self._snapshot()
+        elif self._save:
             if self._save_temp and hasattr(self, '_tmp_buf'):
                 data = self._tmp_buf.retrieve()
                 self.merge(data)
@@ -78,7 +114,10 @@ class Replay(ABC):
                 end = min(start + tpf, size)
                 timestamp = datetime.now().strftime('%Y%m%dT%H%M%S')
                 filename = self._dir / f'{timestamp}-{start}-{end}.npz'
-                data = {k: self._memory[k][start: end] for k in self._save_stats or self._memory.keys()}
+                data = {k: v[start: end] for k, v in self._memory.items()}
+                if self._use_frame_pool:
+                    data = self._decode_frames(data)
+                data = {k: data[k] for k in self._save_stats or data.keys()}
                 save_data(filename, data)
                 print(f'{end-start} transitions are saved at {filename}')
 
@@ -88,6 +127,11 @@ class Replay(ABC):
     def size(self):
         return len(self)
 
+    def sampling_mass(self):
+        """ The unnormalized probability of sampling from this replay,
+        used to weight replays sampled together """
+        return len(self) if self.good_to_learn() else 0
+
     def __call__(self):
         while True:
             yield self.sample()
@@ -96,6 +140,11 @@ class Replay(ABC):
     def sample(self, batch_size=None):
         raise NotImplementedError
 
+    def sample_many(self, n, batch_size=None):
+        """ Samples n batches at once to amortize the per-call 
+        overhead, e.g., a remote call to the replay """
+        return [self.sample(batch_size) for _ in range(n)]
+
     def merge(self, local_buffer):
         """ Merge a local buffer to the replay buffer, 
         useful for distributed algorithms """
@@ -103,50 +152,67 @@ class Replay(ABC):
         assert length < self._capacity, (
             f'Local buffer cannot be largeer than the replay: {length} vs. {self._capacity}')
         self._merge(local_buffer, length)
+        self._maybe_snapshot()
 
     def add(self, **kwargs):
-        if self._n_envs > 1:
+        if self._use_local_buffer:
             self._tmp_buf.add(**kwargs)
             if self._tmp_buf.is_full():
                 data = self._tmp_buf.sample()
                 self.merge(data)
                 self._tmp_buf.reset()
         else:
-            """ Add a single transition to the replay buffer """
-            next_obs = kwargs['next_obs']
-            if self._memory == {}:
-                if not self._has_next_obs:
-                    del kwargs['next_obs']
-                init_buffer(self._memory, 
-                            pre_dims=self._pre_dims, 
-                            has_steps=self._n_steps>1, 
-                            precision=self._precision,
-                            **kwargs)
-                print_buffer(self._memory)
-
-            if not self._is_full and self._mem_idx == self._capacity - 1:
-                self._is_full = True
-            
-            add_buffer(
-                self._memory, self._mem_idx, self._n_steps, self._gamma, cycle=self._is_full, **kwargs)
-            self._mem_idx = (self._mem_idx + 1) % self._capacity
-            if 'next_obs' not in self._memory:
-                self._memory['obs'][self._mem_idx] = next_obs
+            self._add(**kwargs)
+            self._maybe_snapshot()
 
     """ Implementation """
     def _sample(self, batch_size=None):
         raise NotImplementedError
 
+    def _add(self, **kwargs):
+        """ Add a single transition to the replay buffer """
+        next_obs = kwargs['next_obs']
+        if self._memory == {}:
+            if not self._has_next_obs:
+                del kwargs['next_obs']
+            init_buffer(self._memory, 
+                        pre_dims=self._pre_dims, 
+                        has_steps=self._n_steps>1, 
+                        precision=self._precision,
+                        **kwargs)
+            print_buffer(self._memory)
+            if self._memmap:
+                self._create_memmap()
+
+        if not self._is_full and self._mem_idx == self._capacity - 1:
+            self._is_full = True
+        
+        add_buffer(
+            self._memory, self._mem_idx, self._n_steps, self._gamma, cycle=self._is_full, **kwargs)
+        self._mem_idx = (self._mem_idx + 1) % self._capacity
+        if 'next_obs' not in self._memory:
+            self._memory['obs'][self._mem_idx] = next_obs
+
     def _merge(self, local_buffer, length):
+        if self._use_frame_pool:
+            local_buffer = self._encode_frames(local_buffer, length)
         if self._memory == {}:
             if not self._has_next_obs and 'next_obs' in local_buffer:
                 del local_buffer['next_obs']
+            frame_ids = {k: local_buffer.pop(k) 
+                for k in ('obs_frames', 'next_obs_frames') if k in local_buffer}
             init_buffer(self._memory, 
                         pre_dims=self._pre_dims, 
                         has_steps=self._n_steps>1, 
                         precision=self._precision,
                         **local_buffer)
+            # frame ids are monotonic, we keep them as int64 regardless of precision
+            for k, v in frame_ids.items():
+                self._memory[k] = np.zeros((*self._pre_dims, *v.shape[1:]), np.int64)
+                local_buffer[k] = v
             print_buffer(self._memory)
+            if self._memmap:
+                self._create_memmap()
 
         end_idx = self._mem_idx + length
 
@@ -174,11 +240,16 @@ class Replay(ABC):
                 results[k] = v[idxes]
             else:
                 results[k] = np.array([np.array(v[i], copy=False) for i in idxes])
-            
-        if 'next_obs' not in self._memory:
+        if self._use_frame_pool:
+            results = self._decode_frames(results)
+
+        if 'next_obs' not in results:
             steps = results.get('steps', 1)
             next_idxes = (idxes + steps) % self._capacity
-            if isinstance(self._memory['obs'], np.ndarray):
+            if self._use_frame_pool:
+                results['next_obs'] = self._frame_pool.get(
+                    self._memory['obs_frames'][next_idxes])
+            elif isinstance(self._memory['obs'], np.ndarray):
                 results['next_obs'] = self._memory['obs'][next_idxes]
             else:
                 results['next_obs'] = np.array(
@@ -189,3 +260,99 @@ class Replay(ABC):
             results['steps'] = results['steps'].astype(np.float32)
 
         return results
+
+    def _encode_frames(self, local_buffer, length):
+        """ Replaces stacked observations with ids into the frame pool """
+        live_min = None
+        if self._memory != {}:
+            # the oldest transition that survives this merge
+            end_idx = self._mem_idx + length
+            if self._is_full or end_idx >= self._capacity:
+                live_min = np.min(self._memory['obs_frames'][end_idx % self._capacity])
+            elif self._mem_idx > 0:
+                live_min = np.min(self._memory['obs_frames'][0])
+        local_buffer = local_buffer.copy()
+        obs = local_buffer.pop('obs')[:length]
+        next_obs = local_buffer.pop('next_obs', None)
+        next_obs = next_obs[:length] \
+            if self._has_next_obs and next_obs is not None else None
+        steps = local_buffer['steps'][:length] if 'steps' in local_buffer else 1
+        obs_ids, next_obs_ids = self._frame_pool.add(
+            obs, next_obs, steps=steps, live_min=live_min)
+        local_buffer['obs_frames'] = obs_ids
+        if next_obs_ids is not None:
+            local_buffer['next_obs_frames'] = next_obs_ids
+
+        return local_buffer
+
+    def _decode_frames(self, data):
+        """ Rebuilds stacked observations from ids into the frame pool """
+        data = data.copy()
+        for k in ('obs', 'next_obs'):
+            if f'{k}_frames' in data:
+                data[k] = self._frame_pool.get(data.pop(f'{k}_frames'))
+
+        return data
+
+    """ Memory-Mapped Memory """
+    def _extra_memmap_arrays(self):
+        """ Arrays other than memory that are memory-mapped """
+        return {}
+
+    def _set_extra_memmap_arrays(self, arrays):
+        pass
+
+    def _create_memmap(self):
+        create_memmap(self._memmap_dir, self._memory)
+        arrays = self._extra_memmap_arrays()
+        create_memmap(self._memmap_dir, arrays)
+        self._set_extra_memmap_arrays(arrays)
+        self._snapshot()
+        do_logging(f'Memory is memory-mapped at {self._memmap_dir}', logger=logger)
+
+    def _maybe_snapshot(self):
+        """ Called after each add/merge, once everything is written """
+        self._n_writes += 1
+        if self._memmap and self._snapshot_period \
+                and self._n_writes % self._snapshot_period == 0:
+            self._snapshot()
+
+    def _snapshot(self):
+        """ Flushes memory-mapped arrays, then records where we are.
+        
+        A snapshot is not atomic: arrays are written in place, so slots 
+        written after the last snapshot may hold newer data on restore. 
+        Only the header is replaced atomically """
+        if self._memory == {}:
+            return
+        flush_memmap(self._memory)
+        arrays = self._extra_memmap_arrays()
+        flush_memmap(arrays)
+        header = {k: getattr(self, k) for k in self._header_attrs}
+        header = {k: v.item() if isinstance(v, np.generic) else v 
+            for k, v in header.items()}
+        header['memory_keys'] = list(self._memory)
+        header['extra_keys'] = list(arrays)
+        save_header(self._memmap_dir, header)
+
+    def _restore_memmap(self):
+        """ Remaps memory from the last snapshot, which takes O(1) time 
+        
+        Returns:
+            Whether memory is restored
+        """
+        if self._memory != {}:
+            logger.warning(f'There are already {len(self)} transitions in the memory. No further loading is performed')
+            return False
+        header = load_header(self._memmap_dir)
+        if header is None:
+            return False
+        self._memory = load_memmap(self._memmap_dir, header.pop('memory_keys'))
+        extra_arrays = load_memmap(self._memmap_dir, header.pop('extra_keys'))
+        # header attributes are set first, extra arrays may depend on them
+        for k, v in header.items():
+            setattr(self, k, v)
+        self._set_extra_memmap_arrays(extra_arrays)
+        do_logging(f'{len(self)} transitions are remapped from {self._memmap_dir}', logger=logger)
+
+        return True
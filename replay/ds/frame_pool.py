@@ -0,0 +1,142 @@
+import logging
+import numpy as np
+
+from core.log import do_logging
+
+logger = logging.getLogger(__name__)
+
+
+class FramePool:
+    """ A ring of unique frames shared by stacked observations
+
+    A stacked observation of shape [..., frame_stack * c] is stored as
+    frame_stack ids into the ring, where each frame is of shape [..., c].
+    Frame ids increase monotonically so that they remain valid when the
+    ring is enlarged; the position of a frame in the ring is id % capacity.
+    """
+    def __init__(self, capacity, frame_stack):
+        self._capacity = int(capacity)
+        self._k = frame_stack
+        self._frames = None
+        self._n_frames = 0       # number of frames ever written
+
+    def __len__(self):
+        return min(self._n_frames, self._capacity)
+
+    def add(self, obs, next_obs=None, steps=1, live_min=None):
+        """ Writes unique frames of a sequence of stacked observations
+
+        Args:
+            obs: [L, ..., frame_stack * c], consecutive observations from
+                one environment, possibly crossing episode boundaries
+            next_obs: [L, ..., frame_stack * c], the corresponding (n-step)
+                next observations
+            steps: the number of steps between obs and next_obs
+            live_min: the smallest frame id still referenced by the replay
+        Returns:
+            obs_ids: [L, frame_stack]
+            next_obs_ids: [L, frame_stack] or None
+        """
+        obs = self._to_array(obs)
+        if self._frames is None:
+            self._init_frames(obs)
+        length = obs.shape[0]
+        k = self._k
+        obs = self._split(obs)
+
+        # an observation is a continuation of the previous one if its
+        # first k-1 frames are the last k-1 frames of the previous one.
+        # Otherwise, e.g., at the beginning of an episode, we write all its frames
+        consistent = np.zeros(length, dtype=bool)
+        consistent[1:] = self._match(obs[1:, :-1], obs[:-1, 1:])
+        n_new = np.where(consistent, 1, k)
+        newest = self._n_frames + np.cumsum(n_new) - 1
+        start = newest - n_new + 1
+        # the latest observation with all its frames written
+        root = np.maximum.accumulate(np.where(consistent, 0, np.arange(length)))
+        back = np.arange(length)[:, None] - np.arange(k-1, -1, -1)
+        obs_ids = np.where(back >= root[:, None],
+            newest[np.maximum(back, 0)],
+            start[root][:, None] + k - 1 - (root[:, None] - back))
+        write_mask = np.zeros((length, k), dtype=bool)
+        write_mask[:, -1] = True
+        write_mask[~consistent] = True
+        new_frames = [obs[write_mask]]
+        n_frames = self._n_frames + new_frames[0].shape[0]
+
+        next_obs_ids = None
+        if next_obs is not None:
+            next_obs = self._split(self._to_array(next_obs))
+            idxes = np.arange(length)
+            steps = np.broadcast_to(np.asarray(steps, dtype=np.int64), (length,))
+            # next_obs either is an observation in this sequence or
+            # shifts from one, e.g., the last observation of an episode
+            target = np.minimum(idxes + steps, length - 1)
+            same = np.logical_and(idxes + steps < length,
+                self._match(next_obs, obs[target]))
+            prev = np.minimum(idxes + steps - 1, length - 1)
+            shifted = np.logical_and(~same, np.logical_and(
+                idxes + steps - 1 < length,
+                self._match(next_obs[:, :-1], obs[prev, 1:])))
+            n_next = np.where(same, 0, np.where(shifted, 1, k))
+            next_start = n_frames + np.cumsum(n_next) - n_next
+            next_obs_ids = next_start[:, None] + np.arange(k)
+            next_obs_ids[shifted, :-1] = obs_ids[prev[shifted], 1:]
+            next_obs_ids[shifted, -1] = next_start[shifted]
+            next_obs_ids[same] = obs_ids[target[same]]
+            write_mask = np.zeros((length, k), dtype=bool)
+            write_mask[shifted, -1] = True
+            write_mask[n_next == k] = True
+            new_frames.append(next_obs[write_mask])
+            n_frames += new_frames[1].shape[0]
+
+        live_min = self._n_frames if live_min is None \
+            else min(live_min, self._n_frames)
+        if n_frames - live_min > self._capacity:
+            self._enlarge(live_min, n_frames - live_min)
+        for frames in new_frames:
+            pos = np.arange(self._n_frames, self._n_frames + frames.shape[0]) % self._capacity
+            self._frames[pos] = frames
+            self._n_frames += frames.shape[0]
+        assert self._n_frames == n_frames, (self._n_frames, n_frames)
+
+        return obs_ids, next_obs_ids
+
+    def get(self, ids):
+        """ Rebuilds stacked observations from frame ids of shape [..., frame_stack] """
+        frames = self._frames[ids % self._capacity]
+        # [..., k, H, W, c] -> [..., H, W, k, c] -> [..., H, W, k * c]
+        frames = np.moveaxis(frames, ids.ndim-1, -2)
+        return frames.reshape(*frames.shape[:-2], -1)
+
+    """ Implementation """
+    def _init_frames(self, obs):
+        assert obs.shape[-1] % self._k == 0, (obs.shape, self._k)
+        self._frame_shape = (*obs.shape[1:-1], obs.shape[-1] // self._k)
+        self._frames = np.zeros((self._capacity, *self._frame_shape), dtype=obs.dtype)
+        do_logging(f'Frame pool: shape({self._frames.shape}), type({self._frames.dtype})',
+            logger=logger)
+
+    def _to_array(self, obs):
+        if isinstance(obs, np.ndarray):
+            return obs
+        # e.g., a list of LazyFrames
+        return np.stack([np.asarray(o) for o in obs])
+
+    def _split(self, obs):
+        """ [L, H, W, k * c] -> [L, k, H, W, c] without copying """
+        obs = obs.reshape(*obs.shape[:-1], self._k, -1)
+        return np.moveaxis(obs, -2, 1)
+
+    def _match(self, x, y):
+        return np.all((x == y).reshape(x.shape[0], -1), axis=-1)
+
+    def _enlarge(self, live_min, required):
+        capacity = max(2 * self._capacity, required)
+        do_logging(f'Frame pool is enlarged from {self._capacity} to {capacity} '
+            'frames. Consider a larger frame_pool_ratio', logger=logger, level='warning')
+        frames = np.zeros((capacity, *self._frame_shape), dtype=self._frames.dtype)
+        ids = np.arange(live_min, self._n_frames)
+        frames[ids % capacity] = self._frames[ids % self._capacity]
+        self._frames = frames
+        self._capacity = capacity
@@ -0,0 +1,59 @@
+from threading import Lock
+import numpy as np
+
+
+class PriorityUpdateQueue:
+    """ Coalesces priority updates from many train steps
+
+    Updates are buffered by put and returned by flush as a single
+    update, in which duplicate indices keep the last priority put.
+    Generations of updates put without generations are -1, 
+    which means that no staleness check is done for them.
+    """
+    def __init__(self):
+        self._priorities = []
+        self._idxes = []
+        self._generations = []
+        self._locker = Lock()
+
+    def __getstate__(self):
+        # locks cannot be pickled, e.g., when a ShardedReplay 
+        # holding the queue is passed to a remote learner
+        state = self.__dict__.copy()
+        del state['_locker']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._locker = Lock()
+
+    def __len__(self):
+        return len(self._idxes)
+
+    def put(self, priorities, idxes, generations=None):
+        with self._locker:
+            self._priorities.append(np.asarray(priorities))
+            self._idxes.append(np.asarray(idxes))
+            self._generations.append(
+                np.full(np.shape(idxes), -1, np.int64) if generations is None 
+                else np.asarray(generations, np.int64))
+
+    def flush(self):
+        """ Returns (priorities, idxes, generations) with unique idxes """
+        with self._locker:
+            if not self._idxes:
+                return None
+            priorities = np.concatenate(self._priorities)
+            idxes = np.concatenate(self._idxes)
+            generations = np.concatenate(self._generations)
+            self._priorities.clear()
+            self._idxes.clear()
+            self._generations.clear()
+        # the first occurrence in the reversed order is the last one put
+        _, i = np.unique(idxes[::-1], return_index=True)
+        i = len(idxes) - 1 - i
+        priorities = priorities[i]
+        idxes = idxes[i]
+        generations = generations[i]
+
+        return priorities, idxes, generations
@@ -0,0 +1,140 @@
+from threading import Lock
+import numpy as np
+
+
+class RankTable:
+    """ Ranks slots by priority for rank-based prioritization
+
+    A slot of rank k (from 1) is sampled with probability proportional to
+    (1 / k)**alpha. We keep slots in an order sorted by priority, which is
+    re-sorted every sort_period priority updates; in between, updates
+    only change priorities, and newly written slots are put in front of
+    the order, newest first, since they usually have the top priority.
+    Overwritten slots are removed from the order when they are put in 
+    front, which only records their positions, so no slot is ranked twice.
+
+    RankTable shares the sampling interface of SumTree, where the "priority"
+    of a slot is the weight of its rank, (1 / k)**alpha. Cumulative weights
+    of ranks are precomputed, so finding a batch takes O(batch_size * log(N))
+    """
+    def __init__(self, capacity, alpha=.7, sort_period=100):
+        self._capacity = capacity
+        self._alpha = alpha
+        self._sort_period = sort_period
+
+        self._priorities = np.zeros(capacity)
+        # slots sorted by their priorities at the last sort
+        self._order = np.zeros(0, np.int64)
+        # positions of slots in the order, -1 for slots not in the order
+        self._position = np.full(capacity, -1, np.int64)
+        # sorted positions in the order of slots overwritten since the last sort,
+        # and their offsets, _removed[i] - i, which map ranks to positions
+        self._removed = np.zeros(0, np.int64)
+        self._removed_offsets = np.zeros(0, np.int64)
+        # slots written since the last sort
+        self._recent = np.zeros(max(capacity // 10, 1), np.int64)
+        self._n_recent = 0
+        self._n_updates = 0
+        # cumulative weights of ranks, i.e., _weight_cumsum[k-1] = sum_{i<=k} i**(-alpha)
+        self._weight_cumsum = np.cumsum(np.arange(
+            1, capacity+1, dtype=np.float64)**(-alpha))
+
+        # the order is replaced as a whole, the locker keeps
+        # readers from seeing an order and a mismatched _n_recent
+        self._locker = Lock()
+
+    def __len__(self):
+        return self._n_recent + len(self._order) - len(self._removed)
+
+    @property
+    def total_priorities(self):
+        n = len(self)
+        return self._weight_cumsum[n-1] if n else 0
+
+    @property
+    def container(self):
+        return self._priorities
+
+    @container.setter
+    def container(self, container):
+        assert container.shape == self._priorities.shape, \
+            (container.shape, self._priorities.shape)
+        self._priorities = container
+
+    def batch_find(self, values):
+        """ Returns (weights, idxes) of the ranks values fall in """
+        with self._locker:
+            n = len(self)
+            ranks = np.searchsorted(self._weight_cumsum[:n], values, side='right')
+            ranks = np.minimum(ranks, n-1)
+            recent = ranks < self._n_recent
+            recent_idxes = self._recent[np.maximum(self._n_recent - 1 - ranks, 0)]
+            if len(self._order):
+                # the k-th live slot in the order lies after 
+                # the removed positions i with _removed[i] - i <= k
+                order_ranks = np.maximum(ranks - self._n_recent, 0)
+                positions = order_ranks + np.searchsorted(
+                    self._removed_offsets, order_ranks, side='right')
+                order_idxes = self._order[np.minimum(positions, len(self._order)-1)]
+                idxes = np.where(recent, recent_idxes, order_idxes)
+            else:
+                idxes = recent_idxes
+        weights = (ranks + 1.)**(-self._alpha)
+
+        return weights, idxes
+
+    def insert(self, mem_idxes, priorities):
+        """ Sets priorities of newly written slots, which are ranked first until the next sort """
+        np.testing.assert_array_less(0, priorities)
+        mem_idxes = np.atleast_1d(mem_idxes)
+        with self._locker:
+            self._priorities[mem_idxes] = priorities
+            # slots already in front keep their ranks, and each slot is put once
+            mem_idxes = mem_idxes[~np.isin(mem_idxes, self._recent[:self._n_recent])]
+            _, first = np.unique(mem_idxes, return_index=True)
+            mem_idxes = mem_idxes[np.sort(first)]
+            if self._n_recent + len(mem_idxes) > len(self._recent):
+                self._sort()
+                return
+            # remove overwritten slots from the order
+            positions = self._position[mem_idxes]
+            positions = positions[positions >= 0]
+            if len(positions):
+                self._position[mem_idxes] = -1
+                self._removed = np.sort(np.concatenate([self._removed, positions]))
+                self._removed_offsets = self._removed - np.arange(len(self._removed))
+            self._recent[self._n_recent: self._n_recent+len(mem_idxes)] = mem_idxes
+            self._n_recent += len(mem_idxes)
+
+    def update(self, mem_idx, value):
+        self.batch_update(np.array([mem_idx]), np.array([value]))
+
+    def batch_update(self, mem_idxes, values):
+        """ Updates priorities, ranks are refreshed every sort_period calls """
+        np.testing.assert_array_less(0, values)
+        with self._locker:
+            self._priorities[mem_idxes] = values
+            self._n_updates += 1
+            if self._n_updates % self._sort_period == 0:
+                self._sort()
+
+    def sort(self):
+        with self._locker:
+            self._sort()
+
+    def rebuild(self, size):
+        """ Clears priorities from size on, and re-sorts the rest """
+        with self._locker:
+            self._priorities[size:] = 0
+            self._sort()
+
+    """ Implementation """
+    def _sort(self):
+        # written slots have positive priorities
+        idxes = np.nonzero(self._priorities)[0]
+        self._order = idxes[np.argsort(-self._priorities[idxes], kind='stable')]
+        self._position[:] = -1
+        self._position[self._order] = np.arange(len(self._order))
+        self._removed = np.zeros(0, np.int64)
+        self._removed_offsets = np.zeros(0, np.int64)
+        self._n_recent = 0
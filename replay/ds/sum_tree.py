@@ -6,42 +6,59 @@ class SumTree:
     """ Interface """
     def __init__(self, capacity):
         self._capacity = capacity
-        self._tree_size = capacity - 1
+        # we pad leaves to the next power of 2 so that every leaf
+        # lies at the same depth and find/update run a fixed
+        # number of vectorized steps, one per level
+        self._depth = int(np.ceil(np.log2(max(capacity, 1))))
+        self._tree_size = 2**self._depth - 1
 
-        self._container = np.zeros(int(self._tree_size + self._capacity))
+        self._container = np.zeros(int(self._tree_size + 2**self._depth))
 
-        # locker used to avoid conflict introduced by tf.data.Dataset
-        # ensuring SumTree update will not happen while sampling
-        # which may cause out-of-range sampling in data_structure.find
+        # locker used to serialize writers only. Readers are lock-free:
+        # a writer only writes positive leaves and recomputes parents
+        # bottom-up from their children, so a non-zero node never
+        # becomes zero. As find never descends into a zero subtree,
+        # a reader concurrent with a writer always ends at a written leaf
         self._locker = Lock()
 
     @property
     def total_priorities(self):
         return self._container[0]
 
+    @property
+    def container(self):
+        return self._container
+
+    @container.setter
+    def container(self, container):
+        assert container.shape == self._container.shape, \
+            (container.shape, self._container.shape)
+        self._container = container
+
     def find(self, value):
         idx = 0                 # start from the root
-        with self._locker:
-            while idx < self._tree_size:
-                left, right = 2 * idx + 1, 2 * idx + 2
-                if value <= self._container[left]:
-                    idx = left
-                else:
-                    idx = right
-                    value -= self._container[left]
+        for _ in range(self._depth):
+            left = 2 * idx + 1
+            left_value = self._container[left]
+            if value < left_value or self._container[left + 1] == 0:
+                idx = left
+            else:
+                idx = left + 1
+                value -= left_value
 
-            return self._container[idx], idx - self._tree_size
+        return self._container[idx], idx - self._tree_size
 
     def batch_find(self, values):
         """ vectorized find """
-        idxes = np.zeros_like(values, dtype=np.int32)
-        with self._locker:
-            while np.any(idxes < self._tree_size):
-                left, right = 2 * idxes + 1, 2 * idxes + 2
-                left = np.where(left < len(self._container), left, idxes)
-                right = np.where(right < len(self._container), right, idxes)
-                idxes = np.where(values <= self._container[left], left, right)
-                values = np.where(values <= self._container[left], values, values - self._container[left])
+        values = np.array(values, dtype=np.float64)
+        idxes = np.zeros(values.shape, dtype=np.int64)
+        for _ in range(self._depth):
+            left = 2 * idxes + 1
+            left_values = self._container[left]
+            go_right = np.logical_and(
+                values >= left_values, self._container[left + 1] > 0)
+            values -= left_values * go_right
+            idxes = left + go_right
 
         return self._container[idxes], idxes - self._tree_size
 
@@ -49,34 +66,32 @@ class SumTree:
         np.testing.assert_array_less(0, value)
         idx = mem_idx + self._tree_size
         with self._locker:
-            diff = value - self._container[idx]
-            self._container[idx] += diff
-
-            while idx > 0:
+            self._container[idx] = value
+            for _ in range(self._depth):
                 idx = (idx - 1) // 2    # update idx to its parent idx
-                self._container[idx] += diff
+                left = 2 * idx + 1
+                self._container[idx] = self._container[left] + self._container[left + 1]
 
     def batch_update(self, mem_idxes, values):
-        """ vectorized update """
+        """ vectorized update. For duplicate mem_idxes, the last one wins """
         np.testing.assert_array_less(0, values)
-        idxes = mem_idxes + self._tree_size
-        # if there are some i < j and idxes[i] == idxes[j], we only keep idxes[i]
-        idxes, i = np.unique(idxes, return_index=True)
-        values = values[i]
-        diffs = values - self._container[idxes]
+        idxes = np.asarray(mem_idxes, dtype=np.int64) + self._tree_size
 
         with self._locker:
-            self._container[idxes] += diffs
-            while len(idxes) > 0:
-                p_idxes = (idxes - 1) // 2  # parent idxes
-                # idx1 contains the leftmost unique index of p_idxes
-                idxes, idx1, count = np.unique(p_idxes, return_index=True, return_counts=True)
-                # idx2 contains the rightmost unique index of p_idxes
-                _, idx2 = np.unique(p_idxes[::-1], return_index=True)
-                # the following code takes the advantage of binary trees
-                diffs = (diffs[-idx2-1] + diffs[idx1]) * count / 2
+            self._container[idxes] = values
+            for _ in range(self._depth):
+                # parents are recomputed from their children,
+                # duplicate parents simply write the same sum
+                idxes = (idxes - 1) // 2
+                left = 2 * idxes + 1
+                self._container[idxes] = self._container[left] + self._container[left + 1]
 
-                # code for unbalanced binary tree to avoid negative idxes.
-                diffs = diffs[idxes >= 0]
-                idxes = idxes[idxes >= 0]
-                self._container[idxes] += diffs
+    def rebuild(self, size):
+        """ Clears leaves from size on, and recomputes all internal 
+        nodes from the leaves, e.g., after remapping a snapshot """
+        with self._locker:
+            self._container[self._tree_size + size:] = 0
+            for depth in reversed(range(self._depth)):
+                idxes = np.arange(2**depth - 1, 2**(depth+1) - 1)
+                left = 2 * idxes + 1
+                self._container[idxes] = self._container[left] + self._container[left + 1]
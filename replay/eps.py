@@ -3,10 +3,12 @@ from datetime import datetime
 import logging
 from pathlib import Path
 import random
+from threading import Lock
 import uuid
 import numpy as np
 
 from core.decorator import config
+from core.log import do_logging
 from replay.local import EnvEpisodicBuffer, EnvFixedEpisodicBuffer, \
     EnvVecFixedEpisodicBuffer
 from replay.utils import load_data, print_buffer, save_data
@@ -44,6 +46,19 @@ class EpisodicReplay:
 
         self._info_printed = False
 
+        # episodes are stored back to back in a flat arena, where
+        # self._memory keeps views of them. Positions in the arena are
+        # logical ones that only increase; the physical position of
+        # a step is its logical position minus self._arena_base
+        self._arena = {}
+        self._arena_base = 0
+        self._arena_end = 0
+        self._eps_starts = {}       # filename -> logical start
+        # an index of episodes for sampling, rebuilt after episodes change
+        self._index = None
+        # samples are drawn from a background thread
+        self._locker = Lock()
+
     def name(self):
         return self._replay_type
 
@@ -133,14 +148,15 @@ class EpisodicReplay:
             identifier = str(uuid.uuid4().hex)
             length = len(eps['reward'])
             filename = self._dir / f'{timestamp}-{identifier}-{length}.npz'
-            self._memory[filename] = eps
+            with self._locker:
+                self._write_episode(filename, eps)
             if self._save:
                 save_data(filename, eps)
-            self._filenames.append(filename)
-        if self._save:
-            self._remove_file()
-        else:
-            self._pop_episode()
+        with self._locker:
+            if self._save:
+                self._remove_file()
+            else:
+                self._pop_episode()
 
     def count_episodes(self):
         """ count the total number of episodes and transitions in the directory """
@@ -163,18 +179,23 @@ class EpisodicReplay:
     def load_data(self):
         if self._memory == {}:
             # load data from files
-            for filename in self._dir.glob('*.npz'):
+            # file names start with timestamps, so episodes are loaded in order
+            for filename in sorted(self._dir.glob('*.npz')):
                 if filename not in self._memory:
                     data = load_data(filename)
                     if data is not None:
-                        self._memory[filename] = data
+                        self._write_episode(filename, data)
             do_logging(f'{len(self)} episodes are loaded', logger=logger)
         else:
             logger.warning(f'There are already {len(self)} episodes in the memory. No further loading is performed')
 
     def sample(self, batch_size=None):
         batch_size = batch_size or self._batch_size
-        if batch_size > 1:
+        if self._sample_size:
+            data = self._sample_windows(batch_size)
+            if batch_size == 1:
+                data = {k: v[0] for k, v in data.items()}
+        elif batch_size > 1:
             samples = [self._sample() for _ in range(batch_size)]
             data = {k: np.stack([t[k] for t in samples], 0)
                 for k in samples[0].keys()}
@@ -185,35 +206,100 @@ class EpisodicReplay:
 
     def _sample(self):
         """ Samples a sequence """
+        if self._sample_size:
+            return {k: v[0] for k, v in self._sample_windows(1).items()}
         filename = random.choice(list(self._memory))
         episode = self._memory[filename]
-        if self._sample_size:
-            total = len(next(iter(episode.values())))
-            available = total - self._sample_size
-            assert available > 0, f'Skipped short episode of length {total}.' \
-                f'{[(k, np.array(v).shape) for e in self._memory.values() for k, v in e.items()]}'
-
-            i = int(random.randint(0, available))
-            episode = {k: v[i] if k in self._state_keys 
-                        else v[i: i + self._sample_size] 
-                        for k, v in episode.items()}
-        else:
-            episode = {k: v[0] if k in self._state_keys
-                        else v for k, v in episode.items()}
+        episode = {k: v[0] if k in self._state_keys
+                    else v for k, v in episode.items()}
 
         return episode
 
+    def _sample_windows(self, batch_size):
+        """ Samples batch_size sequences of length sample_size uniformly
+        from all windows in memory, and gathers them at once from the arena """
+        with self._locker:
+            if self._index is None:
+                self._build_index()
+            starts, cum_windows, n_windows = self._index
+            assert cum_windows[-1] > 0, \
+                f'No episode is longer than sample_size({self._sample_size})'
+            windows = np.random.randint(0, cum_windows[-1], size=batch_size)
+            eps = np.searchsorted(cum_windows, windows, side='right')
+            i = starts[eps] - self._arena_base \
+                + windows - (cum_windows[eps] - n_windows[eps])
+            idxes = i[:, None] + np.arange(self._sample_size)
+            data = {k: v[i] if k in self._state_keys else v[idxes]
+                for k, v in self._arena.items()}
+
+        return data
+
+    def _build_index(self):
+        filenames = list(self._eps_starts)
+        starts = np.array([self._eps_starts[f] for f in filenames], np.int64)
+        lengths = np.array([len(next(iter(self._memory[f].values()))) 
+            for f in filenames], np.int64)
+        # the number of valid starts of sequences in each episode
+        n_windows = np.maximum(lengths - self._sample_size + 1, 0)
+        self._index = (starts, np.cumsum(n_windows), n_windows)
+
+    def _write_episode(self, filename, eps):
+        """ Appends eps to the arena, and stores its views in memory """
+        length = len(next(iter(eps.values())))
+        if self._arena == {}:
+            self._arena = {k: np.zeros((length * 16, *np.shape(v)[1:]), 
+                np.asarray(v).dtype) for k, v in eps.items()}
+        capacity = len(next(iter(self._arena.values())))
+        if self._arena_end + length - self._arena_base > capacity:
+            self._reallocate_arena(length)
+        i = self._arena_end - self._arena_base
+        for k, v in eps.items():
+            self._arena[k][i: i + length] = v
+        self._memory[filename] = {k: v[i: i + length] 
+            for k, v in self._arena.items()}
+        self._eps_starts[filename] = self._arena_end
+        self._filenames.append(filename)
+        self._arena_end += length
+        self._index = None
+
+    def _reallocate_arena(self, length):
+        """ Drops the space of removed episodes, and enlarges the arena if necessary """
+        head = self._eps_starts[self._filenames[0]] \
+            if self._filenames else self._arena_end
+        live = self._arena_end - head
+        capacity = len(next(iter(self._arena.values())))
+        if 2 * (live + length) > capacity:
+            capacity = 2 * (live + length)
+            do_logging(f'Episodic arena is enlarged to {capacity} steps', logger=logger)
+            arena = {k: np.zeros((capacity, *v.shape[1:]), v.dtype) 
+                for k, v in self._arena.items()}
+        else:
+            arena = self._arena
+        for k, v in self._arena.items():
+            arena[k][:live] = v[head - self._arena_base: self._arena_end - self._arena_base]
+        self._arena = arena
+        self._arena_base = head
+        for filename, start in self._eps_starts.items():
+            i = start - self._arena_base
+            eps_len = len(next(iter(self._memory[filename].values())))
+            self._memory[filename] = {k: v[i: i + eps_len] 
+                for k, v in self._arena.items()}
+
     def _pop_episode(self):
         if len(self._memory) > self._max_episodes:
             filename = self._filenames.popleft()
             assert(filename in self._memory)
             del self._memory[filename]
+            del self._eps_starts[filename]
+            self._index = None
 
     def _remove_file(self):
         if len(self._memory) > self._max_episodes:
             filename = self._filenames.popleft()
             assert(filename in self._memory)
             del self._memory[filename]
+            del self._eps_starts[filename]
+            self._index = None
             filename.unlink()
             
     def clear_temp_bufs(self):
@@ -1,5 +1,5 @@
 from replay.uniform import UniformReplay
-from replay.per import ProportionalPER
+from replay.per import ProportionalPER, RankBasedPER
 from replay.eps import EpisodicReplay
 from replay.seq import SequentialReplay
 from replay.sper import SequentialPER
@@ -9,6 +9,7 @@ from replay.local import *
 replay_type = dict(
     uniform=UniformReplay,
     per=ProportionalPER,
+    rankper=RankBasedPER,
     episodic=EpisodicReplay,
     seq=SequentialReplay,
     seqper=SequentialPER
@@ -54,9 +55,19 @@ def create_replay_center(config, **kwargs):
     config = config.copy()
     
     plain_type = replay_type[config['replay_type']]
+    if config.get('n_shards', 1) > 1:
+        from replay.sharded import ShardedReplay
+        return ShardedReplay(plain_type, config, **kwargs)
     import ray
     ray_type = ray.remote(plain_type)
     return ray_type.remote(config, **kwargs)
+
+def get_worker_replay(replay, worker_id):
+    """ Returns the remote replay the worker writes to """
+    from replay.sharded import ShardedReplay
+    if isinstance(replay, ShardedReplay):
+        return replay.shard(worker_id)
+    return replay
     
 if __name__ == '__main__':
     config = dict(
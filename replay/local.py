@@ -61,10 +61,12 @@ class EnvNStepBuffer(NStepBuffer):
         """ Add experience to local memory """
         if self._memory == {}:
             del data['next_obs']
-            init_buffer(self._memory, pre_dims=self._memlen, has_steps=self._n_steps>1, **data)
+            init_buffer(self._memory, pre_dims=self._memlen, **data)
             print_buffer(self._memory, 'Local')
-            
-        add_buffer(self._memory, self._idx, self._n_steps, self._gamma, **data)
+        
+        # we store one-step data here, multi-step rewards are computed in retrieve
+        for k, v in self._memory.items():
+            v[self._idx] = data[k]
         self._idx = self._idx + 1
 
     def sample(self):
@@ -75,11 +77,17 @@ class EnvNStepBuffer(NStepBuffer):
         seqlen = seqlen or self._idx
         results = {}
         for k, v in self._memory.items():
-            results[k] = v[:seqlen]
+            if k not in ('reward', 'discount'):
+                results[k] = v[:seqlen]
+        results['reward'], results['discount'], steps = compute_n_steps(
+            self._memory['reward'], self._memory['discount'], seqlen, 
+            self._n_steps, self._gamma, max_steps=self._max_steps, 
+            value=self._memory.get('q', self._memory.get('v')), 
+            kl=self._memory.get('kl'), length=self._idx)
+        if self._extra_len > 1:
+            results['steps'] = steps
         if 'next_obs' not in self._memory:
-            idxes = np.arange(seqlen)
-            steps = results.get('steps', 1)
-            next_idxes = idxes + steps
+            next_idxes = np.arange(seqlen) + steps
             if isinstance(self._memory['obs'], np.ndarray):
                 results['next_obs'] = self._memory['obs'][next_idxes]
             else:
@@ -103,8 +111,7 @@ class EnvVecNStepBuffer(NStepBuffer):
         """ Add experience to local memory """
         if self._memory == {}:
             # initialize memory
-            init_buffer(self._memory, pre_dims=(self._n_envs, self._memlen), 
-                        has_steps=self._extra_len>1, **data)
+            init_buffer(self._memory, pre_dims=(self._n_envs, self._memlen), **data)
             print_buffer(self._memory, 'Local Buffer')
 
         idx = self._idx
@@ -115,8 +122,6 @@ class EnvVecNStepBuffer(NStepBuffer):
             else:
                 for i in range(self._n_envs):
                     self._memory[k][i][idx] = v[i]
-        if self._extra_len > 1:
-            self._memory['steps'][:, idx] = 1
 
         self._idx += 1
 
@@ -128,6 +133,8 @@ class EnvVecNStepBuffer(NStepBuffer):
         seqlen = seqlen or self._idx
         results = adjust_n_steps_envvec(self._memory, seqlen, 
             self._n_steps, self._max_steps, self._gamma)
+        if self._extra_len <= 1:
+            del results['steps']
         value = None
         for k, v in results.items():
             if k in ('q', 'v'):
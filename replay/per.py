@@ -4,20 +4,34 @@ from core.decorator import override
 from utility.schedule import PiecewiseSchedule
 from replay.base import Replay
 from replay.ds.sum_tree import SumTree
+from replay.ds.rank_table import RankTable
+from replay.ds.priority_queue import PriorityUpdateQueue
+from replay.utils import split_batch
 
 
 class PERBase(Replay):
-    """ Base class for PER, left in case one day I implement rank-based PER """
+    """ Base class for PER, whose _data_structure maps slots to priorities """
+    _header_attrs = Replay._header_attrs + ('_top_priority', '_sample_i')
+
     def _add_attributes(self):
         super()._add_attributes()
         self._top_priority = 1.
         self._data_structure = None            
         self._use_is_ratio = getattr(self, '_use_is_ratio', True)
+        self._return_probability = getattr(self, '_return_probability', False)
         self._beta = float(getattr(self, 'beta0', .4))
         if getattr(self, '_beta_schedule', None):
             assert isinstance(self._beta_schedule, list)
             self._beta_schedule = PiecewiseSchedule(self._beta_schedule)
         self._sample_i = 0   # count how many times self._sample is called
+        # generations[i] counts how many times slot i has been written,
+        # samples carry the generations of their slots so that priorities
+        # computed from an overwritten transition are dropped
+        self._generations = np.zeros(self._capacity, np.int64)
+        # apply priority updates every priority_update_period calls
+        self._priority_update_period = getattr(self, '_priority_update_period', 1)
+        self._priority_queue = PriorityUpdateQueue()
+        self._n_priority_updates = 0
 
     @override(Replay)
     def sample(self, batch_size=None):
@@ -32,13 +46,56 @@ class PERBase(Replay):
         return samples
 
     @override(Replay)
-    def add(self, **kwargs):
-        super().add(**kwargs)
-        # super().add updates self._mem_idx 
-        if self._n_envs == 1:
-            self._data_structure.update(self._mem_idx - 1, self._top_priority)
+    def sample_many(self, n, batch_size=None):
+        assert self.good_to_learn(), (
+            'There are not sufficient transitions to start learning --- '
+            f'transitions in buffer({len(self)}) vs '
+            f'minimum required size({self._min_size})')
+        samples = self._sample(batch_size=batch_size, n_batches=n)
+        self._sample_i += n
+        if hasattr(self, '_beta_schedule'):
+            self._update_beta()
+        return samples
+
+    @override(Replay)
+    def sampling_mass(self):
+        return self._data_structure.total_priorities if self.good_to_learn() else 0
 
-    def update_priorities(self, priorities, idxes):
+    def update_priorities(self, priorities, idxes, generations=None):
+        """ Queues priorities of sampled transitions, which are applied 
+        every priority_update_period calls. 
+        
+        Args:
+            generations: the generations returned along with idxes by 
+                sample. Priorities of slots that have been overwritten 
+                since they were sampled are dropped. No check is done if 
+                generations is None or for generations of -1
+        """
+        idxes = np.asarray(idxes)
+        if generations is None:
+            generations = self._generations[idxes]
+        else:
+            generations = np.asarray(generations)
+            generations = np.where(generations < 0, 
+                self._generations[idxes], generations)
+        # drops priorities of slots overwritten since they were sampled
+        valid = generations == self._generations[idxes]
+        self._priority_queue.put(
+            np.asarray(priorities)[valid], idxes[valid], generations[valid])
+        self._n_priority_updates += 1
+        if self._n_priority_updates % self._priority_update_period == 0:
+            self.flush_priorities()
+
+    def flush_priorities(self):
+        """ Applies all queued priority updates at once """
+        updates = self._priority_queue.flush()
+        if updates is None:
+            return
+        priorities, idxes, generations = updates
+        valid = generations == self._generations[idxes]
+        priorities, idxes = priorities[valid], idxes[valid]
+        if len(idxes) == 0:
+            return
         assert not np.any(np.isnan(priorities)), priorities
         np.testing.assert_array_less(0, priorities)
         if self._to_update_top_priority:
@@ -46,20 +103,67 @@ class PERBase(Replay):
         self._data_structure.batch_update(idxes, priorities)
 
     """ Implementation """
+    @override(Replay)
+    def _sample(self, batch_size=None, n_batches=None):
+        """ Samples a batch, or a list of n_batches batches 
+        retrieved from memory with a single gather """
+        batch_size = batch_size or self._batch_size
+        n = n_batches or 1
+        total_priorities = self._data_structure.total_priorities
+
+        intervals = np.linspace(0, total_priorities, n * batch_size+1)
+        values = np.random.uniform(intervals[:-1], intervals[1:])
+        # the i-th batch takes the i-th value of every n strata
+        # so that each batch remains stratified over all priorities
+        values = values.reshape(batch_size, n).T.reshape(-1)
+        priorities, idxes = self._data_structure.batch_find(values)
+        assert np.max(idxes) < len(self), f'idxes: {idxes}\nvalues: {values}\npriorities: {priorities}\ntotal: {total_priorities}, len: {len(self)}'
+        assert np.min(priorities) > 0, f'idxes: {idxes}\nvalues: {values}\npriorities: {priorities}\ntotal: {total_priorities}, len: {len(self)}'
+
+        probabilities = priorities / total_priorities
+
+        # generations are read before data, so that data overwritten 
+        # in between comes with a stale generation and is not updated
+        generations = self._generations[idxes]
+        samples = self._get_samples(idxes)
+        samples['idxes'] = idxes
+        samples['generation'] = generations
+        if self._return_probability:
+            samples['probability'] = probabilities
+        samples = split_batch(samples, n)
+        # compute importance sampling ratios
+        if self._use_is_ratio:
+            for s, p in zip(samples, probabilities.reshape(n, batch_size)):
+                s['IS_ratio'] = self._compute_IS_ratios(p).astype(np.float32)
+
+        return samples if n_batches else samples[0]
+
     def _update_beta(self):
         self._beta = self._beta_schedule.value(self._sample_i)
 
+    @override(Replay)
+    def _add(self, **kwargs):
+        super()._add(**kwargs)
+        # super()._add updates self._mem_idx 
+        mem_idx = (self._mem_idx - 1) % self._capacity
+        self._update_written_slots(np.array([mem_idx]), self._top_priority)
+
     @override(Replay)
     def _merge(self, local_buffer, length):    
         priority = local_buffer.pop('priority')[:length] \
             if 'priority' in local_buffer else self._top_priority * np.ones(length)
-        np.testing.assert_array_less(0, priority)
-        # update sum tree
         mem_idxes = np.arange(self._mem_idx, self._mem_idx + length) % self._capacity
-        self._data_structure.batch_update(mem_idxes, priority)
-        # update memory
+        # update memory before sum tree so that lock-free sampling
+        # never sees a priority for a slot that holds no data yet
         super()._merge(local_buffer, length)
-        
+        self._update_written_slots(mem_idxes, priority)
+
+    def _update_written_slots(self, mem_idxes, priorities):
+        """ Sets priorities of newly written slots """
+        np.testing.assert_array_less(0, priorities)
+        self._generations[mem_idxes] += 1
+        self._data_structure.batch_update(mem_idxes, priorities)
+
     def _compute_IS_ratios(self, probabilities):
         """
         w = (N * p)**(-beta)
@@ -71,6 +175,25 @@ class PERBase(Replay):
 
         return IS_ratios
 
+    """ Memory-Mapped Memory """
+    @override(Replay)
+    def _extra_memmap_arrays(self):
+        return {'generations': self._generations}
+
+    @override(Replay)
+    def _set_extra_memmap_arrays(self, arrays):
+        if 'generations' in arrays:
+            self._generations = arrays['generations']
+
+    @override(Replay)
+    def _restore_memmap(self):
+        restored = super()._restore_memmap()
+        if restored:
+            # the snapshot may hold priorities written after the header, 
+            # we drop those of unwritten slots and rebuild the rest
+            self._data_structure.rebuild(len(self))
+        return restored
+
 
 class ProportionalPER(PERBase):
     """ Interface """
@@ -78,25 +201,45 @@ class ProportionalPER(PERBase):
         super()._add_attributes()
         self._data_structure = SumTree(self._capacity)        # mem_idx    -->     priority
 
-    """ Implementation """
+    """ Memory-Mapped Memory """
     @override(PERBase)
-    def _sample(self, batch_size=None):
-        batch_size = batch_size or self._batch_size
-        total_priorities = self._data_structure.total_priorities
+    def _extra_memmap_arrays(self):
+        arrays = super()._extra_memmap_arrays()
+        arrays['priority_tree'] = self._data_structure.container
+        return arrays
 
-        intervals = np.linspace(0, total_priorities, batch_size+1)
-        values = np.random.uniform(intervals[:-1], intervals[1:])
-        priorities, idxes = self._data_structure.batch_find(values)
-        assert np.max(idxes) < len(self), f'idxes: {idxes}\nvalues: {values}\npriorities: {priorities}\ntotal: {total_priorities}, len: {len(self)}'
-        assert np.min(priorities) > 0, f'idxes: {idxes}\nvalues: {values}\npriorities: {priorities}\ntotal: {total_priorities}, len: {len(self)}'
+    @override(PERBase)
+    def _set_extra_memmap_arrays(self, arrays):
+        super()._set_extra_memmap_arrays(arrays)
+        if 'priority_tree' in arrays:
+            self._data_structure.container = arrays['priority_tree']
 
-        probabilities = priorities / total_priorities
 
-        # compute importance sampling ratios
-        samples = self._get_samples(idxes)
-        samples['idxes'] = idxes
-        if self._use_is_ratio:
-            IS_ratios = self._compute_IS_ratios(probabilities)
-            samples['IS_ratio'] = IS_ratios.astype(np.float32)
+class RankBasedPER(PERBase):
+    """ Interface """
+    def _add_attributes(self):
+        super()._add_attributes()
+        # ranks are given by priorities, whose exponent does not matter here.
+        # Instead, the probability of rank k is proportional to (1 / k)**rank_alpha
+        self._data_structure = RankTable(self._capacity, 
+            alpha=getattr(self, '_rank_alpha', .7),
+            sort_period=getattr(self, '_sort_period', 100))   # mem_idx    -->     rank
 
-        return samples
+    """ Memory-Mapped Memory """
+    @override(PERBase)
+    def _extra_memmap_arrays(self):
+        arrays = super()._extra_memmap_arrays()
+        arrays['priorities'] = self._data_structure.container
+        return arrays
+
+    @override(PERBase)
+    def _set_extra_memmap_arrays(self, arrays):
+        super()._set_extra_memmap_arrays(arrays)
+        if 'priorities' in arrays:
+            self._data_structure.container = arrays['priorities']
+
+    """ Implementation """
+    @override(PERBase)
+    def _update_written_slots(self, mem_idxes, priorities):
+        self._generations[mem_idxes] += 1
+        self._data_structure.insert(mem_idxes, priorities)
@@ -1,8 +1,8 @@
 import logging
-import collections
 import numpy as np
 
 from replay.uniform import UniformReplay
+from replay.utils import print_buffer
 
 
 logger = logging.getLogger(__name__)
@@ -10,9 +10,13 @@ logger = logging.getLogger(__name__)
 class SequentialBase:
     """ Construction """
     def _add_attributes(self, state_keys=None):
+        super()._add_attributes()
         self._state_keys = state_keys or getattr(self, '_state_keys', [])
-        self._memory = collections.deque(maxlen=self._capacity)
-        self._first = True
+        # memory is a dict of preallocated arrays, each of shape
+        #   [capacity, ...] for state_keys,
+        #   [capacity, sample_size+1, ...] for extra_keys,
+        #   [capacity, sample_size, ...] for the others
+        self._memory = {}
 
     def _construct_temp_buff(self):
         from replay.func import create_local_buffer
@@ -24,9 +28,6 @@ class SequentialBase:
             'extra_keys': self._extra_keys,
         })
 
-    def __len__(self):
-        return len(self._memory)
-
     def clear_temp_buffer(self):
         self._tmp_buf.clear()
 
@@ -43,47 +44,48 @@ class SequentialBase:
             local_buffer: either a list/tuple of dicts across multiple timesteps
                 or a dict of data at a single timestep
         """
+        is_per = self._replay_type.endswith('per')
         if isinstance(local_buffer, (list, tuple)):
             length = len(local_buffer)
-            mem_idxes = np.arange(self._mem_idx, self._mem_idx + length) % self._capacity
-            if self._replay_type.endswith('per'):
+            if is_per:
                 priorities = np.array([b.pop('priority', self._top_priority) for b in local_buffer])
-                np.testing.assert_array_less(0, priorities)
-                self._data_structure.batch_update(mem_idxes, priorities)
-            self._memory.extend(local_buffer)
-            self._mem_idx = self._mem_idx + length
+            data = {k: np.stack([b[k] for b in local_buffer]) for k in local_buffer[0]}
         else:
-            if self._replay_type.endswith('per'):
-                priority = local_buffer.pop('priority', self._top_priority)
-                assert priority > 0, priority
-                self._data_structure.update(self._mem_idx, priority)
-            self._memory.append(local_buffer)
-            self._mem_idx = self._mem_idx + 1
-        if self._first:
-            do_logging('First sample', logger=logger)
-            for k, v in self._memory[0].items():
-                do_logging(f'\t{k}, {v.shape}, {v.dtype}', logger=logger)
-            self._first = False
+            length = 1
+            if is_per:
+                priorities = np.array([local_buffer.pop('priority', self._top_priority)])
+            data = {k: np.expand_dims(v, 0) for k, v in local_buffer.items()}
+        mem_idxes = np.arange(self._mem_idx, self._mem_idx + length) % self._capacity
+
+        if self._memory == {}:
+            self._init_memory(data)
+        for k, v in self._memory.items():
+            v[mem_idxes] = data[k]
+        # update sum tree after memory so that sampling never sees empty slots
+        if is_per:
+            self._update_written_slots(mem_idxes, priorities)
+        self._mem_idx = self._mem_idx + length
         
         if not self._is_full and self._mem_idx >= self._capacity:
-            print(f'Memory is full({len(self)})')
             self._is_full = True
+            print(f'Memory is full({len(self)})')
         self._mem_idx = self._mem_idx % self._capacity
+        self._maybe_snapshot()
 
-    def _get_samples(self, idxes):
-        assert len(idxes) == self._batch_size, idxes
-        results = collections.defaultdict(list)
-        [results[k].append(v) for i in idxes for k, v in self._memory[i].items()]
-        results = {k: np.stack(v) for k, v in results.items()}
-        for k, v in results.items():
-            if k in self._state_keys:
-                assert v.shape[0] == self._batch_size, (k, v.shape)
-            elif k in self._extra_keys:
-                assert v.shape[:2] == (self._batch_size, self._sample_size+1), (k, v.shape)
-            else:
-                assert v.shape[:2] == (self._batch_size, self._sample_size), (k, v.shape)
+    def _init_memory(self, data):
+        for k, v in data.items():
+            if k in self._extra_keys:
+                assert v.shape[1] == self._sample_size+1, (k, v.shape)
+            elif k not in self._state_keys:
+                assert v.shape[1] == self._sample_size, (k, v.shape)
+        self._memory = {k: np.zeros((self._capacity, *v.shape[1:]), v.dtype)
+            for k, v in data.items()}
+        print_buffer(self._memory, 'Sequential')
+        if self._memmap:
+            self._create_memmap()
 
-        return results
+    def _get_samples(self, idxes):
+        return {k: v[idxes] for k, v in self._memory.items()}
 
 class SequentialReplay(SequentialBase, UniformReplay):
     def __init__(self, config, state_keys=None):
@@ -0,0 +1,127 @@
+import logging
+import time
+import numpy as np
+import ray
+
+from utility.utils import to_int
+from utility.schedule import PiecewiseSchedule
+from replay.ds.priority_queue import PriorityUpdateQueue
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedReplay:
+    """ A replay center split into n_shards remote replays
+
+    Each shard owns capacity // n_shards slots and its own sampling
+    structure (e.g., SumTree). Workers write to their own shard, given
+    by shard(worker_id). Sampling draws shard-proportional sub-batches
+    and returns global indices, shard_id * shard_capacity + local index,
+    so that update_priorities can route priorities back to shards.
+
+    ShardedReplay itself lives in the learner process and exposes the
+    synchronous replay interface, so it plugs into core.dataset.Dataset.
+    """
+    def __init__(self, ReplayType, config, **kwargs):
+        config = config.copy()
+        self._n_shards = config.pop('n_shards')
+        self._batch_size = config['batch_size']
+        self._min_size = to_int(config['min_size'])
+        self._beta = float(config.get('beta0', .4))
+        self._beta_schedule = config.get('beta_schedule', None)
+        if self._beta_schedule:
+            self._beta_schedule = PiecewiseSchedule(self._beta_schedule)
+        self._sample_i = 0
+        self._sleep_time = 0.025
+        self._use_is_ratio = config.get('use_is_ratio', True)
+        # priority updates are coalesced here, shards apply them at once
+        self._priority_update_period = config.pop('priority_update_period', 1)
+        self._priority_queue = PriorityUpdateQueue()
+        self._n_priority_updates = 0
+
+        self._shard_capacity = to_int(config['capacity']) // self._n_shards
+        config['capacity'] = self._shard_capacity
+        config['min_size'] = max(1, self._min_size // self._n_shards)
+        # shards are sampled with sub-batches whose sizes vary across calls
+        config['batch_size'] = -(-self._batch_size // self._n_shards)
+        # shards return per-sample probabilities so that
+        # IS ratios can be computed across shards
+        config['return_probability'] = True
+        RemoteReplay = ray.remote(ReplayType)
+        self._shards = []
+        for i in range(self._n_shards):
+            shard_config = config.copy()
+            if 'dir' in config:
+                shard_config['dir'] = f'{config["dir"]}/shard{i}'
+            self._shards.append(RemoteReplay.remote(shard_config, **kwargs))
+        # sampling masses of shards, refreshed along with each sample
+        self._mass_refs = [s.sampling_mass.remote() for s in self._shards]
+
+    def name(self):
+        return ray.get(self._shards[0].name.remote())
+
+    def shard(self, i):
+        """ Returns the shard workers with id i write to """
+        return self._shards[i % self._n_shards]
+
+    def size(self):
+        return sum(ray.get([s.size.remote() for s in self._shards]))
+
+    def __len__(self):
+        return self.size()
+
+    def good_to_learn(self):
+        return self.size() >= self._min_size \
+            and any(ray.get([s.good_to_learn.remote() for s in self._shards]))
+
+    def sample(self, batch_size=None):
+        batch_size = batch_size or self._batch_size
+        # masses are at most one sample stale, which saves a round trip
+        masses = np.array(ray.get(self._mass_refs), dtype=np.float64)
+        while masses.sum() == 0:
+            time.sleep(self._sleep_time)
+            masses = np.array(ray.get(
+                [s.sampling_mass.remote() for s in self._shards]), dtype=np.float64)
+        shard_probs = masses / masses.sum()
+        sizes = np.random.multinomial(batch_size, shard_probs)
+        shard_ids = np.nonzero(sizes)[0]
+        sample_refs = [self._shards[i].sample.remote(int(sizes[i])) for i in shard_ids]
+        self._mass_refs = [s.sampling_mass.remote() for s in self._shards]
+        samples = ray.get(sample_refs)
+
+        data = {k: np.concatenate([s[k] for s in samples])
+            for k in samples[0].keys()}
+        shard_of_sample = np.repeat(shard_ids, sizes[shard_ids])
+        if 'idxes' in data:
+            data['idxes'] = data['idxes'] + shard_of_sample * self._shard_capacity
+        if 'probability' in data:
+            # the probability of a sample across all shards
+            probs = data.pop('probability') * shard_probs[shard_of_sample]
+            data.pop('IS_ratio', None)
+            if self._use_is_ratio:
+                IS_ratios = (np.min(probs) / probs)**self._beta
+                data['IS_ratio'] = IS_ratios.astype(np.float32)
+        self._sample_i += 1
+        if self._beta_schedule:
+            self._beta = self._beta_schedule.value(self._sample_i)
+
+        return data
+
+    def update_priorities(self, priorities, idxes, generations=None):
+        self._priority_queue.put(priorities, idxes, generations)
+        self._n_priority_updates += 1
+        if self._n_priority_updates % self._priority_update_period != 0:
+            return
+        priorities, idxes, generations = self._priority_queue.flush()
+        shard_ids = idxes // self._shard_capacity
+        local_idxes = idxes % self._shard_capacity
+        for i in np.unique(shard_ids):
+            mask = shard_ids == i
+            self._shards[i].update_priorities.remote(
+                priorities[mask], local_idxes[mask], generations[mask])
+
+    def merge(self, local_buffer, worker_id=0):
+        self.shard(worker_id).merge.remote(local_buffer)
+
+    def save(self):
+        ray.get([s.save.remote() for s in self._shards])
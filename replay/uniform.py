@@ -2,6 +2,7 @@ import numpy as np
 
 from core.decorator import override
 from replay.base import Replay
+from replay.utils import split_batch
 
 
 class UniformReplay(Replay):
@@ -10,12 +11,24 @@ class UniformReplay(Replay):
         assert self.good_to_learn(), (
             'There are not sufficient transitions to start learning --- '
             f'transitions in buffer({len(self)}) vs '
-            f'minimum required size({self.min_size})')
+            f'minimum required size({self._min_size})')
 
         samples = self._sample(batch_size)
 
         return samples
 
+    @override(Replay)
+    def sample_many(self, n, batch_size=None):
+        assert self.good_to_learn(), (
+            'There are not sufficient transitions to start learning --- '
+            f'transitions in buffer({len(self)}) vs '
+            f'minimum required size({self._min_size})')
+        batch_size = batch_size or self._batch_size
+        # retrieves all batches with a single gather
+        samples = self._sample(n * batch_size)
+
+        return split_batch(samples, n)
+
     """ Implementation """
     @override(Replay)
     def _sample(self, batch_size=None):
@@ -1,4 +1,6 @@
+import json
 import logging
+import os
 import numpy as np
 
 from core.log import do_logging
@@ -35,16 +37,21 @@ def add_buffer(buffer, idx, n_steps, gamma, cycle=False, **data):
             buffer[k][idx] = data[k]
 
     # Update previous experience if multi-step is required
-    for i in range(1, n_steps):
-        k = idx - i
-        if (k < 0 and not cycle) or buffer['discount'][k] == 0:
-            break
-        buffer['reward'][k] += gamma**i * data['reward']
-        buffer['discount'][k] = data['discount']
+    if n_steps > 1:
+        offsets = np.arange(1, n_steps)
+        prev_idxes = idx - offsets
+        if not cycle:
+            offsets = offsets[prev_idxes >= 0]
+            prev_idxes = prev_idxes[prev_idxes >= 0]
+        # stop at the first previous step that ends an episode
+        alive = np.cumprod(buffer['discount'][prev_idxes] != 0).astype(bool)
+        offsets, prev_idxes = offsets[alive], prev_idxes[alive]
+        buffer['reward'][prev_idxes] += gamma**offsets * data['reward']
+        buffer['discount'][prev_idxes] = data['discount']
         if 'steps' in buffer:
-            buffer['steps'][k] += 1
+            buffer['steps'][prev_idxes] += 1
         if 'next_obs' in buffer:
-            buffer['next_obs'][k] = data['next_obs']
+            buffer['next_obs'][prev_idxes] = data['next_obs']
 
 
 def copy_buffer(dest_buffer, dest_start, dest_end, orig_buffer, 
@@ -89,73 +96,99 @@ def print_buffer(buffer, prefix=''):
         do_logging(f'\t{k}: shape({shape}), type({dtype})', logger=logger)
 
 
+def compute_n_steps(reward, discount, seqlen, n_steps, gamma, 
+        max_steps=0, value=None, kl=None, length=None):
+    """ Computes multi-step rewards of the first seqlen steps at once
+
+    We loop over the step offset j rather than over steps so that each 
+    iteration is a vectorized operation on the whole [..., seqlen] block. 
+    Steps after n_steps are taken only if they increase the bootstrapped 
+    return estimated by value, up to max_steps.
+
+    Args:
+        reward, discount, value, kl: [..., T], one-step data
+        length: the number of valid steps in T, steps beyond which 
+            are never used. Defaults to T
+    Returns:
+        reward, discount, steps: [..., seqlen]. The next observation 
+            of step i is next_obs[..., i + steps - 1], or obs[..., i + steps]
+    """
+    length = reward.shape[-1] if length is None else length
+    max_steps = max(n_steps, max_steps)
+    assert max_steps <= n_steps or value is not None, \
+        'value is required when max_steps > n_steps'
+    reward_kl = reward if kl is None else reward - kl
+    idxes = np.arange(seqlen)
+
+    def shift(x, j):
+        return x[..., np.minimum(idxes + j, x.shape[-1] - 1)]
+
+    results_reward = reward[..., :seqlen].copy()
+    results_discount = discount[..., :seqlen].copy()
+    steps = np.ones(results_reward.shape, np.uint8)
+    cond = np.ones(results_reward.shape, bool)
+    for j in range(1, max_steps):
+        # once a step is rejected, or an episode ends, no further step is taken
+        cond = cond & (results_discount == 1) & (idxes + j < length)
+        if not np.any(cond):
+            break
+        cum_rew = results_reward + gamma**j * shift(reward_kl, j)
+        if j >= n_steps:
+            cond = cond & (idxes + j + 1 < length) & (
+                cum_rew + gamma**(j+1) * shift(value, j+1) * shift(discount, j+1)
+                > results_reward + gamma**j * shift(value, j) * shift(discount, j))
+        results_reward = np.where(cond, cum_rew, results_reward)
+        results_discount = np.where(cond, shift(discount, j), results_discount)
+        steps += cond.astype(np.uint8)
+
+    return results_reward, results_discount, steps
+
+
+def _adjust_n_steps(data, seqlen, n_steps, max_steps, gamma):
+    reward, discount, steps = compute_n_steps(
+        data['reward'], data['discount'], seqlen, n_steps, gamma, 
+        max_steps=max_steps, value=data.get('q', data.get('v')), 
+        kl=data.get('kl'))
+    results = {k: v for k, v in data.items() 
+        if k not in ('q', 'v', 'kl', 'reward', 'discount', 'steps')}
+    results['reward'] = reward
+    results['discount'] = discount
+    results['steps'] = steps
+
+    return results
+
+
 def adjust_n_steps(data, seqlen, n_steps, max_steps, gamma):
-    results = {}
-    kl = data.get('kl', np.zeros_like(data['reward']))
-    for k, v in data.items():
-        if k == 'q' or k == 'v':
-            vs = v
-        elif k == 'kl':
-            continue
-        else:
-            results[k] = v.copy()[:seqlen]
-    if max_steps < n_steps:
-        max_steps = n_steps
-    reward_kl = data['reward'] - kl
-    for i in range(seqlen):
-        for j in range(1, max_steps):
-            if results['discount'][i] == 1:
-                cum_rew = results['reward'][i] + gamma**j * reward_kl
-                if j >= n_steps and cum_rew + gamma**(j+1) * vs[i+j+1] * data['discount'][i+j+1] \
-                    <= results['reward'][i] + gamma**j * vs[i+j] * data['discount'][i+j]:
-                    break
-                results['reward'][i] = cum_rew
-                results['next_obs'][i] = data['next_obs'][i+j]
-                results['discount'][i] = data['discount'][i+j]
-                results['steps'][i] += 1
+    results = _adjust_n_steps(data, seqlen, n_steps, max_steps, gamma)
+    next_idxes = np.arange(seqlen) + results['steps'] - 1
+    for k, v in results.items():
+        if k == 'next_obs':
+            results[k] = v[next_idxes]
+        elif k not in ('reward', 'discount', 'steps'):
+            results[k] = v[:seqlen].copy()
 
     return results
 
 
 def adjust_n_steps_envvec(data, seqlen, n_steps, max_steps, gamma):
-    # we do forward update since updating discount in a backward pass is problematic when max_steps > n_steps
-    results = {}
-    kl = data.get('kl', np.zeros_like(data['reward']))
-    for k, v in data.items():
-        if k == 'q' or k == 'v':
-            vs = v
-        elif k == 'kl':
-            continue
-        else:
-            results[k] = v.copy()[:, :seqlen]
-    obs_exp_dims = tuple(range(1, data['obs'].ndim-1))
-    if max_steps < n_steps:
-        max_steps = n_steps
-    reward_kl = data['reward'] - kl
-    for i in range(seqlen):
-        disc = results['discount'][:, i]
-        for j in range(1, max_steps):
-            cum_rew = results['reward'][:, i] + gamma**j * reward_kl[:, i+j] * disc
-            if j < n_steps:
-                cond = disc == 1
-            else:
-                cond = np.logical_and(cond, disc == 1)
-                cond = np.logical_and(
-                    cond, cum_rew + gamma**(j+1) * vs[:, i+j+1] * data['discount'][:, i+j+1] \
-                        > results['reward'][:, i] + gamma**j * vs[:, i+j] * data['discount'][:, i+j]
-                )
-            results['reward'][:, i] = np.where(
-                cond, cum_rew, results['reward'][:, i])
-            results['next_obs'][:, i] = np.where(
-                np.expand_dims(cond, obs_exp_dims), data['next_obs'][:, i+j], results['next_obs'][:, i])
-            results['discount'][:, i] = np.where(
-                cond, data['discount'][:, i+j], disc)
-            results['steps'][:, i] += np.where(
-                cond, np.ones_like(cond, dtype=np.uint8), np.zeros_like(cond, dtype=np.uint8))
+    results = _adjust_n_steps(data, seqlen, n_steps, max_steps, gamma)
+    env_idxes = np.arange(results['steps'].shape[0])[:, None]
+    next_idxes = np.arange(seqlen) + results['steps'] - 1
+    for k, v in results.items():
+        if k == 'next_obs':
+            results[k] = v[env_idxes, next_idxes]
+        elif k not in ('reward', 'discount', 'steps'):
+            results[k] = v[:, :seqlen].copy()
         
     return results
 
 
+def split_batch(data, n):
+    """ Splits a batch of n * batch_size samples into n batches """
+    data = {k: v.reshape(n, -1, *v.shape[1:]) for k, v in data.items()}
+    return [{k: v[i] for k, v in data.items()} for i in range(n)]
+
+
 def load_data(filename):
     data = None
     try:
@@ -170,3 +203,49 @@ def load_data(filename):
 def save_data(filename, data):
     with filename.open('wb') as f:
         np.savez_compressed(f, **data)
+
+
+def create_memmap(directory, buffer):
+    """ Replaces arrays in buffer with memory-mapped .npy files in directory """
+    directory.mkdir(parents=True, exist_ok=True)
+    for k, v in buffer.items():
+        assert isinstance(v, np.ndarray), \
+            f'Cannot memory-map {k} of type {type(v)}'
+        mm = np.lib.format.open_memmap(
+            directory / f'{k}.npy', mode='w+', dtype=v.dtype, shape=v.shape)
+        # files are zero-filled, copying zeros only dirties pages
+        if np.any(v):
+            mm[:] = v
+        buffer[k] = mm
+
+
+def load_memmap(directory, keys):
+    """ Maps .npy files in directory without reading them into memory """
+    return {k: np.lib.format.open_memmap(directory / f'{k}.npy', mode='r+')
+        for k in keys}
+
+
+def flush_memmap(buffer):
+    for v in buffer.values():
+        if isinstance(v, np.memmap):
+            v.flush()
+
+
+def save_header(directory, header):
+    """ Atomically writes header so that a crash leaves either 
+    the previous or the new header on disk """
+    filename = directory / 'header.json'
+    tmp_filename = directory / 'header.json.tmp'
+    with tmp_filename.open('w') as f:
+        json.dump(header, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def load_header(directory):
+    filename = directory / 'header.json'
+    if not filename.exists():
+        return None
+    with filename.open('r') as f:
+        return json.load(f)
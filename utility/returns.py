@@ -0,0 +1,183 @@
+""" Advantages and returns computed by a linear recurrence along time
+
+Every function here reduces to linear_scan, which scans
+    y[t] = x[t] + a[t] * y[t+1]
+over the time axis of arrays of arbitrary leading/trailing dimensions,
+e.g., [n_envs, T] for PPO or [n_envs, T, n_agents] for MAPPO, in one call.
+Two backends are available:
+    numpy: a blocked recurrence. Time is split into blocks of about
+        sqrt(T) steps, which are scanned in parallel with zero carry,
+        and the carries between blocks are resolved recursively.
+        This requires about 2sqrt(T) vectorized steps instead of T.
+    tf: tf.scan compiled by tf.function
+"""
+import numpy as np
+import tensorflow as tf
+
+from utility.utils import moments, standardize
+
+
+# sequences shorter than this are scanned step by step
+MIN_BLOCKED_LEN = 64
+
+
+def _reverse_scan_numpy(x, a, init):
+    """ Scans along the first axis, where y[T] = init """
+    T = x.shape[0]
+    if T < MIN_BLOCKED_LEN:
+        y = np.empty_like(x)
+        next_y = init
+        for t in reversed(range(T)):
+            y[t] = next_y = x[t] + a[t] * next_y
+        return y
+
+    block = int(np.ceil(np.sqrt(T)))
+    n_blocks = -(-T // block)
+    pad = n_blocks * block - T
+    if pad:
+        # padded steps carry init unchanged to the last step
+        x = np.concatenate([x, np.zeros((pad, *x.shape[1:]), x.dtype)])
+        a = np.concatenate([a, np.ones((pad, *a.shape[1:]), a.dtype)])
+    x = x.reshape(n_blocks, block, *x.shape[1:])
+    a = a.reshape(n_blocks, block, *a.shape[1:])
+
+    # scan all blocks with zero carry, recording the products
+    # of coefficients from each step to the end of the block
+    local = np.empty_like(x)
+    decay = np.empty_like(a)
+    y, g = 0, 1
+    for i in reversed(range(block)):
+        local[:, i] = y = x[:, i] + a[:, i] * y
+        decay[:, i] = g = a[:, i] * g
+    # y at the first step of each block
+    start = _reverse_scan_numpy(local[:, 0], decay[:, 0], init)
+    carry = np.concatenate([start[1:], init[None]])
+    y = local + decay * np.expand_dims(carry, 1)
+
+    return y.reshape(n_blocks * block, *y.shape[2:])[:T]
+
+
+@tf.function(experimental_relax_shapes=True)
+def _reverse_scan_tf(x, a, init):
+    """ Scans along the first axis, where y[T] = init """
+    return tf.scan(
+        lambda y, xa: xa[0] + xa[1] * y,
+        (x, a), initializer=init, reverse=True)
+
+
+def linear_scan(x, a, init=0, axis=0, reverse=True, backend='numpy'):
+    """ Computes y[t] = x[t] + a[t] * y[t+1] along axis, where y[T] = init,
+    or y[t] = x[t] + a[t] * y[t-1], where y[-1] = init, if not reverse
+
+    Args:
+        x: inputs
+        a: coefficients, broadcastable to x
+        init: the carry beyond the sequence, broadcastable
+            to x without axis
+        backend: numpy or tf
+    """
+    x = np.asarray(x)
+    if not np.issubdtype(x.dtype, np.floating):
+        x = x.astype(np.float32)
+    a = np.broadcast_to(np.asarray(a, dtype=x.dtype), x.shape)
+    x = np.moveaxis(x, axis, 0)
+    a = np.moveaxis(a, axis, 0)
+    init = np.broadcast_to(np.asarray(init, dtype=x.dtype), x.shape[1:])
+    if not reverse:
+        x, a = x[::-1], a[::-1]
+
+    if backend == 'numpy':
+        y = _reverse_scan_numpy(x, a, init)
+    elif backend == 'tf':
+        y = _reverse_scan_tf(x, a, init).numpy()
+    else:
+        raise ValueError(f'Unknown backend: {backend}')
+
+    if not reverse:
+        y = y[::-1]
+    return np.moveaxis(y, 0, axis)
+
+
+def discounted_sum(reward, discount, gamma, last=0, axis=0, backend='numpy'):
+    """ Computes ret[t] = reward[t] + gamma * discount[t] * ret[t+1] """
+    return linear_scan(reward, gamma * discount, last,
+        axis=axis, backend=backend)
+
+
+def length_mask(lengths, T, ndim):
+    """ Returns a mask of shape [B, T, 1, ...] of ndim dimensions,
+    where steps beyond the lengths of trajectories are False """
+    mask = np.arange(T) < np.expand_dims(lengths, 1)
+    return mask.reshape(*mask.shape, *(1,)*(ndim - 2))
+
+
+def compute_nae(reward, discount, value, last_value, gamma,
+        mask=None, epsilon=1e-8, axis=1, backend='numpy'):
+    traj_ret = discounted_sum(reward, discount, gamma, last_value,
+        axis=axis, backend=backend)
+
+    # Standardize traj_ret and advantages
+    traj_ret_mean, traj_ret_var = moments(traj_ret)
+    traj_ret_std = np.maximum(np.sqrt(traj_ret_var), 1e-8)
+    value = standardize(value, mask=mask, epsilon=epsilon)
+    # To have the same mean and std as trajectory return
+    value = (value + traj_ret_mean) / traj_ret_std
+    advantage = standardize(traj_ret - value, mask=mask, epsilon=epsilon)
+    traj_ret = standardize(traj_ret, mask=mask, epsilon=epsilon)
+
+    return advantage, traj_ret
+
+
+def compute_gae(reward, discount, value, last_value, gamma,
+        gae_discount, norm_adv=False, mask=None, epsilon=1e-8,
+        lengths=None, axis=1, backend='numpy'):
+    """ Computes GAE advantages and returns along axis
+
+    Args:
+        reward, discount: rewards and discounts, of shape [B, T, ...]
+            with axis=1, or with time at the given axis otherwise
+        value: values of the same shape, or with T+1 steps along
+            axis if last_value is None
+        last_value: values following the last steps, with axis removed
+        norm_adv: standardizes advantages if True
+        mask: life mask of the same shape as reward,
+            zero entries are excluded from standardization
+        lengths: lengths of trajectories, of shape [B]. Steps beyond
+            are padding, on which zeros are returned. Requires axis=1
+    """
+    reward, discount, value = [np.moveaxis(x, axis, 0)
+        for x in (reward, discount, value)]
+    if last_value is not None:
+        next_value = np.concatenate(
+            [value[1:], np.expand_dims(last_value, 0)], axis=0)
+    else:
+        next_value = value[1:]
+        value = value[:-1]
+    assert value.shape == next_value.shape, (value.shape, next_value.shape)
+    if lengths is not None:
+        assert axis == 1, axis
+        valid = np.moveaxis(length_mask(lengths, reward.shape[0], reward.ndim), 1, 0)
+        if last_value is not None:
+            # bootstrap from last_value at the end of each trajectory
+            idxes = np.arange(len(lengths))
+            next_value[lengths-1, idxes] = last_value
+    delta = reward + discount * gamma * next_value - value
+    if lengths is not None:
+        delta = np.where(valid, delta, 0)
+    advs = linear_scan(delta, discount * gae_discount,
+        axis=0, backend=backend)
+    traj_ret = advs + value
+    if lengths is not None:
+        traj_ret = np.where(valid, traj_ret, 0)
+    advs = np.moveaxis(advs, 0, axis)
+    traj_ret = np.moveaxis(traj_ret, 0, axis)
+    if norm_adv:
+        if lengths is not None:
+            valid = np.broadcast_to(
+                length_mask(lengths, advs.shape[1], advs.ndim), advs.shape)
+            mask = valid if mask is None else np.logical_and(valid, mask)
+        if mask is not None:
+            mask = np.asarray(mask, dtype=np.float32)
+        advs = standardize(advs, mask=mask, epsilon=epsilon)
+
+    return advs, traj_ret
@@ -2,16 +2,23 @@ import collections
 import logging
 import numpy as np
 
+from utility.utils import batch_dicts
+
 logger = logging.getLogger(__name__)
 
 class RunMode:
     NSTEPS='nsteps'
     TRAJ='traj'
+    # steps environments asynchronously, see Runner._run_async_envvec
+    ASYNC='async'
+    # writes data into the step slots of a buffer, see Runner._run_slots_envvec
+    SLOTS='slots'
 
 
 class Runner:
     def __init__(self, env, agent, step=0, nsteps=None, 
-                run_mode=RunMode.NSTEPS, record_envs=None, info_func=None):
+                run_mode=RunMode.NSTEPS, record_envs=None, info_func=None,
+                min_ready=None, max_lag=2):
         self.env = env
         if env.max_episode_steps == int(1e9):
             logger.info(f'Maximum episode steps is not specified'
@@ -19,6 +26,7 @@ class Runner:
             # assert nsteps is not None
         self.agent = agent
         self.step = step
+        self.run_mode = run_mode
         if run_mode == RunMode.TRAJ and env.env_type == 'EnvVec':
             logger.warning('Runner.step is not the actual environment steps '
                 f'as run_mode == {RunMode.TRAJ} and env_type == EnvVec')
@@ -30,7 +38,25 @@ class Runner:
             f'{RunMode.NSTEPS}-EnvVec': self._run_envvec,
             f'{RunMode.TRAJ}-Env': self._run_traj_env,
             f'{RunMode.TRAJ}-EnvVec': self._run_traj_envvec,
+            f'{RunMode.ASYNC}-EnvVec': self._run_async_envvec,
+            f'{RunMode.SLOTS}-EnvVec': self._run_slots_envvec,
         }[f'{run_mode}-{self.env.env_type}']
+        if run_mode == RunMode.ASYNC:
+            assert hasattr(self.env, 'step_async'), \
+                f'{type(self.env)} does not support asynchronous steps'
+            # the number of environments for which we compute actions at a time
+            self._min_ready = min_ready or max(self.env.n_envs // 2, 1)
+            # the number of transitions an environment may run ahead of the slowest one
+            self._max_lag = max_lag
+            self._transitions = [collections.deque() for _ in range(self.env.n_envs)]
+            self._ready_envs = list(range(self.env.n_envs))
+            self._actions = None
+            self._terms = {}
+            # env_output is updated in place for ready environments, 
+            # which must not alias the environment's own output
+            self.env_output = type(self.env_output)(*[
+                {k: np.array(v) for k, v in o.items()} 
+                if isinstance(o, dict) else np.array(o) for o in self.env_output])
 
         self._frame_skip = getattr(env, 'frame_skip', 1)
         self._frames_per_step = self.env.n_envs * self._frame_skip
@@ -38,6 +64,7 @@ class Runner:
 
         record_envs = record_envs or self.env.n_envs
         self._record_envs = list(range(record_envs))
+        self._record_mask = np.arange(self.env.n_envs) < record_envs
 
         self._info_func = info_func
 
@@ -67,21 +94,70 @@ class Runner:
         for t in range(nsteps):
             action = action_selector(self.env_output, evaluation=False)
             obs, reset = self.step_env(obs, action, step_fn)
-            
-            # logging when any env is reset 
-            done_env_ids = [i for i, r in enumerate(reset)
-                if (np.all(r) if isinstance(r, np.ndarray) else r) 
-                and i in self._record_envs]
-            if done_env_ids:
-                info = self.env.info(done_env_ids)
-                # further filter done caused by life loss
-                info = [i for i in info if i.get('game_over')]
-                if info:
-                    self.store_info(info)
-                self.episodes[done_env_ids] += 1
+            self._record_done_envs(reset)
 
         return self.step
 
+    def _run_slots_envvec(self, *, action_selector=None, step_fn=None, 
+            nsteps=None, buffer=None):
+        """ Writes obs, action, reward, discount and terms of each step 
+        directly into buffer.step_slots(), in place of calling step_fn 
+        with a dict of them. Steps before buffer initializes its memory 
+        are added by buffer.add. Data are laid out as collect does, 
+        where terms overwrite obs, e.g., by normalized obs
+        """
+        assert step_fn is None, 'step_fn is replaced by buffer in the slots mode'
+        action_selector = action_selector or self.agent
+        nsteps = nsteps or self._default_nsteps
+
+        for t in range(nsteps):
+            obs = self.env_output.obs
+            action = action_selector(self.env_output, evaluation=False)
+            if isinstance(action, tuple):
+                assert len(action) == 2, f'Invalid action "{action}" for slots mode'
+                action, terms = action
+            else:
+                terms = {}
+            self.env_output = self.env.step(action)
+            self.step += self._frames_per_step
+            _, reward, discount, reset = self.env_output
+
+            slots = buffer.step_slots()
+            if slots is None:
+                obs = {} if 'obs' in terms else obs
+                buffer.add(**{**obs, 'action': action, 'reward': reward, 
+                    'discount': discount, **terms})
+            else:
+                if 'obs' not in terms:
+                    for k, v in obs.items():
+                        slots[k][...] = v
+                slots['action'][...] = action
+                slots['reward'][...] = reward
+                slots['discount'][...] = discount
+                for k, v in terms.items():
+                    slots[k][...] = v
+                buffer.advance()
+
+            self._record_done_envs(reset)
+
+        return self.step
+
+    def _record_done_envs(self, reset, idxes=None):
+        """ Records info of recorded environments that are reset, 
+        where reset is aligned with idxes, all environments by default """
+        reset = np.asarray(reset)
+        if reset.ndim > 1:
+            reset = np.all(reset, axis=tuple(range(1, reset.ndim)))
+        idxes = np.arange(len(reset)) if idxes is None else np.asarray(idxes)
+        done_env_ids = idxes[np.logical_and(reset, self._record_mask[idxes])].tolist()
+        if done_env_ids:
+            info = self.env.info(done_env_ids)
+            # further filter done caused by life loss
+            info = [i for i in info if i.get('game_over')]
+            if info:
+                self.store_info(info)
+            self.episodes[done_env_ids] += 1
+
     def _run_traj_env(self, action_selector=None, step_fn=None):
         action_selector = action_selector or self.agent
         obs = self.env_output.obs
@@ -117,6 +193,80 @@ class Runner:
 
         return self.step
 
+    def _run_async_envvec(self, *, action_selector=None, step_fn=None, nsteps=None):
+        """ Computes actions for whichever min_ready environments are done 
+        stepping, while the others are still stepping. 
+        
+        Transitions are queued per environment, step_fn receives a batch
+        of transitions, one from each environment, when every environment 
+        has one. Therefore, batch dimensions keep matching environments, 
+        but transitions in a batch may come from different time steps.
+        Notice that action_selector is called with a subset of environments, 
+        making this mode unsuitable for agents that keep per-environment states
+        """
+        action_selector = action_selector or self.agent
+        nsteps = nsteps or self._default_nsteps
+        
+        n_env_steps = 0
+        while n_env_steps < nsteps * self.env.n_envs:
+            self._step_async(action_selector)
+            idxes, env_output = self.env.step_wait(self._min_ready)
+            n_env_steps += len(idxes)
+            self.step += len(idxes) * self._frame_skip
+            # transitions are only queued for step_fn, otherwise 
+            # full queues would stop _step_async from stepping any env
+            for j, i in enumerate(idxes if step_fn else []):
+                self._transitions[i].append(dict(
+                    # copy as self.env_output is updated in place below
+                    obs={k: v[i].copy() for k, v in self.env_output.obs.items()},
+                    action=self._actions[i],
+                    reward=env_output.reward[j],
+                    discount=env_output.discount[j],
+                    next_obs={k: v[j] for k, v in env_output.obs.items()},
+                    prev_reset=self.env_output.reset[i],
+                    **{k: v[i] for k, v in self._terms.items()}))
+            self.env_output[idxes] = env_output
+            self._ready_envs += idxes
+
+            self._record_done_envs(env_output.reset, idxes)
+
+            if step_fn:
+                while all(self._transitions):
+                    self._step_fn_on_transitions(step_fn)
+
+        return self.step
+
+    def _step_async(self, action_selector):
+        """ Computes actions for ready environments that are not too far 
+        ahead of others, and starts stepping them """
+        n_queued = [len(t) for t in self._transitions]
+        idxes = sorted(i for i in self._ready_envs if n_queued[i] < self._max_lag)
+        if not idxes:
+            return
+        self._ready_envs = [i for i in self._ready_envs if i not in idxes]
+        action = action_selector(self.env_output[idxes], evaluation=False)
+        if isinstance(action, tuple):
+            assert len(action) == 2, f'Invalid action "{action}" for async mode'
+            action, terms = action
+        else:
+            terms = {}
+        if self._actions is None:
+            self._actions = np.zeros((self.env.n_envs, *action.shape[1:]), action.dtype)
+            self._terms = {k: np.zeros((self.env.n_envs, *v.shape[1:]), v.dtype)
+                for k, v in terms.items()}
+        self._actions[idxes] = action
+        for k, v in terms.items():
+            self._terms[k][idxes] = v
+        self.env.step_async(action, idxes)
+
+    def _step_fn_on_transitions(self, step_fn):
+        """ Calls step_fn on the earliest queued transition of each environment """
+        transitions = [t.popleft() for t in self._transitions]
+        kwargs = batch_dicts(transitions, 
+            lambda x: batch_dicts(x) if isinstance(x[0], dict) else np.stack(x))
+        prev_reset = kwargs.pop('prev_reset')
+        step_fn(self.env, self.step, prev_reset, **kwargs)
+
     def step_env(self, obs, action, step_fn):
         prev_reset = self.env_output.reset
         if isinstance(action, tuple):
@@ -181,7 +331,7 @@ def evaluate(env,
     n_done_eps = 0
     frame_skip = None
     obs = env_output.obs
-    prev_done = np.zeros(env.n_envs)
+    prev_done = np.zeros(env.n_envs, bool)
     while n_done_eps < n:
         for k in range(max_steps):
             if record_video:
@@ -229,26 +379,15 @@ def evaluate(env,
                     break
             else:
                 done = env.game_over()
-                done_env_ids = [i for i, (d, pd) in 
-                    enumerate(zip(done, prev_done)) if d and not pd]
+                done_env_ids = np.nonzero(np.logical_and(done, np.logical_not(prev_done)))[0]
                 n_done_eps += len(done_env_ids)
-                if done_env_ids:
-                    score = env.score(done_env_ids)
-                    epslen = env.epslen(done_env_ids)
-                    scores += score
-                    epslens += epslen
+                if len(done_env_ids):
+                    scores += list(env.score(done_env_ids))
+                    epslens += list(env.epslen(done_env_ids))
                     if n_run_eps < n:
                         reset_env_ids = done_env_ids[:n-n_run_eps]
                         n_run_eps += len(reset_env_ids)
-                        eo = env.reset(reset_env_ids)
-                        for t, s in zip(env_output, eo):
-                            if isinstance(t, dict):
-                                for k in t.keys():
-                                    for i, ri in enumerate(reset_env_ids):
-                                        t[k][ri] = s[k][i]
-                            else:
-                                for i, ri in enumerate(reset_env_ids):
-                                    t[ri] = s[i]
+                        env_output[reset_env_ids] = env.reset(reset_env_ids)
                     elif n_done_eps == n:
                         break
                 prev_done = done